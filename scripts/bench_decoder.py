@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# benchmark: decoding the ||/::-encoded stage 2 columns, one row at a time in Python vs. a column at a time in Arrow
+
+import sys
+import time
+
+from argparse import ArgumentParser
+from glob import glob
+
+import pandas as pd
+
+from stage2_decoder import GUN_FIELDS, PARTICIPANT_FIELDS, decode_list, guns, legacy_rows, participants
+from stage2_loader import load_stage2_csv
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'csv_glob',
+        metavar='CSVS',
+        help="glob matching stage 2 or stage 3 CSV files, e.g. 'stage2.*.csv'",
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        metavar='NUM',
+        help="number of passes over the data; the fastest pass is reported",
+        action='store',
+        dest='repeat',
+        type=int,
+        default=3,
+    )
+    return parser.parse_args()
+
+def best_of(repeat, func, df):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(df)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# The baseline: what a reader of the CSV would otherwise write, splitting each value with str.split.
+
+def _split_dict(value):
+    if not isinstance(value, str) or not value:
+        return {}
+    item_sep, kv_sep = ('||', '::') if '::' in value else ('|', ':')
+    return dict(item.split(kv_sep, 1) for item in value.split(item_sep))
+
+def _split_list(value):
+    if not isinstance(value, str) or not value:
+        return []
+    return value.split('||' if '||' in value else '|')
+
+def _naive_entities(df, prefix, fields):
+    records = []
+    for values in zip(df['incident_id'], *[df[prefix + field] for field in fields]):
+        dicts = [_split_dict(value) for value in values[1:]]
+        ids = sorted({int(id) for d in dicts for id in d})
+        for id in ids:
+            records.append([values[0], id] + [d.get(str(id)) for d in dicts])
+    return records
+
+def naive(df):
+    _naive_entities(df, 'participant_', PARTICIPANT_FIELDS)
+    _naive_entities(df, 'gun_', GUN_FIELDS)
+    for column in ['incident_characteristics', 'sources']:
+        [_split_list(value) for value in df[column]]
+
+def vectorized(df):
+    legacy = legacy_rows(df)
+    participants(df, legacy=legacy)
+    guns(df, legacy=legacy)
+    for column in ['incident_characteristics', 'sources']:
+        decode_list(df[column], legacy)
+
+def main():
+    args = parse_args()
+    fnames = sorted(glob(args.csv_glob))
+    if not fnames:
+        sys.exit("No files match {}".format(args.csv_glob))
+    df = pd.concat([load_stage2_csv(fname) for fname in fnames], ignore_index=True)
+
+    naive_time = best_of(args.repeat, naive, df)
+    vectorized_time = best_of(args.repeat, vectorized, df)
+
+    n = len(df)
+    print("{} rows from {} files, best of {}".format(n, len(fnames), args.repeat))
+    print("  per-row str.split:   {:6.2f} s ({:.1f} us/row)".format(naive_time, naive_time / n * 1e6))
+    print("  vectorized (Arrow):  {:6.2f} s ({:.1f} us/row, {:.1f}x)".format(vectorized_time, vectorized_time / n * 1e6, naive_time / vectorized_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# micro-benchmark: per-page cost of locating incident page sections, one scan per title vs. a single-pass index
+
+import sys
+import time
+
+from argparse import ArgumentParser
+from glob import glob
+
+from stage2_backends import BACKENDS, get_backend
+from stage2_extractor import Context, Stage2Extractor
+
+SECTION_TITLES = [
+    'Location',
+    'Participants',
+    'Incident Characteristics',
+    'Notes',
+    'Guns Involved',
+    'Sources',
+    'District',
+]
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'pages_glob',
+        metavar='PAGES',
+        help="glob matching saved incident pages (the innerHTML of .region-content), e.g. 'pages/*.html'",
+    )
+    parser.add_argument(
+        '-p', '--parser',
+        help="HTML parser backend to benchmark",
+        action='store',
+        dest='parser',
+        choices=sorted(BACKENDS),
+        default='html5lib',
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        metavar='NUM',
+        help="number of passes over the pages; the fastest pass is reported",
+        action='store',
+        dest='repeat',
+        type=int,
+        default=5,
+    )
+    return parser.parse_args()
+
+def best_of(repeat, func, items):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    args = parse_args()
+    fnames = sorted(glob(args.pages_glob))
+    if not fnames:
+        sys.exit("No pages match {}".format(args.pages_glob))
+
+    texts = []
+    for fname in fnames:
+        with open(fname, encoding='utf-8') as file:
+            texts.append(file.read())
+
+    backend = get_backend(args.parser)
+    roots = [backend.parse(text) for text in texts]
+
+    def scan_per_title(root):
+        return {title: backend.find_section(root, title) for title in SECTION_TITLES}
+
+    scan_time = best_of(args.repeat, scan_per_title, roots)
+    index_time = best_of(args.repeat, backend.sections, roots)
+
+    extractor = Stage2Extractor(backend=args.parser)
+    ctx = Context(address='', city_or_county='', state='')
+    extract_time = best_of(args.repeat, lambda text: extractor.extract_fields(text, ctx), texts)
+
+    n = len(texts)
+    print("{} pages, parser={}, best of {}".format(n, args.parser, args.repeat))
+    print("  section lookup, scan per title: {:8.1f} us/page".format(scan_time / n * 1e6))
+    print("  section lookup, single index:   {:8.1f} us/page ({:.1f}x)".format(index_time / n * 1e6, scan_time / index_time))
+    print("  extract_fields (parse + index): {:8.1f} us/page".format(extract_time / n * 1e6))
+
+if __name__ == '__main__':
+    main()
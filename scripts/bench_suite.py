@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# benchmark suite: times the hot paths of every stage offline and flags regressions against stored baselines
+
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+# Page parsing runs on the saved pages in bench_corpus/: incident pages (the innerHTML of .region-content,
+# as stage 2 gets it from the browser) and query result pages (the whole document, as stage 1 gets it).
+# They follow GVA's markup and cover the variations the parsers have to handle: several participants or
+# none, missing Notes/Guns Involved/District sections, rows without a source link and so on.
+#
+# Stage 3 and remove_incidents.py run on synthetic stage 2 files of each --sizes row count, generated in a
+# temporary directory before timing starts.
+#
+# Each benchmark reports the best of --repeat runs. Results are compared with the baseline file and any
+# that got more than --threshold slower are flagged, in which case the exit status is 1. Timings depend on
+# the machine, so regenerate the baseline with --save-baseline when moving to a different one.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(SCRIPTS_DIR, 'bench_corpus')
+BASELINE_FNAME = os.path.join(SCRIPTS_DIR, 'bench_baseline.json')
+DEFAULT_SIZES = '10000,100000,1000000'
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-k', '--only',
+        metavar='PATTERN',
+        help="only run benchmarks whose name matches this regular expression",
+        action='store',
+        dest='only',
+        default=None,
+    )
+    parser.add_argument(
+        '-s', '--sizes',
+        metavar='NUM,...',
+        help="row counts of the synthetic datasets (default: {})".format(DEFAULT_SIZES),
+        action='store',
+        dest='sizes',
+        default=DEFAULT_SIZES,
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        metavar='NUM',
+        help="number of runs of each benchmark; the fastest is reported",
+        action='store',
+        dest='repeat',
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        '-b', '--baseline',
+        metavar='FILE',
+        help="baseline results to compare against",
+        action='store',
+        dest='baseline_fname',
+        default=BASELINE_FNAME,
+    )
+    parser.add_argument(
+        '-t', '--threshold',
+        metavar='FRACTION',
+        help="flag benchmarks that are more than this fraction slower than the baseline",
+        action='store',
+        dest='threshold',
+        type=float,
+        default=0.25,
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help="write the results as JSON to this file",
+        action='store',
+        dest='output_fname',
+        default=None,
+    )
+    parser.add_argument(
+        '--save-baseline',
+        help="store the results as the new baseline instead of comparing against it",
+        action='store_true',
+        dest='save_baseline',
+    )
+    return parser.parse_args()
+
+def best_of(repeat, func, setup=None):
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def best_of_looped(repeat, func, min_time=0.2):
+    # For benchmarks that take milliseconds: each run calls `func` as many times as it takes to fill
+    # `min_time`, like timeit's autorange, and the time of a single call is reported.
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_time:
+            break
+        number *= 2
+    return best_of(repeat, lambda: [func() for _ in range(number)]) / number
+
+def read_corpus(kind):
+    texts = []
+    for fname in sorted(glob(os.path.join(CORPUS_DIR, kind, '*.html'))):
+        with open(fname, encoding='utf-8') as file:
+            texts.append(file.read())
+    if not texts:
+        sys.exit("No {} pages in {}".format(kind, CORPUS_DIR))
+    return texts
+
+# Page parsing
+
+def _incident_context(text):
+    # Location lines matching the row's city and state are skipped by the extractor, so take them from the page.
+    from stage2_extractor import Context
+    match = re.search(r'<span>([^<,]+), ([^<,]+)</span>', text)
+    return Context(address='', city_or_county=match.group(1), state=match.group(2))
+
+def bench_stage2(add, repeat):
+    from stage2_backends import BACKENDS
+    from stage2_extractor import Stage2Extractor, _normalize
+
+    pages = [(text, _incident_context(text)) for text in read_corpus('incidents')]
+    for backend in sorted(BACKENDS):
+        extractor = Stage2Extractor(backend=backend)
+        add('stage2_extract_fields[{}]'.format(backend), len(pages),
+            best_of_looped(repeat, lambda: [extractor.extract_fields(text, ctx) for text, ctx in pages]))
+
+    # _normalize gets the fields in extraction order, without the ones the page doesn't have.
+    fields = [Stage2Extractor().extract_fields(text, ctx) for text, ctx in pages]
+    unnormalized = [[field for field in reversed(page_fields) if field.value is not None] for page_fields in fields]
+    add('stage2_normalize', len(unnormalized),
+        best_of_looped(repeat, lambda: [_normalize(page_fields) for page_fields in unnormalized]))
+
+def bench_stage1(add, repeat):
+    # stage1_parse_page times what Stage1Serializer does with a page; the [bs4] variants time the html5lib
+    # tree it used to build, for comparison.
+    from bs4 import BeautifulSoup
+    from stage1_serializer import _get_info, _get_row, _result_trs
+
+    texts = read_corpus('queries')
+    soup_trs = [tr for text in texts for tr in BeautifulSoup(text, 'html5lib').select('.responsive tbody tr')]
+    trs = [tr for text in texts for tr in _result_trs(text)]
+    if [_get_info(tr) for tr in soup_trs] != [_get_row(tr) for tr in trs]:
+        sys.exit("_get_row() and _get_info() disagree on the corpus")
+    add('stage1_get_info', len(soup_trs), best_of_looped(repeat, lambda: [_get_info(tr) for tr in soup_trs]))
+    add('stage1_get_row', len(trs), best_of_looped(repeat, lambda: [_get_row(tr) for tr in trs]))
+
+    def parse_pages_bs4():
+        for text in texts:
+            [_get_info(tr) for tr in BeautifulSoup(text, 'html5lib').select('.responsive tbody tr')]
+    add('stage1_parse_page[bs4]', len(texts), best_of_looped(repeat, parse_pages_bs4))
+
+    def parse_pages():
+        for text in texts:
+            [_get_row(tr) for tr in _result_trs(text)]
+    add('stage1_parse_page', len(texts), best_of_looped(repeat, parse_pages))
+
+# Synthetic datasets
+
+def synthetic_stage2(n, seed=0):
+    # A stage 2 file with every column load_stage2_csv() knows about, in random date order.
+    from stage2_loader import SCHEMA, STATES
+    rng = np.random.default_rng(seed)
+    ids = rng.permutation(n) + 100000
+    days = rng.integers(0, 365 * 5, n)
+    df = pd.DataFrame({
+        'incident_id': ids,
+        'date': (np.datetime64('2013-01-01') + days).astype(str),
+        'state': np.array(STATES)[rng.integers(0, len(STATES), n)],
+        'city_or_county': 'Springfield',
+        'address': '100 block of Main St',
+        'n_killed': rng.integers(0, 3, n),
+        'n_injured': rng.integers(0, 4, n),
+        'n_suspects_killed': 0,
+        'n_suspects_injured': 0,
+        'n_suspects_arrested': rng.integers(0, 2, n),
+        'incident_url': ['http://www.gunviolencearchive.org/incident/{}'.format(id) for id in ids],
+        'source_url': 'http://example.com/story',
+        'incident_url_fields_missing': False,
+        'congressional_district': rng.integers(1, 20, n),
+        'gun_stolen': '0::Unknown||1::Stolen',
+        'gun_type': '0::Handgun||1::9mm',
+        'incident_characteristics': 'Shot - Wounded/Injured||Drive-by (car to street, car to car)',
+        'latitude': rng.uniform(25, 48, n).round(4),
+        'location_description': '',
+        'longitude': rng.uniform(-122, -71, n).round(4),
+        'n_guns_involved': 2,
+        'notes': 'Man shot in leg outside store.',
+        'participant_age': '0::24||1::31',
+        'participant_age_group': '0::Adult 18+||1::Adult 18+',
+        'participant_gender': '0::Male||1::Male',
+        'participant_name': '',
+        'participant_relationship': '',
+        'participant_status': '0::Injured||1::Unharmed, Arrested',
+        'participant_type': '0::Victim||1::Subject-Suspect',
+        'sources': 'http://example.com/story',
+        'state_house_district': rng.integers(1, 100, n),
+        'state_senate_district': rng.integers(1, 40, n),
+    })
+    return df[list(SCHEMA)[:1] + ['date'] + list(SCHEMA)[1:]]
+
+def bench_stage3(add, repeat, n, tmp_dir):
+    from stage3 import merge_runs, write_sorted_runs
+
+    # Stage 3 merges many files that overlap in time, so split the rows over four of them.
+    df = synthetic_stage2(n)
+    fnames = []
+    bounds = np.linspace(0, n, 5).astype(int)
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        fnames.append(os.path.join(tmp_dir, 'stage2.{}.csv'.format(i)))
+        df.iloc[start:end].to_csv(fnames[-1], index=False, float_format='%g', encoding='utf-8')
+    columns = df.columns.tolist()
+    run_dir = os.path.join(tmp_dir, 'runs')
+
+    def reset_runs():
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.mkdir(run_dir)
+
+    run_fnames = []
+    def sort_runs():
+        run_fnames[:] = [run_fname
+                         for i, fname in enumerate(fnames)
+                         for run_fname in write_sorted_runs(fname, columns, os.path.join(run_dir, 'run{}'.format(i)), 100000)]
+    add('stage3_sort_runs[{}]'.format(n), n, best_of(repeat, sort_runs, setup=reset_runs))
+
+    output_fname = os.path.join(tmp_dir, 'stage3.csv')
+    add('stage3_merge_runs[{}]'.format(n), n, best_of(repeat, lambda: merge_runs(run_fnames, columns, output_fname)))
+
+def bench_remove_incidents(add, repeat, n, tmp_dir):
+    from remove_incidents import incident_ids, load_completed_ids, remove_completed
+
+    # Half of the source rows have already been through stage 2.
+    df = synthetic_stage2(n, seed=1)
+    stage1_columns = ['date', 'state', 'city_or_county', 'address', 'n_killed', 'n_injured', 'incident_url', 'source_url']
+    pristine_fname = os.path.join(tmp_dir, 'source.csv.orig')
+    source_fname = os.path.join(tmp_dir, 'source.csv')
+    result_fname = os.path.join(tmp_dir, 'result.csv')
+    df[stage1_columns].to_csv(pristine_fname, index=False, encoding='utf-8')
+    df.sample(frac=0.5, random_state=1).to_csv(result_fname, index=False, float_format='%g', encoding='utf-8')
+
+    completed_ids = load_completed_ids([result_fname])
+    source_ids = incident_ids(pd.read_csv(pristine_fname))
+    add('remove_incidents_isin[{}]'.format(n), n, best_of_looped(repeat, lambda: np.isin(source_ids, completed_ids)))
+    add('remove_incidents[{}]'.format(n), n,
+        best_of(repeat,
+                lambda: remove_completed(source_fname, load_completed_ids([result_fname])),
+                setup=lambda: shutil.copyfile(pristine_fname, source_fname)))
+
+def run_benchmarks(args):
+    pattern = re.compile(args.only) if args.only else None
+    results = {}
+
+    def wants(name):
+        return pattern is None or pattern.search(name)
+
+    def add(name, n, seconds):
+        results[name] = {'seconds': seconds, 'n': n, 'us_per_item': seconds / n * 1e6}
+        print("  {:40} {:10.4f} s {:12.2f} us/item".format(name, seconds, seconds / n * 1e6), file=sys.stderr)
+
+    # A group of benchmarks runs if any of its names is selected; the others in it are left out of the results.
+    from stage2_backends import BACKENDS
+    if any(map(wants, ['stage2_extract_fields[{}]'.format(backend) for backend in BACKENDS] + ['stage2_normalize'])):
+        bench_stage2(add, args.repeat)
+    if any(map(wants, ['stage1_get_info', 'stage1_get_row', 'stage1_parse_page[bs4]', 'stage1_parse_page'])):
+        bench_stage1(add, args.repeat)
+    for n in map(int, args.sizes.split(',')):
+        with tempfile.TemporaryDirectory(prefix='bench.') as tmp_dir:
+            if any(map(wants, ['stage3_sort_runs[{}]'.format(n), 'stage3_merge_runs[{}]'.format(n)])):
+                bench_stage3(add, args.repeat, n, tmp_dir)
+            if any(map(wants, ['remove_incidents[{}]'.format(n), 'remove_incidents_isin[{}]'.format(n)])):
+                bench_remove_incidents(add, args.repeat, n, tmp_dir)
+    return {name: result for name, result in results.items() if wants(name)}
+
+def compare(results, baseline, threshold):
+    # Returns the names of the benchmarks that regressed.
+    regressions = []
+    print("{:40} {:>10} {:>10} {:>8}".format('benchmark', 'baseline', 'now', 'change'))
+    for name, result in results.items():
+        if name not in baseline:
+            print("{:40} {:>10} {:10.4f} {:>8}".format(name, '-', result['seconds'], 'new'))
+            continue
+        before = baseline[name]['seconds']
+        change = result['seconds'] / before - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("{:40} {:10.4f} {:10.4f} {:+7.1%}{}".format(name, before, result['seconds'], change, flag))
+    return regressions
+
+def main():
+    args = parse_args()
+    results = {
+        'python': platform.python_version(),
+        'machine': '{} {} ({} CPUs)'.format(platform.system(), platform.machine(), os.cpu_count()),
+        'time': int(time.time()),
+        'repeat': args.repeat,
+        'benchmarks': run_benchmarks(args),
+    }
+    if args.output_fname is not None:
+        with open(args.output_fname, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline_fname):
+            with open(args.baseline_fname, encoding='utf-8') as file:
+                baseline = json.load(file)
+        # Benchmarks that weren't run keep their old baselines.
+        baseline.update({key: value for key, value in results.items() if key != 'benchmarks'})
+        baseline['benchmarks'] = dict(baseline.get('benchmarks', {}), **results['benchmarks'])
+        with open(args.baseline_fname, 'w', encoding='utf-8') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print("Saved {} results to {}".format(len(results['benchmarks']), args.baseline_fname), file=sys.stderr)
+        return
+
+    if not os.path.exists(args.baseline_fname):
+        sys.exit("No baseline at {}; run with --save-baseline first".format(args.baseline_fname))
+    with open(args.baseline_fname, encoding='utf-8') as file:
+        baseline = json.load(file)
+    if baseline.get('machine') != results['machine']:
+        print("Baseline was recorded on {}; this is {}".format(baseline.get('machine'), results['machine']), file=sys.stderr)
+    regressions = compare(results['benchmarks'], baseline['benchmarks'], args.threshold)
+    if regressions:
+        print("{} benchmark(s) more than {:.0%} slower than the baseline: {}".format(
+            len(regressions), args.threshold, ', '.join(regressions)), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
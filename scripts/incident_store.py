@@ -0,0 +1,174 @@
+import sqlite3
+
+import pandas as pd
+
+from stage2_extractor import ALL_FIELD_NAMES
+
+# Optional SQLite store for stage 1 rows and stage 2 fields, used in place of diffing CSV files to
+# track progress.
+#
+# Both stages upsert into it keyed by incident_id, so re-running either one just overwrites what's
+# there. The incidents stage 2 still has to do are the stage 1 rows without a stage 2 row, which is a
+# single anti-join on the incident_id primary keys. Dates are stored as YYYY-MM-DD, so date ranges
+# compare as strings and can use the date index.
+
+INCIDENT_URL_PREFIX = 'http://www.gunviolencearchive.org/incident/'
+
+STAGE1_COLUMNS = [
+    'date',
+    'state',
+    'city_or_county',
+    'address',
+    'n_killed',
+    'n_injured',
+    'n_suspects_killed',
+    'n_suspects_injured',
+    'n_suspects_arrested',
+    'incident_url',
+    'source_url',
+]
+STAGE2_COLUMNS = ALL_FIELD_NAMES
+
+def incident_id_from_url(incident_url):
+    assert incident_url.startswith(INCIDENT_URL_PREFIX)
+    return int(incident_url[len(INCIDENT_URL_PREFIX):])
+
+def _normalize_date(value):
+    # Stage 1 scrapes dates like 'June 19, 2015'; stage 2 reads them back as Timestamps.
+    return pd.Timestamp(value).strftime('%Y-%m-%d')
+
+def _sql_value(value):
+    # NaN (pandas' missing value) and numpy scalars aren't understood by sqlite3.
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+def _upsert_sql(table, columns):
+    updates = ', '.join('{0} = excluded.{0}'.format(column) for column in columns)
+    return 'INSERT INTO {} (incident_id, {}) VALUES ({}) ON CONFLICT (incident_id) DO UPDATE SET {}'.format(
+        table, ', '.join(columns), ', '.join(['?'] * (len(columns) + 1)), updates)
+
+class IncidentStore(object):
+    def __init__(self, fname, commit_every=100):
+        self.fname = fname
+        self._commit_every = commit_every
+        self._n_uncommitted = 0
+
+        self._conn = sqlite3.connect(fname)
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS stage1 (
+                incident_id INTEGER PRIMARY KEY,
+                {}
+            );
+            CREATE INDEX IF NOT EXISTS stage1_date ON stage1 (date);
+            CREATE INDEX IF NOT EXISTS stage1_state ON stage1 (state);
+            CREATE TABLE IF NOT EXISTS stage2 (
+                incident_id INTEGER PRIMARY KEY,
+                {}
+            );
+        '''.format(',\n'.join(STAGE1_COLUMNS), ',\n'.join(STAGE2_COLUMNS)))
+        self._upsert_stage1_sql = _upsert_sql('stage1', STAGE1_COLUMNS)
+        self._upsert_stage2_sql = _upsert_sql('stage2', STAGE2_COLUMNS)
+
+    def _stage1_values(self, row):
+        # `row` maps stage 1 column names to values; columns older files don't have are stored as NULL.
+        values = [_sql_value(row.get(column)) for column in STAGE1_COLUMNS]
+        values[0] = _normalize_date(row['date'])
+        return [incident_id_from_url(row['incident_url'])] + values
+
+    def upsert_stage1(self, rows):
+        # Rows without an incident URL have no incident_id to key them by, and nothing for stage 2 to fetch.
+        rows = (row for row in rows if isinstance(row.get('incident_url'), str) and row['incident_url'])
+        self._conn.executemany(self._upsert_stage1_sql, (self._stage1_values(row) for row in rows))
+        self._conn.commit()
+
+    def import_stage1_csv(self, fname, chunk_size=10000):
+        # Loads a stage 1 CSV into the store and returns the incident_ids of its rows.
+        ids = []
+        for chunk in pd.read_csv(fname, encoding='utf-8', chunksize=chunk_size):
+            chunk['date'] = pd.to_datetime(chunk['date'], format='mixed')
+            rows = chunk.to_dict('records')
+            self.upsert_stage1(rows)
+            ids += [incident_id_from_url(row['incident_url']) for row in rows
+                    if isinstance(row.get('incident_url'), str) and row['incident_url']]
+        return ids
+
+    def upsert_stage2(self, incident_id, fields):
+        # `fields` maps stage 2 field names to values. Commits every `commit_every` calls.
+        values = [_sql_value(fields.get(column)) for column in STAGE2_COLUMNS]
+        self._conn.execute(self._upsert_stage2_sql, [int(incident_id)] + values)
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= self._commit_every:
+            self.commit()
+
+    def pending(self, ids=None, start=None, end=None, state=None, batch_size=1000):
+        # Yields the stage 1 rows (as dicts, with incident_id) that have no stage 2 fields yet, optionally
+        # limited to the incidents in `ids` (e.g. one input file's; the store holds every file imported so
+        # far), to dates between `start` and `end` inclusive and to one state.
+        #
+        # Rows are read `batch_size` at a time, each batch picking up after the last row of the one before,
+        # so no cursor stays open while the caller upserts and commits stage 2 rows.
+        conditions, params = [], []
+        join = ''
+        if ids is not None:
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS pending_ids (incident_id INTEGER PRIMARY KEY)')
+            self._conn.execute('DELETE FROM pending_ids')
+            self._conn.executemany('INSERT OR IGNORE INTO pending_ids VALUES (?)', ((int(i),) for i in ids))
+            join = 'JOIN pending_ids p ON p.incident_id = s1.incident_id'
+        if start is not None:
+            conditions.append('s1.date >= ?')
+            params.append(_normalize_date(start))
+        if end is not None:
+            conditions.append('s1.date <= ?')
+            params.append(_normalize_date(end))
+        if state is not None:
+            conditions.append('s1.state = ?')
+            params.append(state)
+        conditions.append('NOT EXISTS (SELECT 1 FROM stage2 s2 WHERE s2.incident_id = s1.incident_id)')
+
+        columns = ['incident_id'] + STAGE1_COLUMNS
+        sql = 'SELECT {} FROM stage1 s1 {} WHERE {} AND (s1.date, s1.incident_id) > (?, ?) ORDER BY s1.date, s1.incident_id LIMIT ?'.format(
+            ', '.join('s1.' + column for column in columns), join, ' AND '.join(conditions))
+        last = ('', -1)
+        while True:
+            batch = self._conn.execute(sql, params + list(last) + [batch_size]).fetchall()
+            for values in batch:
+                yield dict(zip(columns, values))
+            if len(batch) < batch_size:
+                return
+            last = (batch[-1][columns.index('date')], batch[-1][0])
+
+    def count(self, table):
+        return self._conn.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+
+    def commit(self):
+        self._conn.commit()
+        self._n_uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+def add_store_args(parser):
+    parser.add_argument(
+        '--store',
+        metavar='FILE',
+        help="also record incidents in this SQLite database, and (in stage 2) use it to find the ones left to do",
+        action='store',
+        dest='store_fname',
+        default=None,
+    )
+
+def open_store(args):
+    if args.store_fname is None:
+        return None
+    return IncidentStore(args.store_fname)
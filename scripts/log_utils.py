@@ -1,11 +1,14 @@
 import logging as log
-
-from inspect import stack
+import sys
 
 _funcs_logged = set()
 
 def log_first_call(level=log.DEBUG):
-    funcname = stack()[1].function
-    if funcname not in _funcs_logged:
-        _funcs_logged.add(funcname)
-        log.log(level, "%s() called", funcname)
+    # Called at the top of hot functions, so it returns straight away unless `level` is enabled, and only
+    # looks at the caller's frame instead of building the whole stack with inspect.stack().
+    if not log.root.isEnabledFor(level):
+        return
+    code = sys._getframe(1).f_code
+    if code not in _funcs_logged:
+        _funcs_logged.add(code)
+        log.log(level, "%s() called", code.co_name)
@@ -0,0 +1,175 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# Counters, gauges and histograms for watching a stage while it runs.
+#
+# Everything records into REGISTRY, which ignores every call until a stage is run with --metrics (see
+# start_metrics()), so instrumented hot paths only pay for a method call and a flag check when it's off.
+# Once enabled, a background thread writes a snapshot every `interval` seconds and once more at the end:
+# appended to the file as a line of JSON or, if its name ends in .prom, in the Prometheus text format,
+# replacing the file (as node_exporter's textfile collector expects).
+#
+# Names are prefixed with the stage, and counters end in _total. Histograms measure seconds.
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+class _Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for le, n in zip(BUCKETS, self.counts):
+            total += n
+            yield le, total
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer(object):
+    __slots__ = ('_registry', '_name', '_start')
+
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._registry.observe(self._name, time.perf_counter() - self._start)
+        return False
+
+class Registry(object):
+    def __init__(self):
+        self.enabled = False
+        # Stage 2 records from helper threads too.
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = _Histogram()
+            histogram.observe(value)
+
+    def time(self, name):
+        # with REGISTRY.time('stage1_parse_seconds'): ...
+        return _Timer(self, name) if self.enabled else _NULL_TIMER
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {name: {'count': histogram.count,
+                                      'sum': histogram.sum,
+                                      'buckets': [['+Inf' if le == float('inf') else le, n]
+                                                  for le, n in histogram.cumulative()]}
+                               for name, histogram in self._histograms.items()},
+            }
+
+REGISTRY = Registry()
+
+def format_prometheus(snapshot):
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines += ['# TYPE {} counter'.format(name), '{} {}'.format(name, value)]
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines += ['# TYPE {} gauge'.format(name), '{} {}'.format(name, value)]
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        lines.append('# TYPE {} histogram'.format(name))
+        lines += ['{}_bucket{{le="{}"}} {}'.format(name, le, n) for le, n in histogram['buckets']]
+        lines += ['{}_sum {}'.format(name, histogram['sum']), '{}_count {}'.format(name, histogram['count'])]
+    return '\n'.join(lines) + '\n'
+
+class MetricsExporter(object):
+    def __init__(self, fname, interval=10.0, registry=REGISTRY):
+        self.fname = fname
+        self.interval = interval
+        self._registry = registry
+        self._registry.enabled = True
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        snapshot = self._registry.snapshot()
+        if self.fname.endswith('.prom'):
+            tmp_fname = self.fname + '.tmp'
+            with open(tmp_fname, 'w', encoding='utf-8') as file:
+                file.write(format_prometheus(snapshot))
+            os.replace(tmp_fname, self.fname)
+        else:
+            snapshot['time'] = time.time()
+            with open(self.fname, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(snapshot) + '\n')
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+        self._registry.enabled = False
+
+def add_metrics_args(parser):
+    parser.add_argument(
+        '--metrics',
+        metavar='FILE',
+        help="periodically write counters and timings to this file: JSON lines, or Prometheus text if it ends in .prom",
+        action='store',
+        dest='metrics_fname',
+        default=None,
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        metavar='SECONDS',
+        help="how often to write --metrics",
+        action='store',
+        dest='metrics_interval',
+        type=float,
+        default=10.0,
+    )
+
+def start_metrics(args):
+    if args.metrics_fname is None:
+        return None
+    return MetricsExporter(args.metrics_fname, interval=args.metrics_interval)
@@ -0,0 +1,173 @@
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# On-disk cache of downloaded pages, shared by stage 1 (query result pages) and stage 2 (incident pages).
+#
+# Page bodies are gzipped and stored once under their SHA-256 digest in blobs/, so identical pages
+# fetched from different URLs share a blob. index.sqlite maps each URL to its digest and records when it
+# was last read, which drives least-recently-used eviction once the blobs exceed `max_bytes`.
+
+INDEX_FNAME = 'index.sqlite'
+BLOB_DIRNAME = 'blobs'
+
+class CacheMiss(Exception):
+    pass
+
+def digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class PageCache(object):
+    def __init__(self, root, max_bytes=None, cache_only=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        # In cache-only mode, get() raises CacheMiss instead of letting the caller go to the network.
+        self.cache_only = cache_only
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.join(root, BLOB_DIRNAME), exist_ok=True)
+        # Stage 2 reads and writes from a helper thread, so the connection is shared behind a lock.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, INDEX_FNAME), check_same_thread=False)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at);
+            CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest);
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            );
+        ''')
+        # Running total of the blob sizes, so put() only has to look at the whole table once the cache may
+        # be over max_bytes. Another process sharing the cache can make it drift, so _evict() recounts.
+        self._total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def _blob_path(self, page_digest):
+        return os.path.join(self.root, BLOB_DIRNAME, page_digest[:2], page_digest + '.gz')
+
+    def get(self, url):
+        with self._lock:
+            row = self._conn.execute('SELECT digest FROM pages WHERE url = ?', (url,)).fetchone()
+            if row is not None:
+                self._conn.execute('UPDATE pages SET accessed_at = ? WHERE url = ?', (time.time(), url))
+                self._conn.commit()
+
+        if row is not None:
+            try:
+                with gzip.open(self._blob_path(row[0]), 'rt', encoding='utf-8') as file:
+                    text = file.read()
+            except FileNotFoundError:
+                # The blob was removed from under us; treat it like any other miss.
+                pass
+            else:
+                self.hits += 1
+                return text
+
+        self.misses += 1
+        if self.cache_only:
+            raise CacheMiss(url)
+        return None
+
+    def get_digest(self, url):
+        with self._lock:
+            row = self._conn.execute('SELECT digest FROM pages WHERE url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, url, text):
+        page_digest = digest(text)
+        path = self._blob_path(page_digest)
+        # Only the compression happens outside the lock: checking for the blob, writing it, counting its size
+        # and evicting are one step, so a concurrent put() or _evict() can't remove it or count it twice.
+        data = gzip.compress(text.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            known = self._conn.execute('SELECT 1 FROM blobs WHERE digest = ?', (page_digest,)).fetchone()
+            if not known or not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as file:
+                    file.write(data)
+                os.replace(tmp_path, path)
+            if not known:
+                self._conn.execute('INSERT INTO blobs (digest, size) VALUES (?, ?)', (page_digest, len(data)))
+                self._total += len(data)
+            self._conn.execute('INSERT OR REPLACE INTO pages (url, digest, fetched_at, accessed_at) VALUES (?, ?, ?, ?)',
+                               (url, page_digest, now, now))
+            self._evict()
+            self._conn.commit()
+        return page_digest
+
+    def size(self):
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def _evict(self, batch_size=100):
+        if self.max_bytes is None or self._total <= self.max_bytes:
+            return
+        self._total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        while self._total > self.max_bytes:
+            # Least recently used first; evicted rows are deleted, so each query picks up where the last left off.
+            lru = self._conn.execute('SELECT url, digest FROM pages ORDER BY accessed_at LIMIT ?', (batch_size,)).fetchall()
+            if not lru:
+                break
+            for url, page_digest in lru:
+                if self._total <= self.max_bytes:
+                    break
+                self._conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+                still_used = self._conn.execute('SELECT 1 FROM pages WHERE digest = ? LIMIT 1', (page_digest,)).fetchone()
+                if still_used:
+                    continue
+                row = self._conn.execute('SELECT size FROM blobs WHERE digest = ?', (page_digest,)).fetchone()
+                self._conn.execute('DELETE FROM blobs WHERE digest = ?', (page_digest,))
+                try:
+                    os.remove(self._blob_path(page_digest))
+                except FileNotFoundError:
+                    pass
+                if row is not None:
+                    self._total -= row[0]
+
+def add_cache_args(parser):
+    parser.add_argument(
+        '--cache',
+        metavar='DIR',
+        help="cache downloaded pages in this directory and reuse them on later runs",
+        action='store',
+        dest='cache_dir',
+        default=None,
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB',
+        help="evict least recently used pages once the cache grows past this many megabytes",
+        action='store',
+        dest='cache_size',
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        '--cache-only',
+        help="serve every page from the cache and never go to the network (requires --cache). stage 2 only: "
+             "stage 1 runs its searches in the browser, so it can't run offline",
+        action='store_true',
+        dest='cache_only',
+    )
+
+def open_cache(args):
+    if args.cache_dir is None:
+        if args.cache_only:
+            raise ValueError("--cache-only requires --cache")
+        return None
+    max_bytes = None if args.cache_size is None else args.cache_size * 1024 * 1024
+    return PageCache(args.cache_dir, max_bytes=max_bytes, cache_only=args.cache_only)
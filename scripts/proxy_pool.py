@@ -0,0 +1,161 @@
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import sys
+import time
+
+import aiohttp
+
+# A pool of FlareSolverr sessions for fetching pages through the proxy without a browser.
+#
+# Each proxy session is a browser inside FlareSolverr and handles one request at a time, so every request
+# checks a session out of the pool and returns it when done; throughput grows with the number of sessions.
+# Sessions are created on demand, concurrently, up to `size`. A session whose request fails is destroyed
+# and replaced by a fresh one on the next checkout, and a session that sat idle for `check_interval`
+# seconds is checked with sessions.list before it's handed out again. close() destroys them all.
+
+PROXY_URL = 'http://localhost:8191/v1'
+# Sessions take turns using these user agents.
+PROXY_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleW...',
+    'Chrome/5.0 (Windows NT 10.0; Win64; x64) AppleW...',
+]
+DEFAULT_POOL_SIZE = 4
+
+class ProxyError(Exception):
+    # The proxy answered, but with {"status": "error", ...}.
+    pass
+
+class ProxySession(object):
+    def __init__(self, session_id, user_agent):
+        self.id = session_id
+        self.user_agent = user_agent
+        self.last_used = time.monotonic()
+
+class ProxySessionPool(object):
+    def __init__(self, http, url=PROXY_URL, size=DEFAULT_POOL_SIZE, max_timeout=60000, check_interval=60.0):
+        self.url = url
+        self.size = size
+        self.max_timeout = max_timeout
+        self.check_interval = check_interval
+        self.n_created = 0
+        self.n_recycled = 0
+        self._http = http
+        self._user_agents = itertools.cycle(PROXY_USER_AGENTS)
+        self._sessions = set()
+        self._idle = collections.deque()
+        # Slots that have no session yet, because it hasn't been created or was destroyed after an error.
+        self._missing = size
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _command(self, cmd, **fields):
+        payload = {'cmd': cmd, 'maxTimeout': self.max_timeout}
+        payload.update(fields)
+        async with self._http.post(self.url, data=json.dumps(payload), headers={'content-type': 'application/json'}) as resp:
+            resp.raise_for_status()
+            data = await resp.json(content_type=None)
+        if data.get('status') != 'ok':
+            raise ProxyError("{} failed: {}".format(cmd, data.get('message')))
+        return data
+
+    async def _create(self):
+        user_agent = next(self._user_agents)
+        data = await self._command('sessions.create', userAgent=user_agent)
+        self.n_created += 1
+        session = ProxySession(data['session'], user_agent)
+        self._sessions.add(session)
+        return session
+
+    async def _destroy(self, session):
+        self._sessions.discard(session)
+        try:
+            await self._command('sessions.destroy', session=session.id)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ProxyError) as exc:
+            print("Couldn't destroy proxy session {}: {!r}".format(session.id, exc), file=sys.stderr)
+
+    async def _alive(self, session):
+        try:
+            data = await self._command('sessions.list')
+        except (aiohttp.ClientError, asyncio.TimeoutError, ProxyError):
+            return False
+        return session.id in data.get('sessions', [])
+
+    async def _recycle(self, session):
+        # The slot is refilled by whoever needs a session next.
+        self.n_recycled += 1
+        self._missing += 1
+        self._notify()
+        await self._destroy(session)
+
+    async def _acquire(self):
+        while True:
+            if self._idle:
+                session = self._idle.popleft()
+                if time.monotonic() - session.last_used >= self.check_interval and not await self._alive(session):
+                    await self._recycle(session)
+                    continue
+                return session
+            if self._missing > 0:
+                # Several callers arriving at once each create a session, so the pool fills concurrently.
+                self._missing -= 1
+                try:
+                    return await self._create()
+                except BaseException:
+                    self._missing += 1
+                    self._notify()
+                    raise
+            await self._changed.wait()
+
+    def _release(self, session):
+        session.last_used = time.monotonic()
+        self._idle.append(session)
+        self._notify()
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        # Checks a session out for a request. If the request fails, the session is destroyed instead of
+        # going back to the pool.
+        session = await self._acquire()
+        try:
+            yield session
+        except Exception:
+            await self._recycle(session)
+            raise
+        except BaseException:
+            self._release(session)
+            raise
+        self._release(session)
+
+    async def get(self, session, url):
+        # Fetches `url` through `session` and returns the proxy's JSON response.
+        return await self._command('request.get', url=url, session=session.id, userAgent=session.user_agent)
+
+    async def close(self):
+        sessions = list(self._sessions)
+        self._idle.clear()
+        await asyncio.gather(*(self._destroy(session) for session in sessions))
+
+def add_proxy_args(parser):
+    parser.add_argument(
+        '--proxy-url',
+        metavar='URL',
+        help="FlareSolverr endpoint used when fetching through the proxy",
+        action='store',
+        dest='proxy_url',
+        default=PROXY_URL,
+    )
+    parser.add_argument(
+        '--proxy-sessions',
+        metavar='NUM',
+        help="number of proxy sessions to fetch through at once",
+        action='store',
+        dest='proxy_sessions',
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+    )
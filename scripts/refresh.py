@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# refreshing stage 2 files: re-fetching recent incidents and patching the rows whose pages changed since they were scraped
+
+import asyncio
+import csv
+import json
+import logging as log
+import os
+import sys
+import time
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+from metrics import REGISTRY, add_metrics_args, start_metrics
+from page_cache import add_cache_args, open_cache
+from proxy_pool import add_proxy_args
+from request_scheduler import add_scheduler_args, open_scheduler
+from stage2_backends import BACKENDS
+from stage2_extractor import ALL_FIELD_NAMES, Stage2Extractor, init_extract_worker
+from stage2_journal import format_record, line_terminator, load_page_digests, open_digest_journal
+from stage2_session import IpBlocked, Stage2Session
+
+from selenium import webdriver
+from webdriver_manager.chrome import ChromeDriverManager
+
+# GVA edits incidents after publishing them. Every incident in the window is fetched again and its page
+# digest compared with the one recorded in digests.OUTPUT (see stage2_journal.py); only pages that
+# changed are parsed. Rows whose extracted fields actually differ are patched in place, and each patch is
+# appended to the change log as a line of JSON. If no row changed, the stage 2 file isn't rewritten.
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'stage2_fnames',
+        metavar='STAGE2',
+        nargs='+',
+        help="stage 2 output files to refresh in place",
+    )
+    parser.add_argument(
+        '-d', '--days',
+        metavar='NUM',
+        help="refresh incidents that happened in the last NUM days",
+        action='store',
+        dest='days',
+        type=int,
+        default=90,
+    )
+    parser.add_argument(
+        '--log',
+        metavar='FILE',
+        help="append a JSON line describing each patched row to this file",
+        action='store',
+        dest='log_fname',
+        default='refresh.log.jsonl',
+    )
+    parser.add_argument(
+        '--debug',
+        help="show debug information",
+        action='store_const',
+        dest='log_level',
+        const=log.DEBUG,
+        default=log.WARNING,
+    )
+    parser.add_argument(
+        '-l', '--limit',
+        metavar='NUM',
+        help="maximum number of simultaneous connections to one host: the site for the plain GETs of -f hybrid, " \
+             "or the proxy for -f proxy, whose requests --proxy-sessions also bounds",
+        action='store',
+        dest='conn_limit',
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        '-f', '--fetch',
+        help="how to fetch incident pages: one at a time through Chrome, up to --proxy-sessions at a time through the proxy, "
+             "or concurrently with plain HTTP, falling back to Chrome for pages that need it (hybrid)",
+        action='store',
+        dest='fetch',
+        choices=['browser', 'proxy', 'hybrid'],
+        default='browser',
+    )
+    parser.add_argument(
+        '--site',
+        metavar='URL',
+        help="fetch incident pages from this site instead of gunviolencearchive.org, e.g. a local replay_server.py",
+        action='store',
+        dest='site',
+        default=None,
+    )
+    parser.add_argument(
+        '-r', '--rate',
+        metavar='NUM',
+        help="maximum number of requests started per second when fetching through the proxy or with plain HTTP",
+        action='store',
+        dest='rate',
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        '-p', '--parser',
+        help="HTML parser backend used to extract fields from changed pages",
+        action='store',
+        dest='parser',
+        choices=sorted(BACKENDS),
+        default='html5lib',
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        metavar='NUM',
+        help="number of processes that parse changed pages. 0 parses in the main process",
+        action='store',
+        dest='workers',
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        '-q', '--queue-size',
+        metavar='NUM',
+        help="maximum number of fetched pages waiting to be parsed",
+        action='store',
+        dest='queue_size',
+        type=int,
+        default=32,
+    )
+    add_cache_args(parser)
+    add_scheduler_args(parser)
+    add_proxy_args(parser)
+    add_metrics_args(parser)
+
+    args = parser.parse_args()
+    if args.cache_only:
+        parser.error("--cache-only can't be used to refresh pages")
+    return args
+
+def read_rows(fname):
+    with open(fname, encoding='utf-8', newline='') as file:
+        reader = csv.reader(file)
+        return next(reader), list(reader)
+
+def write_rows(fname, columns, rows):
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file, lineterminator=line_terminator(fname))
+        writer.writerow(columns)
+        writer.writerows(rows)
+    os.replace(tmp_fname, fname)
+
+async def refresh_file(fname, args, driver, executor, cache, scheduler, change_log):
+    # Returns counts of what happened to the rows in the window. If the IP gets blocked, the rows patched so
+    # far are still written before IpBlocked propagates.
+    columns, rows = read_rows(fname)
+    index = {column: i for i, column in enumerate(columns)}
+    field_columns = [column for column in ALL_FIELD_NAMES if column in index]
+    cutoff = (date.today() - timedelta(days=args.days)).isoformat()
+
+    known_digests = load_page_digests(fname)
+    # Dates are written as YYYY-MM-DD, so comparing them as strings orders them chronologically.
+    recent = {}
+    for row in rows:
+        if row[index['date']] >= cutoff:
+            recent[int(row[index['incident_id']])] = row
+
+    def session_rows():
+        for incident_id, row in recent.items():
+            session_row = dict(zip(columns, row))
+            session_row['incident_id'] = incident_id
+            yield session_row
+
+    counts = {'fetched': 0, 'unchanged': 0, 'patched': 0, 'failed': 0}
+    new_digests = []
+    changes_made = []
+    extractor = Stage2Extractor(backend=args.parser)
+    try:
+        async with Stage2Session(extractor=extractor, cache=cache, rate=args.rate, revalidate=True,
+                                 http_first=args.fetch == 'hybrid', site=args.site,
+                                 limit_per_host=args.conn_limit, scheduler=scheduler,
+                                 proxy_url=args.proxy_url, proxy_sessions=args.proxy_sessions) as session:
+            async for row, fields, page_digest in session.iter_fields_from_incident_urls(
+                    session_rows(), driver, executor, args.queue_size, known_digests=known_digests):
+                incident_id = row['incident_id']
+                if page_digest is None:
+                    counts['failed'] += 1
+                    continue
+                counts['fetched'] += 1
+                if fields is None:
+                    counts['unchanged'] += 1
+                    continue
+                new_digests.append({'incident_id': incident_id, 'page_digest': page_digest, 'fetched_at': int(time.time())})
+
+                # The page changed, but often not in a way that changes any field.
+                old = recent[incident_id]
+                new = format_record(dict(fields), field_columns)
+                changes = {column: [old[index[column]], value]
+                           for column, value in zip(field_columns, new) if old[index[column]] != value}
+                if not changes:
+                    continue
+                for column, (_, value) in changes.items():
+                    old[index[column]] = value
+                counts['patched'] += 1
+                REGISTRY.inc('refresh_rows_patched_total')
+                changes_made.append({
+                    'file': fname,
+                    'incident_id': incident_id,
+                    'old_digest': known_digests.get(incident_id),
+                    'new_digest': page_digest,
+                    'changes': changes,
+                    'refreshed_at': int(time.time()),
+                })
+            print("{}: pages fetched: {}".format(fname, session.fetch_summary()), file=sys.stderr)
+    finally:
+        # The change log and digests are only written once the rows they describe are on disk.
+        if counts['patched']:
+            write_rows(fname, columns, rows)
+            for record in changes_made:
+                change_log.write(json.dumps(record) + '\n')
+            change_log.flush()
+        if new_digests:
+            with open_digest_journal(fname) as digests:
+                for record in new_digests:
+                    digests.append(record)
+    return counts
+
+async def main():
+    args = parse_args()
+    log.basicConfig(level=args.log_level)
+
+    driver = None
+    if args.fetch in ('browser', 'hybrid'):
+        options = webdriver.ChromeOptions()
+        options.add_experimental_option('w3c', False)
+        options.add_argument("--disable-blink-features=AutomationControlled")
+        driver = webdriver.Chrome(ChromeDriverManager().install(), options=options)
+
+    metrics = start_metrics(args)
+    cache = open_cache(args)
+    scheduler = open_scheduler(args)
+    executor = None
+    if args.workers > 0:
+        executor = ProcessPoolExecutor(max_workers=args.workers,
+                                       initializer=init_extract_worker,
+                                       initargs=(args.parser, None))
+    try:
+        with open(args.log_fname, 'a', encoding='utf-8') as change_log:
+            for fname in args.stage2_fnames:
+                try:
+                    counts = await refresh_file(fname, args, driver, executor, cache, scheduler, change_log)
+                except IpBlocked:
+                    print("IP blocked while refreshing {}; stopping".format(fname), file=sys.stderr)
+                    break
+                print("{}: {fetched} fetched, {unchanged} unchanged, {patched} patched, {failed} failed".format(fname, **counts),
+                      file=sys.stderr)
+        print("Scheduler: {} retries, {} gave up, {} IP blocks".format(
+            scheduler.n_retries, scheduler.n_gave_up, scheduler.n_blocks), file=sys.stderr)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if cache is not None:
+            cache.close()
+        if metrics is not None:
+            metrics.close()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
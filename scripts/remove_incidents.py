@@ -1,47 +1,131 @@
 #!/usr/bin/env python3
 # removing rows from source file which have already been succesfully augmented
 
+import numpy as np
+import os
 import pandas as pd
+import sys
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+INCIDENT_URL_PREFIX = 'http://www.gunviolencearchive.org/incident/'
+_RESULT_FILE_MESSAGE = "{} has an incident_id column, so it looks like a result file, not a source file"
 
 def parse_args():
-    parser = ArgumentParser()    
+    parser = ArgumentParser()
     parser.add_argument(
         'source_fname',
         metavar='SOURCE',
-        help="path to source file that we are going to remove some of the rows from"
+        help="path to source file that we are going to remove some of the rows from (a glob with --bulk)"
     )
     parser.add_argument(
         'result_fname',
         metavar='RESULT',
-        help="path to result file containing the incident ids of the augmented rows."       
+        help="path to result file containing the incident ids of the augmented rows (a glob with --bulk)"
+    )
+    parser.add_argument(
+        '-b', '--bulk',
+        help="treat SOURCE and RESULT as globs: remove the ids in every result file from every source file",
+        action='store_true',
+        dest='bulk',
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        metavar='NUM',
+        help="number of source files filtered at a time in --bulk mode",
+        action='store',
+        dest='workers',
+        type=int,
+        default=os.cpu_count(),
     )
-    args = parser.parse_args()   
+    args = parser.parse_args()
     return args
 
-def add_incident_id(df):    
-    def extract_id(incident_url):
-        PREFIX = 'http://www.gunviolencearchive.org/incident/'
-        assert incident_url.startswith(PREFIX)
-        return int(incident_url[len(PREFIX):])
+def incident_ids(df):
+    urls = df['incident_url']
+    assert urls.str.startswith(INCIDENT_URL_PREFIX).all()
+    return urls.str.slice(len(INCIDENT_URL_PREFIX)).astype(np.int64).to_numpy()
 
-    df.insert(0, 'incident_id', df['incident_url'].apply(extract_id))
-    return df
+def load_completed_ids(result_fnames):
+    # One sorted array of every id across the result files, for np.isin.
+    ids = [pd.read_csv(fname, usecols=['incident_id'])['incident_id'].to_numpy(np.int64) for fname in result_fnames]
+    return np.unique(np.concatenate(ids)) if ids else np.empty(0, dtype=np.int64)
 
-def main():
-    args = parse_args()
+def check_result(fname):
+    # Result files need an incident_id column. Some old ones don't: they're empty, or were written with a
+    # 0,1,2,... header or none at all, and their columns can't be trusted to be in the usual order.
+    try:
+        columns = pd.read_csv(fname, nrows=0).columns
+    except pd.errors.EmptyDataError:
+        raise ValueError("{} is empty".format(fname))
+    if 'incident_id' not in columns:
+        raise ValueError("{} has no incident_id column".format(fname))
+
+def check_source(fname):
+    # Stage 1 files have no incident_id column; a file that does is a stage 2 result, which must never be
+    # filtered (that would delete scraped rows).
+    if 'incident_id' in pd.read_csv(fname, nrows=0).columns:
+        raise ValueError(_RESULT_FILE_MESSAGE.format(fname))
 
-    res_df = pd.read_csv(args.result_fname) 
-    source = pd.read_csv(args.source_fname)
-    source = add_incident_id(source)
-    incident_ids = res_df['incident_id'].tolist()
-    source.drop(source[source['incident_id'].isin(incident_ids)].index, inplace = True)
-    source.drop(['incident_id'], axis=1, inplace = True)
-    source.to_csv(args.source_fname,
+def remove_completed(source_fname, completed_ids):
+    # Rewrites `source_fname` without the completed incidents and returns how many rows were removed.
+    # The file isn't touched if there's nothing to remove.
+    source = pd.read_csv(source_fname)
+    if 'incident_id' in source.columns:
+        raise ValueError(_RESULT_FILE_MESSAGE.format(source_fname))
+    done = np.isin(incident_ids(source), completed_ids)
+    n_removed = int(done.sum())
+    if n_removed == 0:
+        return 0
+
+    tmp_fname = source_fname + '.tmp'
+    source.loc[~done].to_csv(tmp_fname,
               index=False,
               float_format='%g',
-              encoding='utf-8')   
+              encoding='utf-8')
+    os.replace(tmp_fname, source_fname)
+    return n_removed
+
+def main():
+    args = parse_args()
+
+    if not args.bulk:
+        try:
+            check_source(args.source_fname)
+            check_result(args.result_fname)
+        except ValueError as e:
+            sys.exit(str(e))
+        remove_completed(args.source_fname, load_completed_ids([args.result_fname]))
+        return
+
+    all_result_fnames = sorted(glob(args.result_fname))
+    result_fnames = []
+    for result_fname in all_result_fnames:
+        # Skipping a result file only means its incidents stay in the sources and get scraped again.
+        try:
+            check_result(result_fname)
+            result_fnames.append(result_fname)
+        except ValueError as e:
+            print("{}; skipping it".format(e), file=sys.stderr)
+    # The globs may overlap (e.g. 2020_split*.csv also matches 2020_split5_res.csv): result files are never sources.
+    result_paths = set(map(os.path.abspath, all_result_fnames))
+    source_fnames = [fname for fname in sorted(glob(args.source_fname)) if os.path.abspath(fname) not in result_paths]
+    # Check every source before touching any of them.
+    try:
+        for source_fname in source_fnames:
+            check_source(source_fname)
+    except ValueError as e:
+        sys.exit(str(e))
+    completed_ids = load_completed_ids(result_fnames)
+    print("{} completed ids in {} result files".format(len(completed_ids), len(result_fnames)), file=sys.stderr)
+
+    # pandas releases the GIL for much of parsing and writing, so threads are enough to overlap the files.
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        counts = executor.map(remove_completed, source_fnames, [completed_ids] * len(source_fnames))
+        for source_fname, n_removed in zip(source_fnames, counts):
+            print("{}: removed {} rows".format(source_fname, n_removed) if n_removed else "{}: unchanged".format(source_fname),
+                  file=sys.stderr)
 
-if __name__ == '__main__':           
+if __name__ == '__main__':
    main()
-   
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# replay server: a local stand-in for gunviolencearchive.org and the FlareSolverr proxy, for load testing the scrapers offline
+
+import asyncio
+import collections
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from argparse import ArgumentParser
+from datetime import date, datetime, timedelta
+from glob import glob
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from aiohttp import web
+
+from page_cache import PageCache
+from stage2_session import CHALLENGE_MARKERS, GVA_SITE, IP_BLOCKED_MESSAGE
+
+# Serves what stage 1 and stage 2 read from the site:
+#
+#   /query                the search form stage1.query() fills in; submitting it goes to /query/FROM--TO
+#   /query/FROM--TO       results for that date window, 25 rows per ?page=N with a "Go to last page" link.
+#                         Every day in the window has --rows-per-day incidents, with ids derived from the date,
+#                         so the same window always lists the same incidents.
+#   /incident/ID          an incident page
+#   /v1                   FlareSolverr's API (sessions.create/list/destroy and request.get), serving the pages
+#                         above whatever host the requested URL names
+#   /stats                request counts, faults injected and peak concurrency, as JSON
+#
+# Pages are replayed from the recorded pages in bench_corpus/ (incident pages picked by id, result rows
+# re-labelled with their id and date), or with --cache, from a page cache filled by real runs, falling back
+# to the corpus for URLs it doesn't have. Point stage1.py and stage2.py at it with --site, or stage2.py's
+# proxy fetching with --proxy-url http://HOST:PORT/v1.
+#
+# Faults are injected on site pages (not on the form or /stats), in this order: an active IP block,
+# then a 5xx burst, random 500s, then bot check pages. An IP block starts after --block-after requests or
+# when the last 10 seconds averaged more than --block-rps requests per second, and lasts --block-duration.
+
+ROWS_PER_PAGE = 25
+MESSAGE_NO_INCIDENTS_AVAILABLE = 'There are currently no incidents available.'
+# Incident ids encode the day (counted from FIRST_DAY) and the incident's position within it.
+FIRST_DAY = date(2013, 1, 1)
+IDS_PER_DAY = 10000
+RATE_WINDOW = 10.0
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_corpus')
+
+BLOCKED_PAGE = '''<!DOCTYPE html><html><head><title>Access denied</title></head><body>
+<div id="content"><p>Your access to this site has been limited. Please contact us {} .</p></div>
+</body></html>
+'''.format(IP_BLOCKED_MESSAGE)
+
+CHALLENGE_PAGE = '''<!DOCTYPE html><html><head><title>Just a moment...</title></head><body>
+<div id="challenge-platform" class="cf-browser-verification">Checking your browser before accessing the site.</div>
+</body></html>
+'''
+
+INCIDENT_PAGE = '''<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Incident | Gun Violence Archive</title></head>
+<body class="html not-front page-incident"><div id="page"><div id="main"><div class="region region-content">
+{}</div></div></div></body></html>
+'''
+
+QUERY_FORM = '''<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Search Database | Gun Violence Archive</title></head>
+<body class="html not-front page-query"><div id="page"><div class="region region-content">
+<a href="#" class="filter-dropdown-trigger">Add a rule</a>
+<ul class="filter-dropdown"><li><a href="#">Date</a></li></ul>
+<input type="text" id="edit-query-filters-new-filter-field-date-from">
+<input type="text" id="edit-query-filters-new-filter-field-date-to">
+<button type="button" id="edit-actions-execute" onclick="location.href = '/query/' +
+  encodeURIComponent(document.getElementById('edit-query-filters-new-filter-field-date-from').value) + '--' +
+  encodeURIComponent(document.getElementById('edit-query-filters-new-filter-field-date-to').value)">Search</button>
+</div></div></body></html>
+'''
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--host',
+        help="interface to listen on",
+        action='store',
+        dest='host',
+        default='localhost',
+    )
+    parser.add_argument(
+        '--port',
+        metavar='NUM',
+        help="port to listen on",
+        action='store',
+        dest='port',
+        type=int,
+        default=8080,
+    )
+    parser.add_argument(
+        '--corpus',
+        metavar='DIR',
+        help="recorded pages to replay, laid out like bench_corpus/",
+        action='store',
+        dest='corpus_dir',
+        default=CORPUS_DIR,
+    )
+    parser.add_argument(
+        '--cache',
+        metavar='DIR',
+        help="replay pages from this page cache where it has them",
+        action='store',
+        dest='cache_dir',
+        default=None,
+    )
+    parser.add_argument(
+        '--rows-per-day',
+        metavar='NUM',
+        help="number of incidents listed for every day",
+        action='store',
+        dest='rows_per_day',
+        type=int,
+        default=120,
+    )
+    parser.add_argument(
+        '--latency',
+        metavar='MS',
+        help="mean delay before answering a site page",
+        action='store',
+        dest='latency',
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '--jitter',
+        metavar='MS',
+        help="delays are uniformly spread this far either side of --latency",
+        action='store',
+        dest='jitter',
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '--error-rate',
+        metavar='FRACTION',
+        help="fraction of site pages answered with a 500",
+        action='store',
+        dest='error_rate',
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '--burst-every',
+        metavar='NUM',
+        help="after every NUM site requests, answer the next --burst-length with 503s",
+        action='store',
+        dest='burst_every',
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        '--burst-length',
+        metavar='NUM',
+        help="length of each 503 burst",
+        action='store',
+        dest='burst_length',
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        '--challenge-rate',
+        metavar='FRACTION',
+        help="fraction of site pages answered with a bot check page",
+        action='store',
+        dest='challenge_rate',
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '--block-after',
+        metavar='NUM',
+        help="block the IP once this many site pages have been served",
+        action='store',
+        dest='block_after',
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        '--block-rps',
+        metavar='NUM',
+        help="block the IP when site requests over the last 10s average more than this many per second",
+        action='store',
+        dest='block_rps',
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        '--block-duration',
+        metavar='SECONDS',
+        help="how long an IP block lasts",
+        action='store',
+        dest='block_duration',
+        type=float,
+        default=60.0,
+    )
+    parser.add_argument(
+        '--seed',
+        metavar='NUM',
+        help="seed for the random faults and delays",
+        action='store',
+        dest='seed',
+        type=int,
+        default=None,
+    )
+    return parser.parse_args()
+
+class Faults(object):
+    # Decides what goes wrong with each site request. next() returns None, 'blocked', 'burst', 'error' or
+    # 'challenge'.
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, burst_every=None, burst_length=10,
+                 challenge_rate=0.0, block_after=None, block_rps=None, block_duration=60.0, seed=None):
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.challenge_rate = challenge_rate
+        self.block_after = block_after
+        self.block_rps = block_rps
+        self.block_duration = block_duration
+        self.n_requests = 0
+        self.n_blocks = 0
+        self._random = random.Random(seed)
+        self._recent = collections.deque()
+        self._blocked_until = None
+
+    def delay(self):
+        return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def _start_block(self, now):
+        self._blocked_until = now + self.block_duration
+        self.n_blocks += 1
+        print("Blocking for {:g}s after {} requests".format(self.block_duration, self.n_requests), file=sys.stderr)
+
+    def next(self):
+        now = time.monotonic()
+        self.n_requests += 1
+        self._recent.append(now)
+        while self._recent[0] < now - RATE_WINDOW:
+            self._recent.popleft()
+
+        if self._blocked_until is not None:
+            if now < self._blocked_until:
+                return 'blocked'
+            self._blocked_until = None
+            self._recent.clear()
+        if self.block_after is not None and self.n_requests == self.block_after + 1:
+            self._start_block(now)
+            return 'blocked'
+        if self.block_rps is not None and len(self._recent) > self.block_rps * RATE_WINDOW:
+            self._start_block(now)
+            return 'blocked'
+
+        if self.burst_every is not None and (self.n_requests - 1) % (self.burst_every + self.burst_length) >= self.burst_every:
+            return 'burst'
+        if self._random.random() < self.error_rate:
+            return 'error'
+        if self._random.random() < self.challenge_rate:
+            return 'challenge'
+        return None
+
+class ReplaySite(object):
+    def __init__(self, corpus_dir, faults, rows_per_day=120, cache=None):
+        self.faults = faults
+        self.rows_per_day = rows_per_day
+        self.stats = collections.Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._cache = cache
+        self._incident_pages = self._read(corpus_dir, 'incidents')
+        self._locations = [self._location(text) for text in self._incident_pages]
+        # Result rows are templates with the incident id, date and location cut out; the first page provides the
+        # surrounding document.
+        query_pages = self._read(corpus_dir, 'queries')
+        self._row_templates = [self._row_template(row)
+                               for page in query_pages for row in re.findall(r'<tr class="(?:odd|even)">.*?</tr>', page)]
+        self._query_page = query_pages[0].replace('{', '{{').replace('}', '}}')
+        self._query_page = re.sub(r'<tbody>.*</tbody>', '<tbody>\n{rows}\n</tbody>', self._query_page, flags=re.S)
+        self._query_page = re.sub(r'<ul class="pager">.*?</ul>', '{pager}', self._query_page, flags=re.S)
+        # Proxy sessions by id, each with the number of requests it's serving right now.
+        self._proxy_sessions = {}
+        self.max_session_concurrency = 0
+
+    @staticmethod
+    def _read(corpus_dir, kind):
+        pages = []
+        for fname in sorted(glob(os.path.join(corpus_dir, kind, '*.html'))):
+            with open(fname, encoding='utf-8') as file:
+                pages.append(file.read())
+        if not pages:
+            sys.exit("No {} pages in {}".format(kind, corpus_dir))
+        return pages
+
+    @staticmethod
+    def _row_template(row):
+        incident_id = re.search(r'/incident/(\d+)', row).group(1)
+        row = row.replace('{', '{{').replace('}', '}}').replace(incident_id, '{id}')
+        row = re.sub(r'^<tr class="\w+">', '<tr class="{parity}">', row)
+        # The columns after the id and date are the location, filled in from the incident page.
+        return re.sub(r'<td>\w+ \d+, \d{4}</td>(<td>[^<]*</td>){3}',
+                      '<td>{date}</td><td>{state}</td><td>{city}</td><td>{address}</td>', row, count=1)
+
+    @staticmethod
+    def _location(text):
+        # Stage 2 only accepts a page whose location matches its row, so rows list the incident page's.
+        address = re.search(r'<h3>[^<]*</h3>\s*<span>([^<]*)</span>', text).group(1)
+        city, state = re.search(r'<span>([^<,]+), ([^<,]+)</span>', text).groups()
+        return {'address': address, 'city': city, 'state': state}
+
+    def _cached(self, path):
+        if self._cache is None:
+            return None
+        return self._cache.get(GVA_SITE + path)
+
+    def incident_page(self, incident_id):
+        text = self._cached('/incident/{}'.format(incident_id))
+        if text is None:
+            text = self._incident_pages[incident_id % len(self._incident_pages)]
+        # Stage 2's browser path caches just the .region-content HTML.
+        if 'region-content' not in text:
+            text = INCIDENT_PAGE.format(text)
+        return 200, text
+
+    def query_page(self, window, page):
+        start, end = window
+        n_days = (end - start).days + 1
+        n_rows = max(0, n_days * self.rows_per_day)
+        n_pages = -(-n_rows // ROWS_PER_PAGE)
+
+        rows = []
+        for i in range(page * ROWS_PER_PAGE, min(n_rows, (page + 1) * ROWS_PER_PAGE)):
+            # Like the site, the newest incidents come first.
+            day = end - timedelta(days=i // self.rows_per_day)
+            incident_id = (day - FIRST_DAY).days * IDS_PER_DAY + i % self.rows_per_day
+            template = self._row_templates[incident_id % len(self._row_templates)]
+            location = self._locations[incident_id % len(self._incident_pages)]
+            rows.append(template.format(id=incident_id, parity='even' if i % 2 else 'odd', date='{:%B} {}, {}'.format(day, day.day, day.year), **location))
+        if not rows:
+            rows.append('<tr class="odd"><td colspan="11" class="empty message">{}</td></tr>'.format(MESSAGE_NO_INCIDENTS_AVAILABLE))
+
+        qid = '{}--{}'.format(quote('{d.month}/{d.day}/{d.year}'.format(d=start), safe=''),
+                              quote('{d.month}/{d.day}/{d.year}'.format(d=end), safe=''))
+        pager = ''
+        if n_pages > 1:
+            pager = ('<ul class="pager"><li class="pager-current first">{}</li>'
+                     '<li class="pager-last last"><a title="Go to last page" href="/query/{}?page={}">last »</a></li></ul>').format(
+                         page + 1, qid, n_pages - 1)
+        return 200, self._query_page.format(rows='\n'.join(rows), pager=pager)
+
+    async def serve(self, path, query):
+        # Returns (status, text) for a site path, after the configured delay and faults.
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.faults.delay())
+            fault = self.faults.next()
+            self.stats[fault or 'ok'] += 1
+            if fault == 'blocked':
+                return 403, BLOCKED_PAGE
+            if fault in ('burst', 'error'):
+                return (503 if fault == 'burst' else 500), '<html><body>Service unavailable</body></html>'
+            if fault == 'challenge':
+                return 503, CHALLENGE_PAGE
+
+            match = re.match(r'^/incident/(\d+)$', path)
+            if match:
+                return self.incident_page(int(match.group(1)))
+            match = re.match(r'^/query/([^/]+)--([^/]+)$', path)
+            if match:
+                try:
+                    window = tuple(datetime.strptime(unquote(part), '%m/%d/%Y').date() for part in match.groups())
+                except ValueError:
+                    return 404, '<html><body>Not found</body></html>'
+                return self.query_page(window, int(query.get('page', ['0'])[0]))
+            return 404, '<html><body>Not found</body></html>'
+        finally:
+            self.in_flight -= 1
+
+    # Routes
+
+    async def handle_page(self, request):
+        status, text = await self.serve(request.rel_url.raw_path, parse_qs(request.query_string))
+        return web.Response(status=status, text=text, content_type='text/html')
+
+    async def handle_form(self, request):
+        return web.Response(text=QUERY_FORM, content_type='text/html')
+
+    async def handle_proxy(self, request):
+        payload = json.loads(await request.text())
+        cmd = payload.get('cmd')
+        self.stats['proxy ' + str(cmd)] += 1
+        if cmd == 'sessions.create':
+            session_id = 'replay-{}'.format(self.stats['proxy sessions.create'])
+            self._proxy_sessions[session_id] = 0
+            return web.json_response({'status': 'ok', 'session': session_id})
+        if cmd == 'sessions.list':
+            return web.json_response({'status': 'ok', 'sessions': sorted(self._proxy_sessions)})
+        if cmd == 'sessions.destroy':
+            if self._proxy_sessions.pop(payload.get('session'), None) is None:
+                return web.json_response({'status': 'error', 'message': 'This session does not exist.'}, status=500)
+            return web.json_response({'status': 'ok'})
+        if cmd != 'request.get':
+            return web.json_response({'status': 'error', 'message': 'Unknown cmd {}'.format(cmd)}, status=500)
+
+        session_id = payload.get('session')
+        if session_id is not None and session_id not in self._proxy_sessions:
+            return web.json_response({'status': 'error', 'message': 'This session does not exist.'}, status=500)
+        if session_id is not None:
+            self._proxy_sessions[session_id] += 1
+            self.max_session_concurrency = max(self.max_session_concurrency, self._proxy_sessions[session_id])
+        try:
+            url = urlparse(payload['url'])
+            status, text = await self.serve(url.path, parse_qs(url.query))
+        finally:
+            if session_id in self._proxy_sessions:
+                self._proxy_sessions[session_id] -= 1
+        if status >= 500 or any(marker in text for marker in CHALLENGE_MARKERS):
+            # FlareSolverr reports origin errors and challenges it couldn't solve as failures of its own.
+            return web.json_response({'status': 'error', 'message': 'Error solving the challenge (HTTP {})'.format(status)}, status=500)
+        return web.json_response({'status': 'ok', 'solution': {'url': payload['url'], 'status': status, 'response': text}})
+
+    async def handle_stats(self, request):
+        return web.json_response({
+            'requests': dict(self.stats),
+            'site_requests': self.faults.n_requests,
+            'ip_blocks': self.faults.n_blocks,
+            'max_in_flight': self.max_in_flight,
+            'proxy_sessions': len(self._proxy_sessions),
+            'max_session_concurrency': self.max_session_concurrency,
+        })
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/query', self.handle_form)
+        app.router.add_get('/query/{qid}', self.handle_page)
+        app.router.add_get('/incident/{id}', self.handle_page)
+        app.router.add_post('/v1', self.handle_proxy)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+def main():
+    args = parse_args()
+    faults = Faults(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                    burst_every=args.burst_every, burst_length=args.burst_length,
+                    challenge_rate=args.challenge_rate, block_after=args.block_after,
+                    block_rps=args.block_rps, block_duration=args.block_duration, seed=args.seed)
+    cache = PageCache(args.cache_dir) if args.cache_dir is not None else None
+    site = ReplaySite(args.corpus_dir, faults, rows_per_day=args.rows_per_day, cache=cache)
+    web.run_app(site.app(), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import asyncio
+import heapq
+import itertools
+import random
+import sys
+import time
+
+from urllib.parse import urlparse
+
+from metrics import REGISTRY
+
+# Decides when stage 2 may send a request, and when a failed one is tried again. Every fetch goes through
+# one RequestScheduler:
+#
+# - Each host has a circuit breaker. After `failure_threshold` failures in a row the breaker opens and no
+#   requests go to that host for `reset_timeout` seconds. Then a single probe request is let through
+#   (half-open): if it succeeds the breaker closes, otherwise it opens again.
+# - An IP block opens the breaker too, but for `probe_interval` seconds, so every worker pauses until a
+#   probe gets through unblocked. If the host is still blocked after `max_blocked` seconds, record_block()
+#   returns False and the caller gives up.
+# - Rows whose fetch failed go on a RetryQueue with jittered exponential backoff, up to `max_attempts`
+#   fetches in all, instead of being dropped.
+#
+# It's only used from the event loop thread, so it needs no locking.
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+def _host(url):
+    return urlparse(url).netloc
+
+class _Breaker(object):
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self.blocked_since = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        # Wakes everything waiting on this breaker; they re-check the state.
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def open(self, timeout):
+        self.state = OPEN
+        self.opened_until = time.monotonic() + timeout
+        self.notify()
+
+class RequestScheduler(object):
+    def __init__(self, max_attempts=5, backoff_base=2.0, backoff_cap=120.0, failure_threshold=5,
+                 reset_timeout=30.0, probe_interval=300.0, max_blocked=None):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+        self.max_blocked = max_blocked
+        self.n_retries = 0
+        self.n_gave_up = 0
+        self.n_blocks = 0
+        self._breakers = {}
+
+    def _breaker(self, url):
+        host = _host(url)
+        if host not in self._breakers:
+            self._breakers[host] = _Breaker()
+        return self._breakers[host]
+
+    def backoff(self, attempt):
+        # "Full jitter": uniform between 0 and the capped exponential, so retries from many rows spread out.
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)))
+
+    async def acquire(self, url):
+        # Waits until a request to `url`'s host may be sent.
+        breaker = self._breaker(url)
+        while True:
+            if breaker.state == CLOSED:
+                return
+            now = time.monotonic()
+            if now >= breaker.opened_until:
+                # The caller is the probe; everyone else keeps waiting. If the probe never reports back
+                # (e.g. it was cancelled), another one is let through after `reset_timeout`.
+                breaker.state = HALF_OPEN
+                breaker.opened_until = now + self.reset_timeout
+                return
+            try:
+                await asyncio.wait_for(breaker.changed.wait(), breaker.opened_until - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def record_success(self, url):
+        breaker = self._breaker(url)
+        if breaker.blocked_since is not None:
+            print("{} is reachable again after {:.1f}s, resuming".format(
+                _host(url), time.monotonic() - breaker.blocked_since), file=sys.stderr)
+        breaker.failures = 0
+        breaker.blocked_since = None
+        if breaker.state != CLOSED:
+            breaker.state = CLOSED
+            breaker.notify()
+
+    def record_failure(self, url):
+        breaker = self._breaker(url)
+        breaker.failures += 1
+        if breaker.state == HALF_OPEN or (breaker.state == CLOSED and breaker.failures >= self.failure_threshold):
+            # A probe that fails for some other reason while we're blocked doesn't end the block.
+            timeout = self.probe_interval if breaker.blocked_since is not None else self.reset_timeout
+            print("{} failed {} times in a row, pausing requests to it for {:g}s".format(
+                _host(url), breaker.failures, timeout), file=sys.stderr)
+            REGISTRY.inc('scheduler_breaker_opens_total')
+            breaker.open(timeout)
+
+    def record_block(self, url):
+        # Returns False once the host has been blocking us for longer than `max_blocked` seconds.
+        breaker = self._breaker(url)
+        now = time.monotonic()
+        if breaker.blocked_since is None:
+            breaker.blocked_since = now
+            self.n_blocks += 1
+            REGISTRY.inc('scheduler_ip_blocks_total')
+        elif self.max_blocked is not None and now - breaker.blocked_since > self.max_blocked:
+            return False
+        print("IP blocked by {}, pausing all requests and probing again in {:g}s".format(
+            _host(url), self.probe_interval), file=sys.stderr)
+        breaker.open(self.probe_interval)
+        return True
+
+class RetryQueue(object):
+    # Items become available again `delay` seconds after they're pushed, earliest first.
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, delay):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), item))
+
+    def pop_due(self):
+        if self._heap and self._heap[0][0] <= time.monotonic():
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def next_due_in(self):
+        return max(0.0, self._heap[0][0] - time.monotonic()) if self._heap else None
+
+def add_scheduler_args(parser):
+    parser.add_argument(
+        '--max-attempts',
+        metavar='NUM',
+        help="fetch a page at most this many times before leaving its row for a later run",
+        action='store',
+        dest='max_attempts',
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        '--probe-interval',
+        metavar='SECONDS',
+        help="while the IP is blocked, how long to wait between probe requests",
+        action='store',
+        dest='probe_interval',
+        type=float,
+        default=300.0,
+    )
+    parser.add_argument(
+        '--max-blocked',
+        metavar='SECONDS',
+        help="give up if the IP is still blocked after this long (default: keep probing)",
+        action='store',
+        dest='max_blocked',
+        type=float,
+        default=None,
+    )
+
+def open_scheduler(args):
+    return RequestScheduler(max_attempts=args.max_attempts,
+                            probe_interval=args.probe_interval,
+                            max_blocked=args.max_blocked)
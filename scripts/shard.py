@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+# sharding: splitting stage 1 files into work units and handing them out to stage 2 workers through lease files
+
+import csv
+import json
+import os
+import os.path
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+# `shard.py plan` splits stage 1 files into units of --rows rows under DIR, which can live on a filesystem
+# shared by several machines. `shard.py work` (or `shard.py run`, for N local workers) then repeatedly
+# leases a unit, runs stage2.py on it and marks it done:
+#
+#   DIR/units.json             every unit, its input and output files and how many rows it has
+#   DIR/units/NAME.csv         stage 1 rows of one unit
+#   DIR/output/stage2.NAME.csv stage 2 output of one unit; stage 3 can be run in DIR/output
+#   DIR/leases/NAME/N.json     who is working on a unit, renewed every --heartbeat seconds
+#   DIR/done/NAME.json         written once a unit's output has a row for every input row
+#
+# Leases are versioned: every change to a unit's lease (taking it, renewing it, releasing it) creates the
+# next version, N+1, with link(), which fails if that file already exists. Of several workers changing the
+# same version only one succeeds, and the newest version stays in place until a newer one replaces it, so
+# a unit that is leased always looks leased. Older versions are removed by whoever wrote the newer one.
+#
+# If a lease's heartbeat is older than --ttl, the worker is assumed dead and another one takes the unit
+# over. Because stage 2 resumes from its output file, the new worker only fetches the rows that are still
+# missing. A unit whose stage 2 run ends without a row for every input row, or stalls for --stall-timeout,
+# is released for a retry, up to --max-attempts times.
+#
+# Expiry compares the heartbeat time written by one machine with the clock of another, so clocks should
+# be roughly in sync, and --ttl should be several heartbeats long.
+
+UNITS_FNAME = 'units.json'
+UNIT_DIRNAME = 'units'
+OUTPUT_DIRNAME = 'output'
+LEASE_DIRNAME = 'leases'
+DONE_DIRNAME = 'done'
+
+STAGE2_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stage2.py')
+
+def add_queue_args(parser):
+    parser.add_argument(
+        '--ttl',
+        metavar='SECONDS',
+        help="a lease whose heartbeat is older than this is considered abandoned and may be taken over",
+        action='store',
+        dest='ttl',
+        type=float,
+        default=300.0,
+    )
+    parser.add_argument(
+        '--heartbeat',
+        metavar='SECONDS',
+        help="how often a worker renews its lease",
+        action='store',
+        dest='heartbeat',
+        type=float,
+        default=30.0,
+    )
+    parser.add_argument(
+        '--stall-timeout',
+        metavar='SECONDS',
+        help="stop stage 2 and release the unit for a retry if its output gains no rows for this long",
+        action='store',
+        dest='stall_timeout',
+        type=float,
+        default=900.0,
+    )
+    parser.add_argument(
+        '--max-attempts',
+        metavar='NUM',
+        help="stop retrying a unit after this many stage 2 runs that didn't complete it",
+        action='store',
+        dest='max_attempts',
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        '--poll',
+        metavar='SECONDS',
+        help="how long an idle worker waits before looking for work again while other workers hold leases",
+        action='store',
+        dest='poll',
+        type=float,
+        default=30.0,
+    )
+    parser.add_argument(
+        '--stage2',
+        metavar='PATH',
+        help="stage 2 script to run on each unit",
+        action='store',
+        dest='stage2_path',
+        default=STAGE2_PATH,
+    )
+
+def parse_args():
+    # Anything after '--' is passed on to stage2.py, e.g. `shard.py run DIR -p 4 -- -f proxy --cache pages`.
+    argv = sys.argv[1:]
+    stage2_args = []
+    if '--' in argv:
+        argv, stage2_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+
+    parser = ArgumentParser(usage="%(prog)s {plan,work,run,status} ... [-- STAGE2_ARGS]")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help="split stage 1 files into work units")
+    plan_parser.add_argument('shard_dir', metavar='DIR', help="directory holding the units, leases and output")
+    plan_parser.add_argument('input_fnames', metavar='INPUT', nargs='+', help="stage 1 files to split")
+    plan_parser.add_argument(
+        '-n', '--rows',
+        metavar='NUM',
+        help="number of rows per work unit",
+        action='store',
+        dest='rows_per_unit',
+        type=int,
+        default=1500,
+    )
+
+    work_parser = subparsers.add_parser('work', help="lease units and run stage 2 on them until all are settled")
+    work_parser.add_argument('shard_dir', metavar='DIR', help="directory created by `plan`")
+    work_parser.add_argument(
+        '--worker-id',
+        metavar='ID',
+        help="name recorded in leases (default: HOST-PID)",
+        action='store',
+        dest='worker_id',
+        default=None,
+    )
+    add_queue_args(work_parser)
+
+    run_parser = subparsers.add_parser('run', help="run several workers on this machine")
+    run_parser.add_argument('shard_dir', metavar='DIR', help="directory created by `plan`")
+    run_parser.add_argument(
+        '-p', '--processes',
+        metavar='NUM',
+        help="number of worker processes",
+        action='store',
+        dest='processes',
+        type=int,
+        default=2,
+    )
+    add_queue_args(run_parser)
+
+    status_parser = subparsers.add_parser('status', help="show the state and throughput of every unit")
+    status_parser.add_argument('shard_dir', metavar='DIR', help="directory created by `plan`")
+    status_parser.add_argument(
+        '--ttl',
+        metavar='SECONDS',
+        help="report leases with heartbeats older than this as expired",
+        action='store',
+        dest='ttl',
+        type=float,
+        default=300.0,
+    )
+
+    args = parser.parse_args(argv)
+    args.stage2_args = stage2_args
+    return args
+
+def _read_json(path):
+    # Returns None if the file doesn't exist or is still being written.
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_tmp_json(path, obj):
+    # Writes `obj` next to `path` and returns the temporary file's path.
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    os.fchmod(fd, 0o644)
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        json.dump(obj, file)
+    return tmp_path
+
+def _write_json(path, obj):
+    os.replace(_write_tmp_json(path, obj), path)
+
+def _create_json(path, obj):
+    # Fails with FileExistsError if `path` exists, atomically, which is what makes leases exclusive. The file
+    # is written first and then linked into place, so it's never seen half-written.
+    tmp_path = _write_tmp_json(path, obj)
+    try:
+        os.link(tmp_path, path)
+    finally:
+        os.remove(tmp_path)
+
+def count_rows(fname):
+    # Counts CSV records rather than lines, since notes may contain newlines.
+    try:
+        with open(fname, encoding='utf-8', newline='') as file:
+            return max(0, sum(1 for _ in csv.reader(file)) - 1)
+    except FileNotFoundError:
+        return 0
+
+def _unit_name(input_fname):
+    # e.g. 'stage1.01.2014.csv' -> '01.2014', so outputs are named like stage 2 files usually are.
+    name = os.path.splitext(os.path.basename(input_fname))[0]
+    return name[len('stage1.'):] if name.startswith('stage1.') else name
+
+def plan(shard_dir, input_fnames, rows_per_unit):
+    units_fname = os.path.join(shard_dir, UNITS_FNAME)
+    if os.path.exists(units_fname):
+        sys.exit("{} already exists; use a new directory to re-plan".format(units_fname))
+    for dirname in [UNIT_DIRNAME, OUTPUT_DIRNAME, LEASE_DIRNAME, DONE_DIRNAME]:
+        os.makedirs(os.path.join(shard_dir, dirname), exist_ok=True)
+
+    units = {}
+    for input_fname in input_fnames:
+        # Rows are copied as they are, so units read exactly like the file they came from.
+        with open(input_fname, encoding='utf-8', newline='') as input_file:
+            reader = csv.reader(input_file)
+            header = next(reader)
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if len(rows) == rows_per_unit:
+                    _write_unit(shard_dir, units, input_fname, len(units), header, rows)
+                    rows = []
+            if rows:
+                _write_unit(shard_dir, units, input_fname, len(units), header, rows)
+
+    _write_json(units_fname, units)
+    print("Planned {} units of up to {} rows".format(len(units), rows_per_unit))
+
+def _write_unit(shard_dir, units, input_fname, unitno, header, rows):
+    name = '{}.{:04d}'.format(_unit_name(input_fname), unitno)
+    unit_fname = os.path.join(UNIT_DIRNAME, name + '.csv')
+    with open(os.path.join(shard_dir, unit_fname), 'w', encoding='utf-8', newline='') as unit_file:
+        writer = csv.writer(unit_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+    units[name] = {
+        'input': unit_fname,
+        'output': os.path.join(OUTPUT_DIRNAME, 'stage2.{}.csv'.format(name)),
+        'rows': len(rows),
+    }
+
+class ShardQueue(object):
+    def __init__(self, shard_dir, worker_id=None, ttl=300.0, max_attempts=3):
+        self.shard_dir = shard_dir
+        self.worker_id = worker_id or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.units = _read_json(os.path.join(shard_dir, UNITS_FNAME))
+        if self.units is None:
+            raise ValueError("{} has no {}; run `shard.py plan` first".format(shard_dir, UNITS_FNAME))
+
+    def path(self, name, key):
+        return os.path.join(self.shard_dir, self.units[name][key])
+
+    def _lease_dir(self, name):
+        return os.path.join(self.shard_dir, LEASE_DIRNAME, name)
+
+    def _lease_path(self, name, version):
+        return os.path.join(self._lease_dir(name), '{}.json'.format(version))
+
+    def _done_path(self, name):
+        return os.path.join(self.shard_dir, DONE_DIRNAME, name + '.json')
+
+    def _versions(self, name):
+        try:
+            fnames = os.listdir(self._lease_dir(name))
+        except FileNotFoundError:
+            return []
+        return sorted(int(fname[:-len('.json')]) for fname in fnames
+                      if fname.endswith('.json') and fname[:-len('.json')].isdigit())
+
+    def lease(self, name):
+        # The newest version of the unit's lease, or None if it has never been leased.
+        while True:
+            versions = self._versions(name)
+            if not versions:
+                return None
+            lease = _read_json(self._lease_path(name, versions[-1]))
+            if lease is not None:
+                return lease
+            # Replaced by a newer version and removed since we listed the directory.
+
+    def done(self, name):
+        return _read_json(self._done_path(name))
+
+    def is_expired(self, lease):
+        return time.time() - lease['heartbeat_at'] > self.ttl
+
+    def is_failed(self, lease):
+        return lease is not None and lease.get('released') and lease['attempts'] >= self.max_attempts
+
+    def is_settled(self):
+        # True once every unit is either done or out of attempts.
+        return all(self.done(name) is not None or self.is_failed(self.lease(name)) for name in self.units)
+
+    def _new_lease(self, name, version, attempts):
+        now = time.time()
+        rows = count_rows(self.path(name, 'output'))
+        return {
+            'version': version,
+            'worker': self.worker_id,
+            'acquired_at': now,
+            'heartbeat_at': now,
+            'attempts': attempts,
+            'start_rows': rows,
+            'rows': rows,
+        }
+
+    def _put(self, name, lease):
+        # Writes `lease` as the next version and returns True, or returns False if another worker wrote that
+        # version first. A version can also be free because it was removed after a newer one was written;
+        # that lease was already out of date, so it's only kept if it's still the newest.
+        version = lease['version']
+        path = self._lease_path(name, version)
+        try:
+            _create_json(path, lease)
+        except FileExistsError:
+            return False
+        versions = self._versions(name)
+        if versions[-1] != version:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return False
+        for old_version in versions[:-1]:
+            try:
+                os.remove(self._lease_path(name, old_version))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def try_acquire(self, name):
+        # Returns the new lease, or None if the unit is done, out of attempts or held by a live worker.
+        if self.done(name) is not None:
+            return None
+        os.makedirs(self._lease_dir(name), exist_ok=True)
+        previous = self.lease(name)
+        if previous is None:
+            lease = self._new_lease(name, version=1, attempts=1)
+        elif previous.get('finished_at'):
+            # Its worker stopped between finishing the unit and writing the done file.
+            _write_json(self._done_path(name), previous)
+            return None
+        else:
+            if previous.get('released'):
+                if self.is_failed(previous):
+                    return None
+            elif not self.is_expired(previous):
+                return None
+            lease = self._new_lease(name, version=previous['version'] + 1, attempts=previous['attempts'] + 1)
+        return lease if self._put(name, lease) else None
+
+    def acquire_next(self):
+        for name in sorted(self.units):
+            lease = self.try_acquire(name)
+            if lease is not None:
+                return name, lease
+        return None, None
+
+    def _update(self, name, lease, **changes):
+        # Writes the next version of our lease with `changes` applied. Returns False, leaving `lease` as it
+        # was, if a worker took the unit over since we last wrote it.
+        new_lease = dict(lease, version=lease['version'] + 1, **changes)
+        if not self._put(name, new_lease):
+            return False
+        lease.update(new_lease)
+        return True
+
+    def heartbeat(self, name, lease):
+        # Renews `lease` and returns True, or returns False if another worker has taken the unit over.
+        return self._update(name, lease, heartbeat_at=time.time(), rows=count_rows(self.path(name, 'output')))
+
+    def release(self, name, lease):
+        # Marks the unit done if its output has a row for every input row, otherwise leaves it for a retry.
+        rows = count_rows(self.path(name, 'output'))
+        now = time.time()
+        if rows >= self.units[name]['rows']:
+            if not self._update(name, lease, heartbeat_at=now, rows=rows, finished_at=now):
+                return False
+            _write_json(self._done_path(name), lease)
+            return True
+        self._update(name, lease, heartbeat_at=now, rows=rows, released=True)
+        return False
+
+def run_unit(queue, name, lease, args):
+    command = [sys.executable, args.stage2_path, queue.path(name, 'input'), queue.path(name, 'output')] + args.stage2_args
+    print("{}: {} (attempt {})".format(queue.worker_id, name, lease['attempts']), file=sys.stderr)
+    process = subprocess.Popen(command)
+    progress_rows, progress_at = lease['rows'], time.time()
+    while True:
+        try:
+            process.wait(timeout=args.heartbeat)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+        if not queue.heartbeat(name, lease):
+            # Someone else owns the unit now; two stage 2 processes must not append to the same output.
+            print("{}: lost the lease on {}, stopping".format(queue.worker_id, name), file=sys.stderr)
+            process.terminate()
+            process.wait()
+            return
+        if lease['rows'] > progress_rows:
+            progress_rows, progress_at = lease['rows'], time.time()
+        elif time.time() - progress_at > args.stall_timeout:
+            print("{}: {} stalled at {} rows, stopping".format(queue.worker_id, name, progress_rows), file=sys.stderr)
+            process.terminate()
+            process.wait()
+            break
+    if not queue.release(name, lease):
+        print("{}: {} incomplete after stage 2 exited with {}".format(queue.worker_id, name, process.returncode),
+              file=sys.stderr)
+
+def work(args):
+    queue = ShardQueue(args.shard_dir, worker_id=args.worker_id, ttl=args.ttl, max_attempts=args.max_attempts)
+    while True:
+        name, lease = queue.acquire_next()
+        if name is not None:
+            run_unit(queue, name, lease, args)
+        elif queue.is_settled():
+            break
+        else:
+            # Everything left is leased; keep watching in case one of those workers dies.
+            time.sleep(args.poll)
+
+def run(args):
+    # Runs `work` in several local processes, passing the scheduling options through.
+    options = ['--ttl', str(args.ttl), '--heartbeat', str(args.heartbeat), '--stall-timeout', str(args.stall_timeout),
+               '--max-attempts', str(args.max_attempts), '--poll', str(args.poll), '--stage2', args.stage2_path]
+    host = socket.gethostname()
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'work', args.shard_dir,
+                                 '--worker-id', '{}-{}-{}'.format(host, os.getpid(), i)] + options + ['--'] + args.stage2_args)
+               for i in range(args.processes)]
+    for worker in workers:
+        worker.wait()
+    status(args)
+
+def _rate(rows, start_rows, start, end):
+    return (rows - start_rows) / (end - start) if end > start else 0.0
+
+def status(args):
+    queue = ShardQueue(args.shard_dir, ttl=args.ttl)
+    counts = {}
+    print("{:<24} {:<8} {:>13} {:>8} {:>9}  {}".format('unit', 'state', 'rows', 'rows/s', 'attempts', 'worker'))
+    for name in sorted(queue.units):
+        expected = queue.units[name]['rows']
+        done, lease = queue.done(name), queue.lease(name)
+        info = done or lease
+        if done is not None:
+            state, rate = 'done', _rate(done['rows'], done['start_rows'], done['acquired_at'], done['finished_at'])
+        elif lease is None:
+            state, rate = 'pending', None
+        elif lease.get('released'):
+            state, rate = 'failed' if queue.is_failed(lease) else 'retry', None
+        else:
+            state = 'expired' if queue.is_expired(lease) else 'leased'
+            rate = _rate(lease['rows'], lease['start_rows'], lease['acquired_at'], lease['heartbeat_at'])
+        counts[state] = counts.get(state, 0) + 1
+
+        rows = info['rows'] if info else count_rows(queue.path(name, 'output'))
+        print("{:<24} {:<8} {:>6}/{:<6} {:>8} {:>9}  {}".format(
+            name, state, rows, expected, '' if rate is None else '{:.2f}'.format(rate),
+            info['attempts'] if info else 0, info['worker'] if info else ''))
+    print(', '.join('{} {}'.format(n, state) for state, n in sorted(counts.items())))
+
+def main():
+    args = parse_args()
+    if args.command == 'plan':
+        plan(args.shard_dir, args.input_fnames, args.rows_per_unit)
+    elif args.command == 'work':
+        work(args)
+    elif args.command == 'run':
+        run(args)
+    elif args.command == 'status':
+        status(args)
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,11 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from urllib.parse import parse_qs, urlparse
 
-from stage1_serializer import Stage1Serializer
+from incident_store import add_store_args, open_store
+from metrics import REGISTRY, add_metrics_args, start_metrics
+from page_cache import add_cache_args, open_cache
+from stage1_planner import WindowPlanner
+from stage1_serializer import GVA_DOMAIN, Stage1Serializer
 
 import random  
 import time    
@@ -32,6 +36,9 @@ DATE_FORMAT = '%#m/%#d/%Y' if platform.system() == 'Windows' else '%-m/%-d/%Y'
 
 MESSAGE_NO_INCIDENTS_AVAILABLE = 'There are currently no incidents available.'
 
+# Past this many pages of results, a query is assumed to have been truncated and is split in two.
+MAX_PAGES = 20
+
 def random_sleep(min_sec=1.0, max_sec=3.0):
     """Sleep for a random amount of time between min_sec and max_sec."""  
     duration = random.uniform(min_sec, max_sec) 
@@ -56,22 +63,36 @@ def parse_args():
         parser.add_argument('output_file', metavar='OUTFILE', help="set output file", action='store')
 
     parser.add_argument('-d', '--debug', help="show debug information", action='store_const', dest='log_level', const=log.DEBUG, default=log.WARNING)
+    parser.add_argument('-p', '--pages', metavar='NUM', help="number of browser pages that scrape query results concurrently", action='store', dest='n_browser_pages', type=int, default=1)
+    parser.add_argument('-w', '--window', metavar='DAYS', help="query this many days at a time, splitting windows in half whenever they return more than --max-pages pages", action='store', dest='window', type=int, default=1)
+    parser.add_argument('--max-pages', metavar='NUM', help="most result pages a single query may return before it is split", action='store', dest='max_pages', type=int, default=MAX_PAGES)
+    parser.add_argument('--site', metavar='URL', help="query this site instead of gunviolencearchive.org, e.g. a local replay_server.py", action='store', dest='site', default=GVA_DOMAIN)
+    parser.add_argument('--plan', metavar='FILE', help="file recording the chosen date windows, reused by later runs (default: OUTFILE.windows.json)", action='store', dest='plan_file', default=None)
+    add_cache_args(parser)
+    add_store_args(parser)
+    add_metrics_args(parser)
 
     args = parser.parse_args()
+    if args.cache_only:
+        # Each window is searched live in the browser, and the result page URLs that come back are specific to
+        # that search, so there's nothing stable to replay them by.
+        parser.error("--cache-only is only supported by stage 2")
     if targets_specific_month:
         month, year = map(int, parts)
         end_day = monthrange(year, month)[1]
         args.start_date = '{}-01-{}'.format(month, year)
         args.end_date = '{}-{}-{}'.format(month, end_day, year)
         args.output_file = 'stage1.{:02d}.{:04d}.csv'.format(month, year)
+    if args.plan_file is None:
+        args.plan_file = args.output_file + '.windows.json'
     return args
 
-def query(driver, start_date, end_date):
+def query(driver, start_date, end_date, site=GVA_DOMAIN):
     print("Querying incidents between {:%m/%d/%Y} and {:%m/%d/%Y}".format(start_date, end_date))
     random_sleep()  
     random_mouse_move()  
 
-    driver.get('http://www.gunviolencearchive.org/query')
+    driver.get(site + '/query')
     random_sleep()  
 
     filter_dropdown_trigger = driver.find_element_or_wait(By.CSS_SELECTOR, '.filter-dropdown-trigger')
@@ -125,23 +146,41 @@ async def main():
     options = webdriver.ChromeOptions()
     driver = webdriver.Chrome(options=options)
 
-    step = timedelta(days=1)
     global_start, global_end = dateparser.parse(args.start_date), dateparser.parse(args.end_date)
-    start, end = global_start, global_start + step - timedelta(days=1)
+    planner = WindowPlanner(partial(query, driver, site=args.site), max_pages=args.max_pages, window=args.window, plan_fname=args.plan_file)
+    windows = planner.plan(global_start, global_end)
 
-    async with Stage1Serializer(output_fname=args.output_file) as serializer:
+    metrics = start_metrics(args)
+    cache = open_cache(args)
+    store = open_store(args)
+    async with Stage1Serializer(output_fname=args.output_file, cache=cache, n_browser_pages=args.n_browser_pages, store=store) as serializer:
         serializer.write_header()
 
-        while start <= global_end:
-            query_url, n_pages = query(driver, start, end)
-
-            if n_pages > 0:
-                serializer.write_batch(query_url, n_pages)
-
-            start = end + timedelta(days=1)
-            end = min(global_end, end + step)
-
-        await serializer.flush_writes()
+        # Query on a helper thread while the serializer scrapes result pages from earlier queries.
+        loop = asyncio.get_event_loop()
+        writes = asyncio.ensure_future(serializer.stream_writes())
+        try:
+            while not writes.done():
+                window = await loop.run_in_executor(None, next, windows, None)
+                if window is None:
+                    break
+                _, _, query_url, n_pages = window
+
+                if n_pages > 0:
+                    serializer.stream_batch(query_url, n_pages)
+        finally:
+            serializer.end_stream()
+            await writes
+        print("Ran {} queries".format(planner.n_queries))
+        REGISTRY.set('stage1_queries', planner.n_queries)
+
+    if cache is not None:
+        print("Page cache: {} hits, {} misses".format(cache.hits, cache.misses))
+        cache.close()
+    if store is not None:
+        store.close()
+    if metrics is not None:
+        metrics.close()
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
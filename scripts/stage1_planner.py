@@ -0,0 +1,75 @@
+import json
+import os.path
+import sys
+
+from datetime import datetime, timedelta
+
+# Chooses the date windows stage 1 queries. Windows start out `window` days wide and are bisected only
+# when the query reports more result pages than `max_pages`, past which the site truncates results.
+# Sparse periods therefore take one query per window rather than one per day.
+#
+# The windows that were finally used are saved to `plan_fname`, and a re-run over the same dates starts
+# from them instead of from the wide windows, so the bisection doesn't have to be repeated.
+
+DATE_FORMAT = '%Y-%m-%d'
+
+def _days(start, end):
+    return (end - start).days + 1
+
+class WindowPlanner(object):
+    def __init__(self, query, max_pages, window=1, plan_fname=None):
+        self._query = query
+        self._max_pages = max_pages
+        self._window = timedelta(days=window)
+        self._plan_fname = plan_fname
+        self._saved = self._load()
+        self.n_queries = 0
+
+    def _load(self):
+        if self._plan_fname is None or not os.path.isfile(self._plan_fname):
+            return []
+        with open(self._plan_fname, encoding='utf-8') as file:
+            return [tuple(datetime.strptime(d, DATE_FORMAT) for d in window) for window in json.load(file)]
+
+    def _save(self, windows):
+        if self._plan_fname is None:
+            return
+        with open(self._plan_fname, 'w', encoding='utf-8') as file:
+            json.dump([[d.strftime(DATE_FORMAT) for d in window] for window in windows], file, indent=1)
+
+    def _initial_windows(self, global_start, global_end):
+        saved = [(start, end) for start, end in self._saved if global_start <= start and end <= global_end]
+        if saved and saved[0][0] == global_start and saved[-1][1] == global_end and \
+           all(prev[1] + timedelta(days=1) == cur[0] for prev, cur in zip(saved, saved[1:])):
+            return saved
+
+        windows = []
+        start = global_start
+        while start <= global_end:
+            end = min(global_end, start + self._window - timedelta(days=1))
+            windows.append((start, end))
+            start = end + timedelta(days=1)
+        return windows
+
+    def plan(self, global_start, global_end):
+        # Yields (start, end, query_url, n_pages) for consecutive windows covering [global_start, global_end].
+        pending = list(reversed(self._initial_windows(global_start, global_end)))
+        chosen = []
+        while pending:
+            start, end = pending.pop()
+            query_url, n_pages = self._query(start, end)
+            self.n_queries += 1
+
+            if n_pages > self._max_pages:
+                n_days = _days(start, end)
+                if n_days > 1:
+                    middle = start + timedelta(days=n_days // 2 - 1)
+                    pending.append((middle + timedelta(days=1), end))
+                    pending.append((start, middle))
+                    continue
+                print("WARNING: {:%m/%d/%Y} alone has {} pages of results, more than --max-pages={}".format(
+                    start, n_pages, self._max_pages), file=sys.stderr)
+
+            chosen.append((start, end))
+            self._save(chosen + list(reversed(pending)))
+            yield start, end, query_url, n_pages
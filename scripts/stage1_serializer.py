@@ -1,16 +1,83 @@
 import asyncio
 import csv
 import random  
+import re
 import time  
-from bs4 import BeautifulSoup
+from lxml import etree
 from playwright.async_api import async_playwright
 
+from metrics import REGISTRY
+
 GVA_DOMAIN = 'http://www.gunviolencearchive.org'
 
+COLUMNS = [
+    'date',
+    'state',
+    'city_or_county',
+    'address',
+    'n_killed',
+    'n_injured',
+    'n_suspects_killed',
+    'n_suspects_injured',
+    'n_suspects_arrested',
+    'incident_url',
+    'source_url'
+]
+
+# The results table has 11 columns: incident ID, date, state, city or county, address, victims killed and
+# injured, suspects killed, injured and arrested, and the operations cell with the "View Incident" and
+# (optional) "View Source" links.
+N_COLUMNS = 11
+
+_RESULTS_TABLE = re.compile(r'<table\b[^>]*\bclass="[^"]*\bresponsive\b')
+# Plain etree elements; lxml.html's element classes make every element access several times slower.
+_HTML_PARSER = etree.HTMLParser()
+
+def _result_trs(text):
+    # The rows of the results table, as lxml elements. Only the table is parsed: it's cut out of the page
+    # text first, so the rest of the document (most of it) is never tokenized.
+    match = _RESULTS_TABLE.search(text)
+    if match is None:
+        return []
+    end = text.find('</table>', match.start())
+    end = len(text) if end == -1 else end + len('</table>')
+    root = etree.fromstring(text[match.start():end], _HTML_PARSER)
+    # Rows are matched anywhere in the table: unlike html5lib, lxml doesn't add a <tbody> that isn't in the
+    # markup. Header rows only have th cells, and a query without results has a single row whose only cell
+    # says so; a table without either has a layout we don't know.
+    trs = root.xpath('.//tr[td]')
+    if not trs:
+        print("Results table has no rows with td cells")
+    return [tr for tr in trs if len(tr.findall('td')) != 1]
+
+def _get_row(tr):
+    # Returns the row for csv.writer; a row that doesn't have the expected layout raises ValueError.
+    tds = tr.findall('td')
+    if len(tds) != N_COLUMNS:
+        raise ValueError(f"Expected {N_COLUMNS} td cells, got {len(tds)}")
+
+    # Same as bs4's get_text(strip=True); most cells are a single piece of text.
+    texts = [td.text.strip() if td.text is not None and not len(td) else ''.join(s.strip() for s in td.itertext())
+             for td in tds[:10]]
+    try:
+        counts = [int(t or 0) for t in texts[5:10]]
+    except ValueError as parse_error:
+        raise ValueError(f"Error parsing text fields: {parse_error}")
+
+    incident_url = source_url = ''
+    for a in tds[10].iter('a'):
+        label = ''.join(a.itertext())
+        if not incident_url and 'Incident' in label:
+            incident_url = GVA_DOMAIN + a.get('href', '')
+        elif not source_url and 'Source' in label:
+            source_url = a.get('href', '')
+    return (texts[1], texts[2], texts[3], texts[4], *counts, incident_url, source_url)
+
+# The bs4 version of _get_row(), run on rows of a BeautifulSoup tree; kept for comparison (see bench_suite.py).
 def _get_info(tr):
     tds = tr.find_all('td')
-    if len(tds) < 8:
-        raise ValueError(f"Expected 8 td cells, got {len(tds)}")
+    if len(tds) < N_COLUMNS:
+        raise ValueError(f"Expected {N_COLUMNS} td cells, got {len(tds)}")
 
     def get_text(td):
         return td.get_text(strip=True)
@@ -41,10 +108,14 @@ def _get_info(tr):
     return date, state, city_or_county, address, n_killed, n_injured, n_suspects_killed, n_suspects_injured, n_suspects_arrested, incident_url, source_url
 
 class Stage1Serializer:
-    def __init__(self, output_fname, encoding='utf-8'):
+    def __init__(self, output_fname, encoding='utf-8', cache=None, n_browser_pages=1, store=None):
         self._output_fname = output_fname
         self._encoding = encoding
         self._page_urls = []
+        self._stream = asyncio.Queue()
+        self._cache = cache
+        self._n_browser_pages = n_browser_pages
+        self._store = store
 
     async def __aenter__(self):
         self._output_file = open(self._output_fname, 'w', encoding=self._encoding, newline='')
@@ -59,63 +130,133 @@ class Stage1Serializer:
             "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X)",
             "Mozilla/5.0 (iPad; CPU OS 13_2 like Mac OS X)"
         ]
-        ua = random.choice(user_agents)
         self._browser = await self._playwright.chromium.launch(headless=True)
-        self._context = await self._browser.new_context(user_agent=ua)
-        self._page = await self._context.new_page()
+        # Each page in the pool gets its own context, so they don't share cookies or a user agent.
+        self._contexts = []
+        self._pages = []
+        for _ in range(self._n_browser_pages):
+            context = await self._browser.new_context(user_agent=random.choice(user_agents))
+            self._contexts.append(context)
+            self._pages.append(await context.new_page())
         return self
 
     async def __aexit__(self, type, value, tb):
-        await self._page.close()
-        await self._context.close()
+        for page, context in zip(self._pages, self._contexts):
+            await page.close()
+            await context.close()
         await self._browser.close()
         await self._playwright.stop()
         self._output_file.close()
 
-    async def _gettext(self, url):
+    async def _gettext(self, url, page):
+        if self._cache is not None:
+            text = self._cache.get(url)
+            if text is not None:
+                REGISTRY.inc('stage1_cache_hits_total')
+                return text
+
         # >>> : Add a random delay before making request
         delay = random.uniform(2, 6)
         print(f"Sleeping for {delay:.2f} seconds before visiting: {url}")
         await asyncio.sleep(delay)
 
-        await self._page.goto(url, timeout=60000)
-        return await self._page.content()
+        with REGISTRY.time('stage1_fetch_seconds'):
+            await page.goto(url, timeout=60000)
+            text = await page.content()
+        REGISTRY.inc('stage1_pages_fetched_total')
+        if self._cache is not None:
+            self._cache.put(url, text)
+        return text
 
-    async def _write_page(self, page_url):
+    async def _get_rows(self, page_url, page):
         print(f"Fetching page: {page_url}")
-        html = await self._gettext(page_url)
-        soup = BeautifulSoup(html, 'html5lib')
+        html = await self._gettext(page_url, page)
+        with REGISTRY.time('stage1_parse_seconds'):
+            trs = _result_trs(html)
+            print(f"Found {len(trs)} rows in table")
 
-        trs = soup.select('.responsive tbody tr')
-        print(f"Found {len(trs)} rows in table")
+            rows = []
+            for tr in trs:
+                try:
+                    rows.append(_get_row(tr))
+                except Exception as e:
+                    REGISTRY.inc('stage1_row_errors_total')
+                    print(f"Error parsing row: {e}")
+        return rows
 
-        for tr in trs:
+    async def _scrape_with(self, page, work):
+        # Pulls URLs off the shared work queue for as long as the serializer is writing. Each browser page
+        # sleeps before its own requests, so the pacing per page is the same as with a single page.
+        while True:
+            url, result = await work.get()
+            if result.cancelled():
+                continue
             try:
-                info = _get_info(tr)
-                self._writer.writerow(info)
-            except Exception as e:
-                print(f"Error parsing row: {e}")
+                result.set_result(await self._get_rows(url, page))
+            except Exception as exc:
+                result.set_exception(exc)
+
+    async def _write_pages(self, page_urls):
+        # Scrapes URLs from the `page_urls` queue until it yields None, writing rows as soon as they're
+        # available. Pages may finish out of order, but rows are written in the order the URLs were queued.
+        loop = asyncio.get_event_loop()
+        work = asyncio.Queue()
+        results = asyncio.Queue()
+
+        async def feed():
+            while True:
+                url = await page_urls.get()
+                if url is None:
+                    break
+                result = loop.create_future()
+                work.put_nowait((url, result))
+                await results.put(result)
+            await results.put(None)
+
+        feeder = asyncio.ensure_future(feed())
+        scrapers = [asyncio.ensure_future(self._scrape_with(page, work)) for page in self._pages]
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                rows = await result
+                self._writer.writerows(rows)
+                REGISTRY.inc('stage1_rows_written_total', len(rows))
+                # Keep whatever has been scraped so far on disk in case a later page or query fails.
+                self._output_file.flush()
+                if self._store is not None:
+                    self._store.upsert_stage1(dict(zip(COLUMNS, row)) for row in rows)
+        finally:
+            feeder.cancel()
+            for scraper in scrapers:
+                scraper.cancel()
 
     def write_header(self):
-        self._writer.writerow([
-            'date',
-            'state',
-            'city_or_county',
-            'address',
-            'n_killed',
-            'n_injured',
-            'n_suspects_killed',
-            'n_suspects_injured',
-            'n_suspects_arrested',
-            'incident_url',
-            'source_url'
-        ])
+        self._writer.writerow(COLUMNS)
+
+    def _batch_urls(self, query_url, n_pages):
+        return ['{}?page={}'.format(query_url, pageno) for pageno in range(n_pages - 1, 0, -1)] + [query_url]
 
     def write_batch(self, query_url, n_pages):
-        batch = ['{}?page={}'.format(query_url, pageno) for pageno in range(n_pages - 1, 0, -1)] + [query_url]
-        self._page_urls.extend(batch)
+        self._page_urls.extend(self._batch_urls(query_url, n_pages))
 
     async def flush_writes(self):
         print("Flushing writes made to serializer")
-        for url in self._page_urls:
-            await self._write_page(url)
\ No newline at end of file
+        page_urls = asyncio.Queue()
+        for url in self._page_urls + [None]:
+            page_urls.put_nowait(url)
+        await self._write_pages(page_urls)
+
+    # Streaming alternative to write_batch()/flush_writes(): run stream_writes() as a task, then call
+    # stream_batch() as each query comes back and end_stream() once there are no more.
+
+    async def stream_writes(self):
+        await self._write_pages(self._stream)
+
+    def stream_batch(self, query_url, n_pages):
+        for url in self._batch_urls(query_url, n_pages):
+            self._stream.put_nowait(url)
+
+    def end_stream(self):
+        self._stream.put_nowait(None)
@@ -11,10 +11,18 @@ import os.path
 
 from aiohttp.client_exceptions import ClientResponseError
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 
+from incident_store import STAGE1_COLUMNS, add_store_args, open_store
 from log_utils import log_first_call
-from stage2_extractor import NIL_FIELDS
-from stage2_session import Stage2Session
+from metrics import REGISTRY, add_metrics_args, start_metrics
+from page_cache import add_cache_args, open_cache
+from proxy_pool import add_proxy_args
+from request_scheduler import add_scheduler_args, open_scheduler
+from stage2_backends import BACKENDS
+from stage2_extractor import ALL_FIELD_NAMES, NIL_FIELDS, Stage2Extractor, init_extract_worker
+from stage2_journal import Stage2Journal, open_digest_journal
+from stage2_session import IpBlocked, Stage2Session
 
 from selenium.webdriver import Chrome
 from selenium import webdriver
@@ -29,11 +37,6 @@ SCHEMA = {
     'n_guns_involved': np.float64,
 }
 
-data_dict = {}
-columns = []
-incident_ids = []
-OUTPUT_FNAME = None
-INPUT_FNAME = None
 def parse_args():
     targets_specific_month = False
     if len(sys.argv) > 1:
@@ -58,7 +61,7 @@ def parse_args():
 
     parser.add_argument(
         '-a', '--amend',
-        help="amend existing stage2 file by populating missing values",
+        help="amend existing stage2 file by populating missing values. the output has every input row, amended where possible",
         action='store_true',
         dest='amend',
     )
@@ -73,14 +76,102 @@ def parse_args():
     parser.add_argument(
         '-l', '--limit',
         metavar='NUM',
-        help="limit the number of simultaneous connections aiohttp makes to gunviolencearchive.org",
+        help="maximum number of simultaneous connections to one host: the site for the plain GETs of -f hybrid, " \
+             "or the proxy for -f proxy, whose requests --proxy-sessions also bounds",
         action='store',
         dest='conn_limit',
         type=int,
         default=20,
     )
+    parser.add_argument(
+        '-f', '--fetch',
+        help="how to fetch incident pages: one at a time through Chrome, up to --proxy-sessions at a time through the proxy, "
+             "or concurrently with plain HTTP, falling back to Chrome for pages that need it (hybrid)",
+        action='store',
+        dest='fetch',
+        choices=['browser', 'proxy', 'hybrid'],
+        default='browser',
+    )
+    parser.add_argument(
+        '--site',
+        metavar='URL',
+        help="fetch incident pages from this site instead of gunviolencearchive.org, e.g. a local replay_server.py",
+        action='store',
+        dest='site',
+        default=None,
+    )
+    parser.add_argument(
+        '-r', '--rate',
+        metavar='NUM',
+        help="maximum number of requests started per second when fetching through the proxy or with plain HTTP",
+        action='store',
+        dest='rate',
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        '-p', '--parser',
+        help="HTML parser backend used to extract fields from incident pages",
+        action='store',
+        dest='parser',
+        choices=sorted(BACKENDS),
+        default='html5lib',
+    )
+    parser.add_argument(
+        '--parity',
+        metavar='PARSER',
+        help="also extract every page with this parser backend and log any fields that differ",
+        action='store',
+        dest='parity_parser',
+        choices=sorted(BACKENDS),
+        default=None,
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        metavar='NUM',
+        help="number of processes that parse incident pages while the browser fetches the next ones. " \
+             "0 parses in the main process",
+        action='store',
+        dest='workers',
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        '-q', '--queue-size',
+        metavar='NUM',
+        help="maximum number of fetched pages waiting to be parsed",
+        action='store',
+        dest='queue_size',
+        type=int,
+        default=32,
+    )
+    parser.add_argument(
+        '-c', '--chunk-size',
+        metavar='NUM',
+        help="number of input rows read into memory at a time",
+        action='store',
+        dest='chunk_size',
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        '--fsync-every',
+        metavar='NUM',
+        help="fsync the output file after this many rows, bounding what a crash can lose",
+        action='store',
+        dest='fsync_every',
+        type=int,
+        default=100,
+    )
+    add_cache_args(parser)
+    add_store_args(parser)
+    add_scheduler_args(parser)
+    add_proxy_args(parser)
+    add_metrics_args(parser)
 
     args = parser.parse_args()
+    if args.store_fname is not None and args.amend:
+        parser.error("--store can't be combined with --amend")
     if targets_specific_month:
         month, year = map(int, parts)
         args.input_fname = 'stage1.{:02d}.{:04d}.csv'.format(month, year)
@@ -89,10 +180,51 @@ def parse_args():
 
 def load_input(args):
     log_first_call()
+    # Returns an iterator of DataFrames of at most --chunk-size rows, so memory doesn't grow with the input.
     return pd.read_csv(args.input_fname,
                        dtype=SCHEMA,
                        parse_dates=['date'],
-                       encoding='utf-8')
+                       encoding='utf-8',
+                       chunksize=args.chunk_size)
+
+def input_columns(args):
+    columns = pd.read_csv(args.input_fname, nrows=0, encoding='utf-8').columns.tolist()
+    if args.store_fname is not None:
+        # Rows come back from the store, which only keeps the stage 1 columns (e.g. not the index column).
+        columns = [column for column in columns if column in STAGE1_COLUMNS]
+    return columns if args.amend else ['incident_id'] + columns
+
+def iter_input_rows(args, completed_ids):
+    # Yields the rows that still need work as plain dicts, which are much cheaper to make than Series.
+    log_first_call()
+    for chunk in load_input(args):
+        if args.amend:
+            chunk = chunk.loc[chunk['incident_url_fields_missing']]
+        else:
+            chunk = add_incident_id(chunk)
+        chunk = chunk.loc[~chunk['incident_id'].isin(completed_ids)]
+        yield from chunk.to_dict('records')
+
+def copy_remaining_rows(args, journal):
+    # With --amend, the output replaces the input (see stage2_amend), so every input row the run didn't write
+    # goes into it unchanged: the ones that had no missing fields, and those that still couldn't be amended
+    # (which keep incident_url_fields_missing = True).
+    for chunk in load_input(args):
+        chunk = chunk.loc[~chunk['incident_id'].isin(journal.completed_ids)]
+        for record in chunk.to_dict('records'):
+            journal.append(record)
+
+def iter_pending_rows(args, store, completed_ids):
+    # With --store, the input is upserted into the store and the rows left to do come from a single
+    # anti-join against the incidents that already have stage 2 fields, restricted to this input's
+    # incidents (other inputs imported earlier may cover the same dates).
+    ids = store.import_stage1_csv(args.input_fname, chunk_size=args.chunk_size)
+    if not ids:
+        return
+    for row in store.pending(ids):
+        # The journal is checked too, in case a crash came between writing a row and committing the store.
+        if row['incident_id'] not in completed_ids:
+            yield row
 
 def add_incident_id(df):
     log_first_call()
@@ -104,53 +236,50 @@ def add_incident_id(df):
     df.insert(0, 'incident_id', df['incident_url'].apply(extract_id))
     return df
 
-def remove_incident_id_from_source(source_fname, inicident_ids):     
-    source = pd.read_csv(source_fname)
-    source = add_incident_id(source)    
-    source.drop(source[source['incident_id'].isin(incident_ids)].index, inplace = True)
-    source.drop(['incident_id'], axis=1, inplace = True)
-    source.to_csv(source_fname,
-              index=False,
-              float_format='%g',
-              encoding='utf-8')
-
-async def add_fields_from_incident_url(driver, df, args, predicate=None):
+def open_journal(output_fname, args):
+    # Any field columns already in the input (e.g. when amending) are replaced by freshly extracted ones.
+    columns = [column for column in input_columns(args) if column not in ALL_FIELD_NAMES] + ALL_FIELD_NAMES
+    return Stage2Journal(output_fname, columns, fsync_every=args.fsync_every)
+
+async def add_fields_from_incident_url(driver, rows, args, journal, cache=None, store=None, digests=None, scheduler=None):
+    # Appends each row with its extra fields to `journal` as soon as they're available, and the digest of
+    # its page to `digests`. Rows whose fields couldn't be extracted are left out so a later run retries them.
     log_first_call()
-    def field_name(lst):
-        assert len(set([field.name for field in lst])) == 1
-        return lst[0].name
-
-    def field_values(lst):
-        return [field.value for field in lst]
-
-    subset = df if predicate is None else df.loc[predicate]
-    if len(subset) == 0:
-        # No work to do
-        return df    
-    async with Stage2Session(limit_per_host=args.conn_limit) as session: 
-        #ip_is_blocked = False
-        global columns
-        global incident_ids 
-        columns = subset.columns.tolist()                
-        for i in range(len(subset)):            
-            row = subset.iloc[i]
-            row_to_list = row.tolist()
-            try:            
-                extra_fields = session.get_fields_from_incident_url(row, driver)                      
-                if extra_fields:                                    
-                    for field_name, field_values in extra_fields:                
-                        if i == 0:
-                            columns.append(field_name)
-                        row_to_list.append(field_values)                
-                data_dict[i] = row_to_list
-                incident_ids.append(row_to_list[0])
-            except Exception as exc: #The only exception it raises is IpBlocked 
-                #ip_is_blocked = True
-                print(str(exc))                
-                break
-
-        df = pd.DataFrame.from_dict(data_dict, orient='index', columns=columns)         
-    return df
+    extractor = Stage2Extractor(backend=args.parser, parity_backend=args.parity_parser)
+    executor = None
+    if args.workers > 0:
+        executor = ProcessPoolExecutor(max_workers=args.workers,
+                                       initializer=init_extract_worker,
+                                       initargs=(args.parser, args.parity_parser))
+    async with Stage2Session(extractor=extractor, cache=cache, rate=args.rate, limit_per_host=args.conn_limit,
+                             http_first=args.fetch == 'hybrid', site=args.site,
+                             scheduler=scheduler, proxy_url=args.proxy_url,
+                             proxy_sessions=args.proxy_sessions) as session:
+        try:
+            async for row, extra_fields, page_digest in session.iter_fields_from_incident_urls(rows, driver, executor, args.queue_size):
+                if extra_fields is None:
+                    continue
+                record = dict(row)
+                record.update(extra_fields)
+                if args.amend:
+                    # stage2_amend only replaces inputs whose output has no row left with missing fields.
+                    record['incident_url_fields_missing'] = False
+                journal.append(record)
+                REGISTRY.inc('stage2_rows_written_total')
+                if digests is not None:
+                    digests.append({'incident_id': row['incident_id'], 'page_digest': page_digest, 'fetched_at': int(time.time())})
+                if store is not None:
+                    store.upsert_stage2(row['incident_id'], record)
+        except IpBlocked: # raised once --max-blocked runs out; the rows written so far are kept
+            print("The IP is still blocked; stopping", file=sys.stderr)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    print("Pages fetched: {}".format(session.fetch_summary()), file=sys.stderr)
+
+    if args.parity_parser:
+        print("Parity {} vs {}: {} of {} pages differed".format(
+            args.parser, args.parity_parser, extractor.n_parity_mismatches, extractor.n_parity_checks), file=sys.stderr)
 
 async def main():
     args = parse_args()
@@ -160,41 +289,43 @@ async def main():
     options.add_experimental_option('w3c', False)
     options.add_argument("--disable-blink-features=AutomationControlled")
     #driver = webdriver.Chrome(options=options)
-    driver = webdriver.Chrome(ChromeDriverManager().install(), options=options)
-
-    df = load_input(args)   
-    if args.amend:
-        output_fname = args.input_fname + args.output_fname
-        df = await add_fields_from_incident_url(driver, df, args, predicate=df['incident_url_fields_missing'])
-    else:
-        global OUTPUT_FNAME
-        global INPUT_FNAME        
-        output_fname = args.output_fname
-        OUTPUT_FNAME = args.output_fname
-        INPUT_FNAME = args.input_fname        
-        df = add_incident_id(df)
-        time1= time.time()        
-        df = await add_fields_from_incident_url(driver, df, args)        
-        time2 = time.time()
-        print(time2- time1)      
+    # A cache-only run replays pages from disk, so it doesn't need a browser at all.
+    needs_browser = args.fetch in ('browser', 'hybrid') and not args.cache_only
+    driver = webdriver.Chrome(ChromeDriverManager().install(), options=options) if needs_browser else None
+
+    metrics = start_metrics(args)
+    cache = open_cache(args)
+    store = open_store(args)
+    scheduler = open_scheduler(args)
+    output_fname = args.input_fname + args.output_fname if args.amend else args.output_fname
+
+    # The output file doubles as the checkpoint journal; re-running with the same arguments resumes.
+    with open_journal(output_fname, args) as journal, open_digest_journal(output_fname, args.fsync_every) as digests:
+        if store is not None:
+            rows = iter_pending_rows(args, store, journal.completed_ids)
+        else:
+            rows = iter_input_rows(args, journal.completed_ids)
+        start = time.perf_counter()
+        await add_fields_from_incident_url(driver, rows, args, journal, cache=cache, store=store, digests=digests,
+                                           scheduler=scheduler)
+        if args.amend:
+            copy_remaining_rows(args, journal)
+        elapsed = time.perf_counter() - start
+        REGISTRY.set('stage2_run_seconds', elapsed)
+    print("Took {:.1f}s".format(elapsed), file=sys.stderr)
+    print("Scheduler: {} retries, {} gave up, {} IP blocks".format(
+        scheduler.n_retries, scheduler.n_gave_up, scheduler.n_blocks), file=sys.stderr)
+    if cache is not None:
+        print("Page cache: {} hits, {} misses".format(cache.hits, cache.misses), file=sys.stderr)
+        cache.close()
+    if store is not None:
+        store.close()
+    if metrics is not None:
+        metrics.close()
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
     try:        
         loop.run_until_complete(main())
     finally:
-        df = pd.DataFrame.from_dict(data_dict, orient='index', columns=columns)
-
-        # don't include headers if we are appending
-        if os.path.isfile(OUTPUT_FNAME):
-            df.to_csv(OUTPUT_FNAME,
-                  index=False,
-                  float_format='%g',
-                  encoding='utf-8', mode='a', header=False)
-        else:
-            df.to_csv(OUTPUT_FNAME,
-              index=False,
-              float_format='%g',
-              encoding='utf-8')
-        remove_incident_id_from_source(INPUT_FNAME, incident_ids)
         loop.close()
@@ -0,0 +1,115 @@
+from bs4 import BeautifulSoup
+
+# Each backend exposes the handful of tree operations Stage2Extractor needs, so the extraction logic
+# can run unchanged on top of different HTML parsers. Results must be identical across backends;
+# use Stage2Extractor's parity mode to check that before switching.
+#
+# sections() walks #block-system-main once and maps each <h2> title to its enclosing section, keeping the
+# first match like find_section() does. The extractor reads every section from that index; find_section()
+# looks up a single title and is kept for comparison (see bench_sections.py).
+
+class SoupBackend(object):
+    def __init__(self, features):
+        self.name = features
+        self._features = features
+
+    def parse(self, text):
+        return BeautifulSoup(text, features=self._features)
+
+    def find_section(self, root, title):
+        common_parent = root.select_one('#block-system-main')
+        header = common_parent.find('h2', string=title)
+        return header.parent if header else None
+
+    def sections(self, root):
+        index = {}
+        for header in root.select_one('#block-system-main').find_all('h2'):
+            title = header.string
+            if title is not None:
+                index.setdefault(str(title), header.parent)
+        return index
+
+    def select(self, node, selector):
+        return node.select(selector)
+
+    def select_one(self, node, selector):
+        return node.select_one(selector)
+
+    def text(self, node):
+        return node.text
+
+    def attr(self, node, name):
+        return node[name]
+
+    def br_lines(self, node):
+        # The text we want to scrape is orphaned (no direct parent element), so we can't get at it directly.
+        # Fortunately, each important line is followed by a <br> element, so we can use that to our advantage.
+        # NB: The orphaned text elements are of type 'NavigableString'
+        return [str(br.previousSibling).strip() for br in node.select('br')]
+
+def _string(node):
+    # Mirrors bs4's Tag.string: the text of the node's only child, recursing through single-child tags.
+    children = list(node.iter(include_text=True))
+    if len(children) != 1:
+        return None
+    child = children[0]
+    return child.text_content if child.tag == '-text' else _string(child)
+
+class LexborBackend(object):
+    def __init__(self):
+        # selectolax is optional; only require it when this backend is actually selected.
+        from selectolax.lexbor import LexborHTMLParser
+        self.name = 'lexbor'
+        self._parser_cls = LexborHTMLParser
+
+    def parse(self, text):
+        return self._parser_cls(text)
+
+    def find_section(self, root, title):
+        common_parent = root.css_first('#block-system-main')
+        header = next((h2 for h2 in common_parent.css('h2') if _string(h2) == title), None)
+        return header.parent if header else None
+
+    def sections(self, root):
+        index = {}
+        for header in root.css_first('#block-system-main').css('h2'):
+            title = _string(header)
+            if title is not None:
+                index.setdefault(title, header.parent)
+        return index
+
+    def select(self, node, selector):
+        return node.css(selector)
+
+    def select_one(self, node, selector):
+        return node.css_first(selector)
+
+    def text(self, node):
+        return node.text()
+
+    def attr(self, node, name):
+        return node.attrs[name]
+
+    def br_lines(self, node):
+        lines = []
+        for br in node.css('br'):
+            prev = br.prev
+            if prev is None:
+                line = 'None'
+            elif prev.tag == '-text':
+                line = prev.text_content
+            else:
+                line = prev.html
+            lines.append(line.strip())
+        return lines
+
+BACKENDS = {
+    'html5lib': lambda: SoupBackend('html5lib'),
+    'lxml': lambda: SoupBackend('lxml'),
+    'lexbor': LexborBackend,
+}
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError("Unknown parser backend {}. Choose from: {}".format(repr(name), ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name]()
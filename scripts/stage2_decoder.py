@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Decodes the `||`/`::`-encoded stage 2 columns (see _stringify_list and _stringify_dict in
+# stage2_extractor.py) a whole column at a time with Arrow compute kernels, rather than splitting one
+# row at a time in Python.
+#
+# Results are in long format: one row per list item or dict entry, tagged with the row it came from.
+# participants() and guns() combine the per-field columns into one table per entity, keyed by
+# incident_id and participant/gun ID. The *_arrow functions return Arrow arrays and row positions for
+# callers that stay in Arrow, like the Parquet writer.
+#
+# Most of stage2.03.2014.csv was written by an older encoder that used single-character separators
+# ('0:Victim|1:Victim'). A value can't tell which format it's in (a single source URL may contain '|'), so
+# the decoders take a `legacy` flag or per-row mask, and legacy_rows() works it out for a DataFrame from
+# the dict columns: their entries start with 'ID:' in the old format and 'ID::' in the new one.
+
+PARTICIPANT_FIELDS = ['age', 'age_group', 'gender', 'name', 'relationship', 'status', 'type']
+GUN_FIELDS = ['type', 'stolen']
+DICT_COLUMNS = ['participant_' + field for field in PARTICIPANT_FIELDS] + ['gun_' + field for field in GUN_FIELDS]
+
+def _as_arrow(values):
+    # Accepts a pandas Series or a pyarrow Array/ChunkedArray. Empty strings are treated as missing.
+    if isinstance(values, pd.Series):
+        values = pa.array(values, type=pa.string(), from_pandas=True)
+    # Arrow-backed pandas strings convert to a ChunkedArray
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    return pc.if_else(pc.equal(values, ''), None, values)
+
+def _split(arr, sep):
+    lists = pc.split_pattern(arr, sep)
+    rows = pc.list_parent_indices(lists).to_numpy()
+    return rows, pc.list_flatten(lists)
+
+def _matches(arr, pattern):
+    return pc.fill_null(pc.match_substring_regex(arr, pattern), False).to_numpy(zero_copy_only=False)
+
+def legacy_rows(df):
+    # A boolean array saying which rows of `df` (stage 2 rows) are in the old format. A row without
+    # participants or guns has nothing to go by, so it takes the format of the other rows of its file:
+    # stage 2 writes a file per month, so that's its month if `df` has dates, or all of `df` otherwise.
+    marked_legacy = np.zeros(len(df), dtype=bool)
+    marked = np.zeros(len(df), dtype=bool)
+    for column in DICT_COLUMNS:
+        if column in df.columns:
+            arr = _as_arrow(df[column])
+            marked_legacy |= _matches(arr, r'^\d+:($|[^:])')
+            marked |= _matches(arr, r'^\d+:')
+    if 'date' in df.columns:
+        months = pd.to_datetime(df['date']).dt.to_period('M').to_numpy()
+        file_legacy = pd.Series(marked_legacy).groupby(months).transform('any').to_numpy()
+    else:
+        file_legacy = np.full(len(df), marked_legacy.any())
+    return marked_legacy | (~marked & file_legacy)
+
+def _legacy_mask(legacy, n):
+    return pa.array(np.broadcast_to(np.asarray(legacy, dtype=bool), n))
+
+def decode_list_arrow(values, legacy=False):
+    # Returns (rows, items): the position of the source row of every item, and the items themselves.
+    # `legacy` says whether the values are in the old format: a bool, or one per row (see legacy_rows()).
+    arr = _as_arrow(values)
+    if np.any(legacy):
+        arr = pc.if_else(_legacy_mask(legacy, len(arr)), pc.replace_substring(arr, '|', '||'), arr)
+    return _split(arr, '||')
+
+def decode_dict_arrow(values, legacy=False):
+    # Returns (rows, ids, values) with one element per dict entry.
+    arr = _as_arrow(values)
+    if np.any(legacy):
+        converted = pc.replace_substring_regex(pc.replace_substring(arr, '|', '||'), r'(^|\|\|)(\d+):', r'\1\2::')
+        arr = pc.if_else(_legacy_mask(legacy, len(arr)), converted, arr)
+
+    rows, items = _split(arr, '||')
+    pairs = pc.split_pattern(items, '::', max_splits=1)
+    ids = pc.cast(pc.list_element(pairs, 0), pa.int32()).to_numpy()
+    return rows, ids, pc.list_element(pairs, 1)
+
+def decode_entities_arrow(columns, fields, legacy=False):
+    # `columns` are the encoded dict columns for each of `fields`. Returns (rows, ids, {field: values}),
+    # with one element per (row, ID) pair sorted by row, then ID. Fields an entity doesn't have are null.
+    decoded = [decode_dict_arrow(column, legacy) for column in columns]
+    # IDs are small non-negative ints, so (row, id) packs into one sortable int64.
+    keys = np.concatenate([rows.astype(np.int64) << 32 | ids.astype(np.int64) for rows, ids, _ in decoded])
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+    by_field = {}
+    start = 0
+    for field, (rows, _, values) in zip(fields, decoded):
+        end = start + len(rows)
+        take = np.full(len(unique_keys), -1, dtype=np.int64)
+        take[inverse[start:end]] = np.arange(len(rows))
+        by_field[field] = pc.take(values, pa.array(take, mask=take < 0))
+        start = end
+    return (unique_keys >> 32), (unique_keys & 0xffffffff).astype(np.int32), by_field
+
+def decode_list(values, legacy=False):
+    # Returns a Series with one item per row, indexed by the label of the row each item came from.
+    rows, items = decode_list_arrow(values, legacy)
+    index = values.index[rows] if isinstance(values, pd.Series) else pd.Index(rows)
+    return pd.Series(items.to_pandas().array, index=index, name=getattr(values, 'name', None))
+
+def decode_dict(values, legacy=False):
+    # Returns a DataFrame with 'id' and 'value' columns, indexed by the label of the row each entry came from.
+    rows, ids, items = decode_dict_arrow(values, legacy)
+    index = values.index[rows] if isinstance(values, pd.Series) else pd.Index(rows)
+    return pd.DataFrame({'id': ids, 'value': items.to_pandas().array}, index=index)
+
+def decode_entities(df, prefix, fields, id_name, key='incident_id', legacy=None):
+    # Combines the `prefix + field` dict columns into one row per (row, entity ID) with a column per field,
+    # sorted by row, then ID. The index holds the label of the source row. `legacy` defaults to legacy_rows(df).
+    if legacy is None:
+        legacy = legacy_rows(df)
+    rows, ids, by_field = decode_entities_arrow([df[prefix + field] for field in fields], fields, legacy)
+    table = pd.DataFrame({key: df[key].to_numpy()[rows], id_name: ids}, index=df.index[rows])
+    for field in fields:
+        table[field] = by_field[field].to_pandas().array
+    return table
+
+def participants(df, key='incident_id', legacy=None):
+    table = decode_entities(df, 'participant_', PARTICIPANT_FIELDS, 'participant_id', key=key, legacy=legacy)
+    table['age'] = pd.to_numeric(table['age']).astype('Int32')
+    return table
+
+def guns(df, key='incident_id', legacy=None):
+    return decode_entities(df, 'gun_', GUN_FIELDS, 'gun_id', key=key, legacy=legacy)
@@ -1,11 +1,13 @@
+import logging as log
 import re
-import json
+import time
 
-from bs4 import BeautifulSoup
 from collections import defaultdict, namedtuple
 
 from log_utils import log_first_call
+from stage2_backends import get_backend
 
+Context = namedtuple('Context', ['address', 'city_or_county', 'state'])
 Field = namedtuple('Field', ['name', 'value'])
 
 ALL_FIELD_NAMES = sorted([
@@ -38,11 +40,6 @@ ALL_FIELD_NAMES = sorted([
 
 NIL_FIELDS = tuple([Field(name, None) for name in ALL_FIELD_NAMES])
 
-def _find_div_with_title(title, soup):    
-    common_parent = soup.select_one('#block-system-main')         
-    header = common_parent.find('h2', string=title)      
-    return header.parent if header else None
-
 def _out_name(in_name, prefix=''):
     return prefix + in_name.lower().replace(' ', '_') # e.g. 'Age Group' -> 'participant_age_group'
 
@@ -109,18 +106,46 @@ def _stringify_dict(d, insep='::', outsep='||'):
 
     return outsep.join([insep.join([k, v]) for k, v in zip(keys, values)])
 
+def diff_fields(fields, other_fields):
+    # Both tuples come out of _normalize(), so they are aligned by field name.
+    return [(field.name, field.value, other.value)
+            for field, other in zip(fields, other_fields) if field != other]
+
 class Stage2Extractor(object):
-    def extract_fields(self, text, ctx):                
-        #html = json.loads(text)['solution']['response']
+    def __init__(self, backend='html5lib', parity_backend=None):
+        self._backend = get_backend(backend)
+        # In parity mode, every page is also extracted with a second backend and any differences are logged.
+        # The primary backend's fields are always the ones returned.
+        self._parity_backend = get_backend(parity_backend) if parity_backend else None
+        self.n_parity_checks = 0
+        self.n_parity_mismatches = 0
+
+    def extract_fields(self, text, ctx):
         log_first_call()
-        soup = BeautifulSoup(text, features='html5lib')         
-        location_fields = self._extract_location_fields(soup, ctx)
-        participant_fields = self._extract_participant_fields(soup)
-        incident_characteristics = self._extract_incident_characteristics(soup)
-        notes = self._extract_notes(soup)
-        guns_involved_fields = self._extract_guns_involved_fields(soup)
-        sources = self._extract_sources(soup)
-        district_fields = self._extract_district_fields(soup)
+        fields = self._extract_fields(self._backend, text, ctx)
+        if self._parity_backend is not None:
+            self._check_parity(fields, text, ctx)
+        return fields
+
+    def _check_parity(self, fields, text, ctx):
+        self.n_parity_checks += 1
+        other_fields = self._extract_fields(self._parity_backend, text, ctx)
+        diffs = diff_fields(fields, other_fields)
+        if diffs:
+            self.n_parity_mismatches += 1
+            for name, value, other_value in diffs:
+                log.warning("Parity mismatch for %s at %s: %s=%r, %s=%r",
+                            name, ctx.address, self._backend.name, value, self._parity_backend.name, other_value)
+
+    def _extract_fields(self, backend, text, ctx):
+        sections = backend.sections(backend.parse(text))
+        location_fields = self._extract_location_fields(backend, sections, ctx)
+        participant_fields = self._extract_participant_fields(backend, sections)
+        incident_characteristics = self._extract_incident_characteristics(backend, sections)
+        notes = self._extract_notes(backend, sections)
+        guns_involved_fields = self._extract_guns_involved_fields(backend, sections)
+        sources = self._extract_sources(backend, sections)
+        district_fields = self._extract_district_fields(backend, sections)
 
         return _normalize([*location_fields,
                            *participant_fields,
@@ -130,7 +155,7 @@ class Stage2Extractor(object):
                             Field('sources', sources),
                            *district_fields])
 
-    def _extract_location_fields(self, soup, ctx):
+    def _extract_location_fields(self, backend, sections, ctx):
         def describes_city_and_state(line):
             return ',' in line and line.endswith(ctx.state) # and line.startswith(ctx.city_or_county)
 
@@ -140,12 +165,12 @@ class Stage2Extractor(object):
                 re.search(r'^[0-9]+[0-9a-z-]*\b', line, re.I) or \
                 re.search(r'\b(st|street|rd|road|dr|drive|blvd|boulevard|ave|avenue|hwy|highway)\.?$', line, re.I)
 
-        div = _find_div_with_title('Location', soup)
+        div = sections.get('Location')
         if div is None:
             return
 
-        for span in div.select('span'):
-            text = span.text
+        for span in backend.select(div, 'span'):
+            text = backend.text(span)
             if not text:
                 continue
             match = re.search(r'^Geolocation:\s+(.*),\s+(.*)$', text)
@@ -159,60 +184,74 @@ class Stage2Extractor(object):
             else:
                 yield Field('location_description', text)
 
-    def _extract_participant_fields(self, soup):
-        div = _find_div_with_title('Participants', soup)
+    def _extract_participant_fields(self, backend, sections):
+        div = sections.get('Participants')
         if div is None:
             return
 
-        linegroups = [[li.text for li in ul.select('li')] for ul in div.select('ul')]
+        linegroups = [[backend.text(li) for li in backend.select(ul, 'li')] for ul in backend.select(div, 'ul')]
         for field_name, field_values in _getdicts(linegroups).items():
             field_name = _out_name(field_name, prefix='participant_')
             field_values = _stringify_dict(field_values)
             yield Field(field_name, field_values)
 
-    def _extract_incident_characteristics(self, soup):
-        div = _find_div_with_title('Incident Characteristics', soup)
-        return None if div is None else _stringify_list([li.text for li in div.select('li')])
+    def _extract_incident_characteristics(self, backend, sections):
+        div = sections.get('Incident Characteristics')
+        return None if div is None else _stringify_list([backend.text(li) for li in backend.select(div, 'li')])
 
-    def _extract_notes(self, soup):
-        div = _find_div_with_title('Notes', soup)
-        return None if div is None else div.select_one('p').text
+    def _extract_notes(self, backend, sections):
+        div = sections.get('Notes')
+        return None if div is None else backend.text(backend.select_one(div, 'p'))
 
-    def _extract_guns_involved_fields(self, soup):
-        div = _find_div_with_title('Guns Involved', soup)
+    def _extract_guns_involved_fields(self, backend, sections):
+        div = sections.get('Guns Involved')
         if div is None:
             return
 
         # n_guns_involved
-        p_text = div.select_one('p').text
+        p_text = backend.text(backend.select_one(div, 'p'))
         match = re.search(r'^([0-9]+)\s+guns?\s+involved.$', p_text)
         assert match, "<p> text did not match expected pattern: {}".format(p_text)
         n_guns_involved = int(match.group(1))
         yield Field('n_guns_involved', n_guns_involved)
 
         # List attributes
-        linegroups = [[li.text for li in ul.select('li')] for ul in div.select('ul')]
+        linegroups = [[backend.text(li) for li in backend.select(ul, 'li')] for ul in backend.select(div, 'ul')]
         for field_name, field_values in _getdicts(linegroups).items():
             field_name = _out_name(field_name, prefix='gun_')
             field_values = _stringify_dict(field_values)
             yield Field(field_name, field_values)
 
-    def _extract_sources(self, soup):
-        div = _find_div_with_title('Sources', soup)
+    def _extract_sources(self, backend, sections):
+        div = sections.get('Sources')
         if div is None:
             return None
 
-        anchors = [a for a in div.select('a') if a.text == a['href']]
-        return _stringify_list([a['href'] for a in anchors])
+        hrefs = [backend.attr(a, 'href') for a in backend.select(div, 'a') if backend.text(a) == backend.attr(a, 'href')]
+        return _stringify_list(hrefs)
 
-    def _extract_district_fields(self, soup):
-        div = _find_div_with_title('District', soup)
+    def _extract_district_fields(self, backend, sections):
+        div = sections.get('District')
         if div is None:
             return
 
-        # The text we want to scrape is orphaned (no direct parent element), so we can't get at it directly.
-        # Fortunately, each important line is followed by a <br> element, so we can use that to our advantage.
-        # NB: The orphaned text elements are of type 'NavigableString'
-        lines = [str(br.previousSibling).strip() for br in div.select('br')]
+        lines = backend.br_lines(div)
         for key, value in _getdict(lines, apply=int).items():
             yield Field(_out_name(key), value)
+
+# Process pool workers each build their own extractor once, since parser backends aren't picklable.
+_worker_extractor = None
+
+def init_extract_worker(backend, parity_backend=None):
+    global _worker_extractor
+    _worker_extractor = Stage2Extractor(backend=backend, parity_backend=parity_backend)
+
+def extract_fields_in_worker(text, ctx):
+    # Returns the fields along with whether a parity check ran and failed, so the parent process can keep
+    # count, and how long extraction took. The mismatch itself is logged from the worker.
+    n_mismatches = _worker_extractor.n_parity_mismatches
+    start = time.perf_counter()
+    fields = _worker_extractor.extract_fields(text, ctx)
+    elapsed = time.perf_counter() - start
+    checked = _worker_extractor._parity_backend is not None
+    return fields, checked, _worker_extractor.n_parity_mismatches > n_mismatches, elapsed
@@ -0,0 +1,127 @@
+import csv
+import os
+import os.path
+
+import pandas as pd
+
+# Append-only record of the incidents stage 2 has finished. The journal is the stage 2 output CSV itself:
+# each row is appended as soon as its fields are extracted, and the file is fsync'ed every `fsync_every`
+# rows, so a crash loses at most that many rows. On the next run, completed_ids tells stage 2 which input
+# rows to skip, and the input file is never rewritten.
+
+def _format_value(value):
+    # Matches what DataFrame.to_csv(float_format='%g') wrote for the same values.
+    if value is None:
+        return ''
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float):
+        return '' if value != value else '%g' % value
+    return value
+
+def format_record(record, columns):
+    # The values of `record` (a dict) as they appear in the CSV.
+    return [str(_format_value(record[column])) for column in columns]
+
+def _last_record_end(file):
+    # The byte offset just past the last complete CSV record. Fields such as notes can contain newlines, so
+    # a newline only ends a record outside quotes. csv.writer quotes any field containing a quote or a
+    # newline and doubles the quotes inside it, so we're outside quotes whenever an even number of quotes
+    # came before.
+    end = offset = 0
+    in_quotes = False
+    for line in file:
+        offset += len(line)
+        if line.count(b'"') % 2:
+            in_quotes = not in_quotes
+        if not in_quotes and line.endswith(b'\n'):
+            end = offset
+    return end
+
+def line_terminator(fname):
+    # Stage 2 files are written with '\n', as pandas wrote them; journals from before that used the csv
+    # module's default, '\r\n'. Appends keep to whatever the file already has.
+    with open(fname, 'rb') as file:
+        return '\r\n' if file.readline().endswith(b'\r\n') else '\n'
+
+def _truncate_torn_row(fname):
+    # A crash between fsyncs can leave half a row at the end of the file; drop it so appends start cleanly.
+    with open(fname, 'rb+') as file:
+        end = _last_record_end(file)
+        if end < file.tell():
+            file.truncate(end)
+
+class Stage2Journal(object):
+    def __init__(self, fname, columns, fsync_every=100, encoding='utf-8'):
+        self.fname = fname
+        self.completed_ids = set()
+        self._fsync_every = fsync_every
+        self._n_unsynced = 0
+
+        if os.path.isfile(fname):
+            _truncate_torn_row(fname)
+        resuming = os.path.isfile(fname) and os.path.getsize(fname) > 0
+        if resuming:
+            existing = pd.read_csv(fname, usecols=['incident_id'], encoding=encoding)
+            self.completed_ids.update(existing['incident_id'].tolist())
+            with open(fname, encoding=encoding, newline='') as file:
+                header = next(csv.reader(file))
+            if set(header) != set(columns):
+                raise ValueError("{} has columns {}, expected {}".format(fname, header, columns))
+            columns = header
+        terminator = line_terminator(fname) if resuming else '\n'
+
+        self.columns = list(columns)
+        self._id_index = self.columns.index('incident_id')
+        self._file = open(fname, 'a', encoding=encoding, newline='')
+        self._writer = csv.writer(self._file, lineterminator=terminator)
+        if not resuming:
+            self._writer.writerow(self.columns)
+
+    def append(self, record):
+        # `record` maps column names to values.
+        self._writer.writerow([_format_value(record[column]) for column in self.columns])
+        self.completed_ids.add(record['incident_id'])
+        self._n_unsynced += 1
+        if self._n_unsynced >= self._fsync_every:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._n_unsynced = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+# Each stage 2 output file has a sidecar, digests.OUTPUT, recording the digest of the page every row was
+# extracted from. It's append-only like the journal, and the last entry for an incident is the current one.
+# refresh.py compares fresh pages against it to find the incidents that changed. The prefix keeps sidecars
+# out of stage 3's 'stage2.*.csv' glob.
+
+DIGEST_COLUMNS = ['incident_id', 'page_digest', 'fetched_at']
+
+def digests_fname(output_fname):
+    dirname, basename = os.path.split(output_fname)
+    return os.path.join(dirname, 'digests.' + basename)
+
+def open_digest_journal(output_fname, fsync_every=100):
+    return Stage2Journal(digests_fname(output_fname), DIGEST_COLUMNS, fsync_every=fsync_every)
+
+def load_page_digests(output_fname):
+    # Returns {incident_id: page_digest}, empty if there's no sidecar yet.
+    fname = digests_fname(output_fname)
+    if not os.path.isfile(fname):
+        return {}
+    _truncate_torn_row(fname)
+    if os.path.getsize(fname) == 0:
+        return {}
+    digests = pd.read_csv(fname, usecols=['incident_id', 'page_digest'], encoding='utf-8')
+    return dict(zip(digests['incident_id'].tolist(), digests['page_digest'].tolist()))
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+# Typed loading of stage 2 output files, for stage 3 and for anything else reading the dataset.
+#
+# Every column gets an explicit type, so pandas never has to infer one and every file comes back with
+# identical dtypes. Counts that are always present are int64; optional integers use the nullable Int64
+# type so missing values don't turn them into floats. Columns not listed here (e.g. the index column
+# some split files carry) are still inferred.
+
+STATES = [
+    'Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado', 'Connecticut', 'Delaware',
+    'District of Columbia', 'Florida', 'Georgia', 'Hawaii', 'Idaho', 'Illinois', 'Indiana', 'Iowa',
+    'Kansas', 'Kentucky', 'Louisiana', 'Maine', 'Maryland', 'Massachusetts', 'Michigan', 'Minnesota',
+    'Mississippi', 'Missouri', 'Montana', 'Nebraska', 'Nevada', 'New Hampshire', 'New Jersey',
+    'New Mexico', 'New York', 'North Carolina', 'North Dakota', 'Ohio', 'Oklahoma', 'Oregon',
+    'Pennsylvania', 'Rhode Island', 'South Carolina', 'South Dakota', 'Tennessee', 'Texas', 'Utah',
+    'Vermont', 'Virginia', 'Washington', 'West Virginia', 'Wisconsin', 'Wyoming',
+]
+STATE_DTYPE = pd.CategoricalDtype(STATES)
+
+SCHEMA = {
+    'incident_id': np.int64,
+    # 'date' is parsed separately, see DATE_COLUMNS
+    'state': str, # converted to STATE_DTYPE after checking every value is a known state
+    'city_or_county': str,
+    'address': str,
+    'n_killed': np.int64,
+    'n_injured': np.int64,
+    'n_suspects_killed': np.int64,
+    'n_suspects_injured': np.int64,
+    'n_suspects_arrested': np.int64,
+    'incident_url': str,
+    'source_url': str,
+    'incident_url_fields_missing': bool,
+    'congressional_district': 'Int64',
+    'gun_stolen': str,
+    'gun_type': str,
+    'incident_characteristics': str,
+    'latitude': np.float64,
+    'location_description': str,
+    'longitude': np.float64,
+    'n_guns_involved': 'Int64',
+    'notes': str,
+    'participant_age': str,
+    'participant_age_group': str,
+    'participant_gender': str,
+    'participant_name': str,
+    'participant_relationship': str,
+    'participant_status': str,
+    'participant_type': str,
+    'sources': str,
+    'state_house_district': 'Int64',
+    'state_senate_district': 'Int64',
+}
+DATE_COLUMNS = ['date']
+
+def _apply_state_dtype(df, fname):
+    if 'state' not in df.columns:
+        return df
+    states = df['state'].astype(STATE_DTYPE)
+    unknown = df['state'].notna() & states.isna()
+    if unknown.any():
+        raise ValueError("{} has unknown states: {}".format(fname, sorted(df.loc[unknown, 'state'].unique())))
+    df['state'] = states
+    return df
+
+def _iter_typed_chunks(fname, chunks):
+    for chunk in chunks:
+        yield _apply_state_dtype(chunk, fname)
+
+def load_stage2_csv(fname, chunksize=None):
+    # NB: pandas' pyarrow engine would read faster, but it can't handle the newlines inside quoted notes.
+    df = pd.read_csv(fname,
+                     dtype=SCHEMA,
+                     parse_dates=DATE_COLUMNS,
+                     encoding='utf-8',
+                     chunksize=chunksize)
+    if chunksize is not None:
+        return _iter_typed_chunks(fname, df)
+    return _apply_state_dtype(df, fname)
+
+def load_stage2_csvs(fnames, workers=None):
+    # Loads each file in its own process and concatenates them in the order given.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        dfs = list(executor.map(load_stage2_csv, fnames))
+    return pd.concat(dfs, ignore_index=True)
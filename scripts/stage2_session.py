@@ -1,44 +1,71 @@
 import asyncio
-import math
-import numpy as np
+import html
 import platform
 import sys
 import traceback as tb
 import aiohttp
 import json
-import requests
 import time
-import random
+import re
 import pandas as pd
 
 from aiohttp import ClientResponse, ClientSession, TCPConnector
 from aiohttp.client_exceptions import ClientOSError, ClientResponseError
 from aiohttp.hdrs import CONTENT_TYPE
+from lxml import etree
+from multidict import CIMultiDict, CIMultiDictProxy
 from asyncio import CancelledError
-from collections import namedtuple
+from collections import Counter, namedtuple
 from selenium.webdriver import Chrome
 from selenium import webdriver
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
 
 from log_utils import log_first_call
-from stage2_extractor import Stage2Extractor
-
-Context = namedtuple('Context', ['address', 'city_or_county', 'state'])
-PROXY_URL = 'http://localhost:8191/v1'
-# for toggling between userAgents
-proxy_userAgent = {
-    1: 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleW...', 
-    -1: 'Chrome/5.0 (Windows NT 10.0; Win64; x64) AppleW...'
+from metrics import REGISTRY
+from page_cache import CacheMiss, digest
+from proxy_pool import DEFAULT_POOL_SIZE, PROXY_URL, ProxyError, ProxySessionPool
+from request_scheduler import RequestScheduler, RetryQueue
+from stage2_extractor import Context, Stage2Extractor, extract_fields_in_worker
+from yarl import URL
+
+GVA_SITE = 'http://www.gunviolencearchive.org'
+IP_BLOCKED_MESSAGE = 'with your ip and an explanation for why unusual traffic patterns were detected (if known)'
+# Sent with plain HTTP requests; the default aiohttp user agent is challenged far more often.
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml',
 }
+# Markers of a bot check page (e.g. Cloudflare's "Just a moment...") served instead of the incident.
+CHALLENGE_MARKERS = ('cf-browser-verification', 'challenge-platform', 'cf_chl_', '<title>Just a moment...</title>')
+_REGION_CONTENT = re.compile(r'class="[^"]*\bregion-content\b')
+_HTML_PARSER = etree.HTMLParser()
+_FIND_REGION_CONTENT = etree.XPath('//*[contains(concat(" ", normalize-space(@class), " "), " region-content ")]')
+
+def region_content_html(text):
+    # The inner HTML of the page's .region-content element, or None if it has none. Whichever way a page was
+    # fetched, this is what gets cached, hashed and parsed: the rest of the page (sidebars, form tokens, the
+    # theme) doesn't change the digest. It's always serialized by lxml, so the browser's innerHTML and the
+    # same element cut out of a plain HTTP or proxy response come out the same.
+    root = etree.fromstring(text, _HTML_PARSER) if text.strip() else None
+    found = _FIND_REGION_CONTENT(root) if root is not None else []
+    if not found:
+        return None
+    elem = found[0]
+    return html.escape(elem.text or '', quote=False) + \
+        ''.join(etree.tostring(child, method='html', encoding='unicode') for child in elem)
 
-def _compute_wait(average_wait, rng_base):
-    log_first_call()
-    log_average_wait = math.log(average_wait, rng_base)
-    fuzz = np.random.standard_normal(size=1)[0]
-    return int(np.ceil(rng_base ** (log_average_wait + fuzz)))
+def _fallback_reason(text):
+    # Why a page fetched with a plain HTTP GET has to be fetched again in the browser, or None if it's usable.
+    if any(marker in text for marker in CHALLENGE_MARKERS):
+        return 'challenge'
+    if IP_BLOCKED_MESSAGE in text:
+        return 'ip blocked'
+    if not _REGION_CONTENT.search(text):
+        return 'no .region-content'
+    return None
 
 def _status_from_exception(exc):
     if isinstance(exc, CancelledError):
@@ -51,34 +78,130 @@ def _status_from_exception(exc):
 
     return ''
 
+def _retry_reason(exc):
+    # Describes why a failed fetch is worth retrying, or returns None if it isn't (e.g. a 404).
+    if isinstance(exc, ClientResponseError):
+        return exc.status if exc.status >= 500 or exc.status == 429 else None
+    status = _status_from_exception(exc)
+    if status:
+        return status
+    if isinstance(exc, (aiohttp.ClientError, ProxyError, WebDriverException)):
+        return '<{}>'.format(type(exc).__name__)
+    return None
+
+def _proxied_status_error(url, status):
+    # What raise_for_status() raises for a page fetched directly, so pages the proxy got with an error
+    # status are retried (or not) the same way; see _retry_reason().
+    request_info = aiohttp.RequestInfo(URL(url), 'GET', CIMultiDictProxy(CIMultiDict()))
+    return ClientResponseError(request_info, (), status=status, message="through the proxy")
+
+def _context(row):
+    return Context(address=row['address'],
+                   city_or_county=row['city_or_county'],
+                   state=row['state'])
+
 class IpBlocked(Exception):
     pass
 
+class _Retry(object):
+    # Result of a fetch attempt that should be tried again.
+    def __init__(self, reason, blocked=False):
+        self.reason = reason
+        self.blocked = blocked
+
+class _WorkQueue(object):
+    # The rows a pipeline still has to finish: new input rows, and failed ones waiting to be retried.
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._exhausted = False
+        self._retries = RetryQueue()
+        self._n_unfinished = 0
+        self._changed = asyncio.Event()
+
+    def retry(self, item, delay):
+        self._retries.push(item, delay)
+        self._changed.set()
+
+    def finish(self):
+        self._n_unfinished -= 1
+        self._changed.set()
+
+    async def get(self):
+        # Returns the next (row, attempt), due retries first, or None once the input is exhausted and every
+        # row has finished.
+        while True:
+            item = self._retries.pop_due()
+            if item is not None:
+                return item
+            if not self._exhausted:
+                row = next(self._rows, None)
+                if row is not None:
+                    self._n_unfinished += 1
+                    return row, 1
+                self._exhausted = True
+            if self._n_unfinished == 0:
+                return None
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), self._retries.next_due_in())
+            except asyncio.TimeoutError:
+                pass
+
+class TokenBucket(object):
+    # Allows bursts of up to `capacity` requests, refilling at `rate` requests per second.
+    def __init__(self, rate, capacity=1):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
 class Stage2Session(object):
-    def __init__(self, **kwargs):        
-        self.delay = 0
-        self._extractor = Stage2Extractor()
+    def __init__(self, extractor=None, cache=None, rate=None, revalidate=False, scheduler=None,
+                 proxy_url=PROXY_URL, proxy_sessions=DEFAULT_POOL_SIZE, http_first=False, site=None, **kwargs):
+        self._extractor = extractor or Stage2Extractor()
+        self._scheduler = scheduler or RequestScheduler()
+        self._cache = cache
+        # With `revalidate`, pages are always fetched again; the cache is only updated.
+        self._revalidate = revalidate
+        self._bucket = TokenBucket(rate) if rate else None
         self._conn_options = kwargs
-        self._proxy_sessId = None #for storing seesion Id of the proxy server 
-        self._userAgent_index = 1 #for toggling between user agents
-
-    #destroy session wih flare solver proxy 
-    def __del__(self):               
-        '''requests.post(PROXY_URL, data=json.dumps({
-            "cmd": "sessions.destroy", 
-            "userAgent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleW...",
-            "maxTimeout": 60000, 
-            "session": self._proxy_sessId
-            })
-        )'''
+        self._proxy_url = proxy_url
+        self._proxy_sessions = proxy_sessions
+        # With `http_first`, pages are fetched with a plain GET and only go through the browser when that
+        # doesn't yield a usable page. `fetch_counts` counts the pages each path served, `fallbacks` why the
+        # browser was needed.
+        self._http_first = http_first
+        self.fetch_counts = Counter()
+        self.fallbacks = Counter()
+        # With `site` (e.g. a local replay_server.py), pages are fetched from there instead of GVA_SITE. Rows and
+        # the cache keep the real URLs.
+        self._site = site
 
     async def __aenter__(self):        
         conn = TCPConnector(**self._conn_options)
         self._sess = await ClientSession(connector=conn).__aenter__()             
+        # Proxy sessions are only created once the first page is fetched through the proxy, and each one
+        # serves one request at a time, so the pool also bounds the number of in-flight proxy requests.
+        self.proxy_pool = ProxySessionPool(self._sess, url=self._proxy_url, size=self._proxy_sessions)
+        # The browser can only load one page at a time, however many rows are falling back to it.
+        self._browser_lock = asyncio.Lock()
         return self
 
     async def __aexit__(self, type, value, tb):
-        await self._sess.__aexit__(type, value, tb)
+        try:
+            await self.proxy_pool.close()
+        finally:
+            await self._sess.__aexit__(type, value, tb)
 
     def _log_retry(self, url, status, retry_wait):
         print("GET request to {} failed with status {}. Trying again in {}s...".format(url, status, retry_wait), file=sys.stderr)
@@ -86,74 +209,290 @@ class Stage2Session(object):
     def _log_extraction_failed(self, url):
         print("ERROR! Extraction failed for the following url: {}".format(url), file=sys.stderr)
 
-    async def _get(self, url, average_wait=10, rng_base=2):       
-        #initialize the proxy server session id if this is the first request 
-        if self._proxy_sessId == None:              
-            res = requests.post(PROXY_URL, data=json.dumps({"cmd": "sessions.create", "userAgent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleW...",
-            "maxTimeout": 60000}))
-            self._proxy_sessId = json.loads(res.text)['session']        
-
-        payload =  {
-            "cmd": "request.get",
-            "url": url,
-            "session": self._proxy_sessId, #keep the same session for every request 
-            "userAgent": proxy_userAgent[self._userAgent_index],
-            "maxTimeout": 60000                    
-        }
-        self._userAgent_index = self._userAgent_index * -1 # change userAgent for next request        
-                
-        while True:
-            try:
-                resp = await self._sess.post(PROXY_URL, data=json.dumps(payload), headers={"content-type": "application/json"})                
-            except Exception as exc:
-                status = _status_from_exception(exc)
-                if not status:
-                    raise
-            else:
-                status = resp.status
-                if status < 500: # Suceeded or client error
-                    return resp
-                # It's a server error. Dispose the response and retry.
-                await resp.release()
-
-            wait = _compute_wait(average_wait, rng_base)
-            self._log_retry(url, status, wait)
-            await asyncio.sleep(wait)      
+    async def _get(self, url):       
+        # A single request through the proxy; retries are up to the caller (see iter_fields_from_incident_urls).
+        async with self.proxy_pool.session() as session:
+            if self._bucket is not None:
+                await self._bucket.acquire()
+            return await self.proxy_pool.get(session, url)
+
+    def _site_url(self, url):
+        if self._site is None or not url.startswith(GVA_SITE):
+            return url
+        return self._site + url[len(GVA_SITE):]
+
+    def _cached_text(self, row):
+        if self._cache is None or self._revalidate:
+            return None
+        return self._cache.get(row['incident_url'])
                 
-    def _get_fields_from_incident_url(self, row, driver):
-        #time.sleep(self.delay)
+    def _fetch_incident_html(self, row, driver):
         incident_url = row['incident_url']       
-
-        time1 = time.time()
-        driver.get(incident_url) 
+        driver.get(self._site_url(incident_url))
         #Check to see if request is forbbiden due to IP block               
         if driver.exists_element(By.ID, 'content'):
             elem = driver.find_element_or_wait(By.ID, 'content')
-            if 'with your ip and an explanation for why unusual traffic patterns were detected (if known)' in elem.get_attribute('innerHTML'): 
+            if IP_BLOCKED_MESSAGE in elem.get_attribute('innerHTML'): 
                 raise IpBlocked                  
         elem = driver.find_element_or_wait(By.CSS_SELECTOR, '.region-content')
-        time2 = time.time()        
-        self.delay = random.uniform(1, 2) * (time2 - time1)       
-        text = elem.get_attribute('innerHTML')                
-        ctx = Context(address=row['address'],
-                      city_or_county=row['city_or_county'],
-                      state=row['state'])
-        return self._extractor.extract_fields(text, ctx)
+        text = region_content_html('<div class="region-content">{}</div>'.format(elem.get_attribute('innerHTML')))
+        if self._cache is not None:
+            self._cache.put(incident_url, text)
+        return text
+
+    async def _fetch_incident_html_via_proxy(self, row):
+        incident_url = row['incident_url']
+        url = self._site_url(incident_url)
+        data = await self._get(url)
+        text = data['solution']['response']
+        if IP_BLOCKED_MESSAGE in text:
+            raise IpBlocked
+        status = data['solution'].get('status', 200)
+        if status != 200:
+            # Nothing is cached. A challenge the proxy didn't get past is worth another try, like a 5xx.
+            if any(marker in text for marker in CHALLENGE_MARKERS):
+                raise ProxyError("challenge not solved (HTTP {})".format(status))
+            raise _proxied_status_error(url, status)
+        content = region_content_html(text)
+        if content is None:
+            # Not an incident page, so nothing to cache; extraction fails and a later run retries the row.
+            self._count_fetch('proxy')
+            return text
+        text = content
+        if self._cache is not None:
+            self._cache.put(incident_url, text)
+        self._count_fetch('proxy')
+        return text
+
+    async def _fetch_incident_html_via_http(self, row, driver):
+        # The incident pages are rendered server-side, so a plain GET usually returns everything the extractor
+        # needs. Bot checks, the IP block page and pages without .region-content go through the browser.
+        incident_url = row['incident_url']
+        if self._bucket is not None:
+            await self._bucket.acquire()
+        async with self._sess.get(self._site_url(incident_url), headers=HTTP_HEADERS) as resp:
+            text = await resp.text(errors='replace')
+            reason = _fallback_reason(text)
+            if reason is None:
+                text = region_content_html(text)
+                if text is None:
+                    reason = 'no .region-content'
+            if reason is None or reason == 'no .region-content':
+                # Challenges come back as 403/503; anything else that failed is an ordinary HTTP error.
+                resp.raise_for_status()
+
+        if reason is None:
+            if self._cache is not None:
+                self._cache.put(incident_url, text)
+            self._count_fetch('http')
+            return text
+
+        self.fallbacks[reason] += 1
+        REGISTRY.inc('stage2_browser_fallbacks_total')
+        async with self._browser_lock:
+            return await self._fetch_incident_html_in_browser(row, driver)
+
+    async def _fetch_incident_html_in_browser(self, row, driver):
+        # Selenium calls block, so they run on a helper thread.
+        text = await asyncio.get_event_loop().run_in_executor(None, self._fetch_incident_html, row, driver)
+        self._count_fetch('browser')
+        return text
+
+    def _count_fetch(self, path):
+        self.fetch_counts[path] += 1
+        REGISTRY.inc('stage2_{}_fetches_total'.format(path))
+
+    def fetch_summary(self):
+        # e.g. "http 950 (95.0%), browser 50 (5.0%); fell back for challenge 48, no .region-content 2"
+        total = sum(self.fetch_counts.values())
+        summary = ', '.join("{} {} ({:.1%})".format(path, n, n / total) for path, n in self.fetch_counts.most_common())
+        if self.fallbacks:
+            summary += '; fell back for ' + ', '.join("{} {}".format(reason, n) for reason, n in self.fallbacks.most_common())
+        return summary or 'nothing fetched'
+
+    def _get_fields_from_incident_url(self, row, driver):
+        text = self._cached_text(row)
+        if text is None:
+            text = self._fetch_incident_html(row, driver)
+        return self._extractor.extract_fields(text, _context(row))
 
     def get_fields_from_incident_url(self, row, driver):        
+        # Fetches and extracts a single row, without retries. Returns None if that fails.
         log_first_call()
         try:            
             return self._get_fields_from_incident_url(row, driver)
+        except IpBlocked:
+            raise
         except Exception as exc:
-            if isinstance(exc, IpBlocked):
-                raise                        
-            pass
-            # Passing return_exceptions=True to asyncio.gather() destroys the ability
-            # to print them once they're caught, so do that manually here.
-            '''if isinstance(exc, ClientResponseError) and exc.code == 404:
-                # 404 is handled gracefully by us so this isn't too newsworthy.
-                pass
+            self._log_failure(row, exc)
+            return None
+
+    def _log_failure(self, row, exc):
+        if isinstance(exc, CacheMiss) or (isinstance(exc, ClientResponseError) and exc.status == 404):
+            # 404 is handled gracefully by us so this isn't too newsworthy, and neither are cache-only misses.
+            return
+        self._log_extraction_failed(row['incident_url'])
+        tb.print_exception(type(exc), exc, exc.__traceback__)
+
+    def _submit_extraction(self, executor, text, ctx):
+        loop = asyncio.get_event_loop()
+        if executor is not None:
+            return loop.run_in_executor(executor, extract_fields_in_worker, text, ctx)
+        future = loop.create_future()
+        try:
+            start = time.perf_counter()
+            fields = self._extractor.extract_fields(text, ctx)
+            future.set_result((fields, False, False, time.perf_counter() - start))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    async def _extract_unless_unchanged(self, row, text, executor, known_digests):
+        # Resolves to (fields, checked, mismatched, page_digest). Pages whose digest matches the one in
+        # `known_digests` aren't parsed at all, and their fields are None.
+        page_digest = digest(text)
+        if known_digests is not None and known_digests.get(row['incident_id']) == page_digest:
+            return None, False, False, page_digest
+        fields, checked, mismatched, parse_seconds = await self._submit_extraction(executor, text, _context(row))
+        REGISTRY.observe('stage2_parse_seconds', parse_seconds)
+        return fields, checked, mismatched, page_digest
+
+    async def _fetch_text(self, row, driver):
+        # One attempt at getting the page for `row`, from the cache or through the scheduler. Returns the
+        # text, or a _Retry if the attempt failed in a way that's worth retrying. Other failures raise.
+        text = self._cached_text(row)
+        if text is not None:
+            REGISTRY.inc('stage2_cache_hits_total')
+            return text
+
+        url = row['incident_url']
+        await self._scheduler.acquire(url)
+        start = time.perf_counter()
+        try:
+            if self._http_first:
+                text = await self._fetch_incident_html_via_http(row, driver)
+            elif driver is not None:
+                text = await self._fetch_incident_html_in_browser(row, driver)
             else:
-                self._log_extraction_failed(row['incident_url'])
-                tb.print_exc()
-            raise'''
+                text = await self._fetch_incident_html_via_proxy(row)
+        except IpBlocked:
+            if not self._scheduler.record_block(url):
+                raise
+            return _Retry('<ip blocked>', blocked=True)
+        except Exception as exc:
+            reason = _retry_reason(exc)
+            if reason is None:
+                raise
+            self._scheduler.record_failure(url)
+            return _Retry(reason)
+        REGISTRY.observe('stage2_fetch_seconds', time.perf_counter() - start)
+        self._scheduler.record_success(url)
+        return text
+
+    async def _fetch_and_extract(self, row, driver, executor, known_digests):
+        text = await self._fetch_text(row, driver)
+        if isinstance(text, _Retry):
+            return text
+        return await self._extract_unless_unchanged(row, text, executor, known_digests)
+
+    async def _fetch_into(self, pending, work, driver, executor, known_digests):
+        # Fetch stage. Pages are fetched one at a time through the browser while the event loop keeps handing
+        # them to the parse stage. `pending` is bounded, so fetching stalls once the parse stage falls
+        # `maxsize` pages behind.
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await work.get()
+            if item is None:
+                break
+            row, attempt = item
+            try:
+                text = await self._fetch_text(row, driver)
+            except Exception as exc:
+                future = loop.create_future()
+                future.set_exception(exc)
+            else:
+                if isinstance(text, _Retry):
+                    future = loop.create_future()
+                    future.set_result(text)
+                else:
+                    future = asyncio.ensure_future(self._extract_unless_unchanged(row, text, executor, known_digests))
+            await pending.put((row, attempt, future))
+        await pending.put(None)
+
+    async def _fetch_concurrently_into(self, pending, work, driver, executor, known_digests):
+        # Fetch stage for the proxy and for plain HTTP. Every queued row gets its own task, so up to `maxsize`
+        # requests can be waiting on the scheduler, proxy session pool and rate limiter at once, and each page
+        # goes to the parse stage as soon as its response arrives.
+        while True:
+            item = await work.get()
+            if item is None:
+                break
+            row, attempt = item
+            task = asyncio.ensure_future(self._fetch_and_extract(row, driver, executor, known_digests))
+            await pending.put((row, attempt, task))
+        await pending.put(None)
+
+    async def iter_fields_from_incident_urls(self, rows, driver, executor=None, queue_size=32, known_digests=None):
+        # Yields (row, fields, page_digest) for every row. If `driver` is given, pages are fetched one at a time
+        # through it; otherwise they're fetched concurrently through the proxy with _get(). With `http_first`
+        # they're fetched concurrently with plain GETs, and only the ones that need it go through `driver`.
+        # Pages are parsed in `executor` (a ProcessPoolExecutor set up with init_extract_worker), or in this
+        # process if it's None.
+        #
+        # Rows come out in input order, except that a row whose fetch failed goes on a retry queue (see
+        # request_scheduler.py) and comes out once it's been retried. While the IP is blocked, fetching pauses
+        # until a probe gets through; IpBlocked is only raised if the block outlasts the scheduler's max_blocked.
+        #
+        # page_digest is the SHA-256 of the fetched .region-content HTML, or None if the page couldn't be fetched.
+        # As with get_fields_from_incident_url(), fields is None if the row couldn't be fetched or parsed, and
+        # also if `known_digests` (incident_id -> digest) says the page hasn't changed.
+        log_first_call()
+        pending = asyncio.Queue(maxsize=queue_size)
+        work = _WorkQueue(rows)
+        if driver is not None and not self._http_first:
+            producer = asyncio.ensure_future(self._fetch_into(pending, work, driver, executor, known_digests))
+        else:
+            producer = asyncio.ensure_future(self._fetch_concurrently_into(pending, work, driver, executor, known_digests))
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    break
+                row, attempt, future = item
+                try:
+                    result = await future
+                except IpBlocked:
+                    raise
+                except Exception as exc:
+                    self._log_failure(row, exc)
+                    result = None, False, False, None
+
+                if isinstance(result, _Retry):
+                    if result.blocked:
+                        # Not the row's fault; it waits for the block to lift without using up an attempt.
+                        work.retry((row, attempt), 0)
+                        continue
+                    if attempt < self._scheduler.max_attempts:
+                        wait = self._scheduler.backoff(attempt)
+                        self._scheduler.n_retries += 1
+                        REGISTRY.inc('stage2_retries_total')
+                        self._log_retry(row['incident_url'], result.reason, '{:.1f}'.format(wait))
+                        work.retry((row, attempt + 1), wait)
+                        continue
+                    self._scheduler.n_gave_up += 1
+                    REGISTRY.inc('stage2_gave_up_total')
+                    print("Giving up on {} after {} attempts".format(row['incident_url'], attempt), file=sys.stderr)
+                    result = None, False, False, None
+
+                work.finish()
+                fields, checked, mismatched, page_digest = result
+                if checked:
+                    self._extractor.n_parity_checks += 1
+                    self._extractor.n_parity_mismatches += mismatched
+                yield row, fields, page_digest
+        finally:
+            producer.cancel()
+            while not pending.empty():
+                item = pending.get_nowait()
+                if item is not None:
+                    item[2].cancel()
@@ -1,48 +1,134 @@
 #!/usr/bin/env python3
 # stage 3: sorting and merging data
 
-import numpy as np
+import csv
+import heapq
+import os
+import os.path
 import pandas as pd
+import sys
+import tempfile
 
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
+from metrics import REGISTRY, add_metrics_args, start_metrics
+from stage2_loader import load_stage2_csv
+
 STAGE2_GLOB = 'stage2.*.csv'
+OUTPUT_FNAME = 'stage3.csv'
+
+SORT_KEY = ['date', 'incident_id']
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-c', '--chunk-size',
+        metavar='NUM',
+        help="number of rows held in memory at a time while sorting",
+        action='store',
+        dest='chunk_size',
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        metavar='NUM',
+        help="number of processes that load and sort input files",
+        action='store',
+        dest='workers',
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        '--parquet',
+        metavar='DIR',
+        help="also write the merged data as a Parquet dataset partitioned by year and state (requires pyarrow)",
+        action='store',
+        dest='parquet_dir',
+        default=None,
+    )
+    add_metrics_args(parser)
+    return parser.parse_args()
+
+def load_csv(csv_fname, chunksize=None):
+    return load_stage2_csv(csv_fname, chunksize=chunksize)
+
+def write_sorted_runs(fname, columns, run_prefix, chunk_size):
+    # Splits one input into sorted runs of at most `chunk_size` rows. Rows are written exactly as the
+    # merged file should contain them, so the merge only has to compare keys and copy lines.
+    run_fnames = []
+    for chunk in load_csv(fname, chunksize=chunk_size):
+        if set(chunk.columns) != set(columns):
+            raise ValueError("{} has columns {}, expected {}".format(fname, chunk.columns.tolist(), columns))
+        assert all(~chunk['date'].isna())
+        chunk = chunk[columns].sort_values(SORT_KEY, kind='mergesort')
 
-SCHEMA = {
-    'congressional_district': np.float64,
-    'state_house_district': np.float64,
-    'state_senate_district': np.float64,
-    'n_guns_involved': np.float64,
-}
-
-def load_csv(csv_fname):
-    return pd.read_csv(csv_fname,
-                       dtype=SCHEMA,
-                       parse_dates=['date'],
-                       encoding='utf-8')
-
-def inner_sort(dfs):
-    for df in dfs:
-        assert all(~df['date'].isna())
-        df.sort_values('date', inplace=True)
-
-def outer_sort(dfs):
-    # If the first incident in one file took place earlier than the first incident in another,
-    # we assume all incidents in the former took place earlier than all incidents in the latter.
-    dfs.sort(key=lambda df: df.loc[0].date)
+        run_fname = '{}.{}.csv'.format(run_prefix, len(run_fnames))
+        chunk.to_csv(run_fname,
+                     index=False,
+                     float_format='%g',
+                     encoding='utf-8')
+        run_fnames.append(run_fname)
+    return run_fnames
+
+def _read_run(run_file, date_index, id_index):
+    reader = csv.reader(run_file)
+    next(reader) # header
+    for row in reader:
+        # Dates are written as YYYY-MM-DD, so comparing them as strings orders them chronologically.
+        yield (row[date_index], int(row[id_index])), row
+
+def merge_runs(run_fnames, columns, output_fname):
+    date_index, id_index = columns.index('date'), columns.index('incident_id')
+    run_files = [open(fname, encoding='utf-8', newline='') for fname in run_fnames]
+    try:
+        with open(output_fname, 'w', encoding='utf-8', newline='') as output_file:
+            # '\n' like the pandas to_csv() this replaced, so the output is byte-for-byte the same.
+            writer = csv.writer(output_file, lineterminator='\n')
+            writer.writerow(columns)
+            runs = [_read_run(run_file, date_index, id_index) for run_file in run_files]
+            # heapq.merge only holds the head row of each run, so memory doesn't grow with the data.
+            writer.writerows(row for _, row in heapq.merge(*runs, key=lambda item: item[0]))
+    finally:
+        for run_file in run_files:
+            run_file.close()
 
 def main():
-    # Sort the dataframes by ascending date, then sort by ascending date *within* each dataframe,
-    # then merge into 1 giant CSV.
-    dfs = [load_csv(fname) for fname in glob(STAGE2_GLOB)]
-    inner_sort(dfs)
-    outer_sort(dfs)
-
-    giant_df = pd.concat(dfs, ignore_index=True)
-    giant_df.to_csv('stage3.csv',
-                    index=False,
-                    float_format='%g',
-                    encoding='utf-8')
+    # Sort each stage 2 file by (date, incident_id) in bounded-size runs, one process per file,
+    # then merge all the runs into 1 giant CSV. Files may cover overlapping date ranges.
+    args = parse_args()
+    fnames = sorted(glob(STAGE2_GLOB))
+    if not fnames:
+        return
+    columns = pd.read_csv(fnames[0], nrows=0, encoding='utf-8').columns.tolist()
+    if args.parquet_dir is not None:
+        # pyarrow is only needed for this output, so don't require it unless Parquet was asked for.
+        from stage3_parquet import check_dataset_dir, write_parquet
+        # Refuse a --parquet directory that isn't a previous dataset before spending time on the merge.
+        try:
+            check_dataset_dir(args.parquet_dir)
+        except ValueError as e:
+            sys.exit(str(e))
+    metrics = start_metrics(args)
+    REGISTRY.inc('stage3_input_files_total', len(fnames))
+
+    with tempfile.TemporaryDirectory(prefix='stage3.') as run_dir:
+        run_prefixes = [os.path.join(run_dir, 'run{}'.format(i)) for i in range(len(fnames))]
+        n = len(fnames)
+        with REGISTRY.time('stage3_sort_seconds'), ProcessPoolExecutor(max_workers=args.workers) as executor:
+            runs_per_file = executor.map(write_sorted_runs, fnames, [columns] * n, run_prefixes, [args.chunk_size] * n)
+            run_fnames = [run_fname for run_fnames in runs_per_file for run_fname in run_fnames]
+        REGISTRY.inc('stage3_sorted_runs_total', len(run_fnames))
+        with REGISTRY.time('stage3_merge_seconds'):
+            merge_runs(run_fnames, columns, OUTPUT_FNAME)
+
+    if args.parquet_dir is not None:
+        with REGISTRY.time('stage3_parquet_seconds'):
+            write_parquet(OUTPUT_FNAME, args.parquet_dir, chunk_size=args.chunk_size)
+    if metrics is not None:
+        metrics.close()
 
 if __name__ == '__main__':
     main()
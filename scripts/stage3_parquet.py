@@ -0,0 +1,113 @@
+import itertools
+import numpy as np
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shutil
+import tempfile
+
+from stage2_decoder import GUN_FIELDS, PARTICIPANT_FIELDS, decode_entities_arrow, decode_list_arrow, legacy_rows
+from stage2_loader import load_stage2_csv
+
+# Writes the merged dataset as a Parquet dataset partitioned by year and state, e.g.
+# DIR/year=2017/state=Ohio/part-0.parquet, one file per partition.
+#
+# The `||`/`::`-encoded columns are stored as native lists: participant_* columns are combined into a
+# single `participants` column of list<struct>, gun_* into `guns`, and incident_characteristics and
+# sources become list<string>. Rows stay sorted by (date, incident_id), so the per-row-group statistics
+# Parquet writes on those columns let readers skip row groups by predicate. Rows are buffered per partition
+# until a row group is full, so groups have row_group_size rows except for the last one of each file.
+#
+# The dataset is written to a temporary directory next to DIR and renamed into place once complete. An
+# existing DIR is only replaced if it holds nothing but year=* partitions, i.e. is a previous dataset.
+
+LIST_COLUMNS = ['incident_characteristics', 'sources']
+ENCODED_COLUMNS = ['participant_' + field for field in PARTICIPANT_FIELDS] + \
+                  ['gun_' + field for field in GUN_FIELDS] + LIST_COLUMNS
+PARTITION_COLUMNS = ['year', 'state']
+
+def _offsets(rows, n_rows):
+    # `rows` holds the (sorted) source row of every list element; returns Arrow list offsets.
+    counts = np.bincount(rows, minlength=n_rows)
+    return pa.array(np.concatenate([[0], np.cumsum(counts)]), type=pa.int32())
+
+def _entity_lists(df, prefix, fields, types, legacy):
+    rows, ids, by_field = decode_entities_arrow([df[prefix + field] for field in fields], fields, legacy)
+    children = [pa.array(ids)] + [pc.cast(by_field[field], types[field]) for field in fields]
+    structs = pa.StructArray.from_arrays(children, names=['id'] + fields)
+    return pa.ListArray.from_arrays(_offsets(rows, len(df)), structs)
+
+def _string_lists(values, legacy):
+    rows, items = decode_list_arrow(values, legacy)
+    return pa.ListArray.from_arrays(_offsets(rows, len(values)), items)
+
+def to_arrow(df):
+    df = df.reset_index(drop=True)
+    legacy = legacy_rows(df)
+    participant_types = {field: pa.int32() if field == 'age' else pa.string() for field in PARTICIPANT_FIELDS}
+    gun_types = {field: pa.string() for field in GUN_FIELDS}
+
+    scalars = df.drop(columns=ENCODED_COLUMNS)
+    scalars['state'] = scalars['state'].astype(str)
+    scalars.insert(0, 'year', scalars['date'].dt.year.astype('int16'))
+    table = pa.Table.from_pandas(scalars, preserve_index=False)
+    # Every chunk is written with the same schema, and a string column can be all-null in one of them.
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(i, field.name, table[field.name].cast(pa.string()))
+    table = table.set_column(table.schema.get_field_index('date'), 'date', table['date'].cast(pa.date32()))
+
+    table = table.append_column('participants', _entity_lists(df, 'participant_', PARTICIPANT_FIELDS, participant_types, legacy))
+    table = table.append_column('guns', _entity_lists(df, 'gun_', GUN_FIELDS, gun_types, legacy))
+    for column in LIST_COLUMNS:
+        table = table.append_column(column, _string_lists(df[column], legacy))
+    return table
+
+def check_dataset_dir(dataset_dir):
+    # Raises ValueError unless `dataset_dir` is free or a previous dataset that may be replaced.
+    if not os.path.exists(dataset_dir):
+        return
+    if not os.path.isdir(dataset_dir):
+        raise ValueError("{} exists and isn't a directory; not replacing it with the Parquet dataset".format(dataset_dir))
+    others = [entry for entry in os.listdir(dataset_dir)
+              if not (entry.startswith('year=') and os.path.isdir(os.path.join(dataset_dir, entry)))]
+    if others:
+        raise ValueError("{} isn't a previous Parquet dataset (it contains {}); not replacing it".format(
+            dataset_dir, ', '.join(sorted(others)[:5])))
+
+def write_parquet(csv_fname, dataset_dir, chunk_size=100000, row_group_size=10000):
+    dataset_dir = os.path.abspath(dataset_dir)
+    check_dataset_dir(dataset_dir)
+    parent, name = os.path.split(dataset_dir)
+    tmp_dir = tempfile.mkdtemp(prefix='.{}.'.format(name), dir=parent)
+    try:
+        tables = (to_arrow(chunk) for chunk in load_stage2_csv(csv_fname, chunksize=chunk_size))
+        first = next(tables, None)
+        if first is not None: # otherwise the CSV has no rows and the dataset stays empty
+            batches = (batch for table in itertools.chain([first], tables) for batch in table.to_batches())
+            ds.write_dataset(pa.RecordBatchReader.from_batches(first.schema, batches),
+                             tmp_dir,
+                             format='parquet',
+                             partitioning=PARTITION_COLUMNS,
+                             partitioning_flavor='hive',
+                             basename_template='part-{i}.parquet',
+                             min_rows_per_group=row_group_size,
+                             max_rows_per_group=row_group_size,
+                             # One file per partition: there are about 300 (years x states), each kept open.
+                             max_open_files=4096,
+                             preserve_order=True,
+                             file_options=ds.ParquetFileFormat().make_write_options(write_statistics=True))
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        raise
+
+    if os.path.exists(dataset_dir):
+        # A directory can't be renamed over a non-empty one, so move the old dataset aside first.
+        old_dir = tmp_dir + '.old'
+        os.rename(dataset_dir, old_dir)
+        os.rename(tmp_dir, dataset_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.rename(tmp_dir, dataset_dir)
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from incident_store import IncidentStore
+
+PREFIX = 'http://www.gunviolencearchive.org/incident/'
+
+def write_split(fname, ids):
+    # Like the real splits, every file spans the same dates.
+    pd.DataFrame({
+        'date': ['2020-{:02d}-01'.format(1 + i % 12) for i in ids],
+        'state': 'Texas',
+        'city_or_county': 'Houston',
+        'address': '',
+        'n_killed': 0,
+        'n_injured': 1,
+        'incident_url': [PREFIX + str(i) for i in ids],
+        'source_url': '',
+    }).to_csv(fname, index=False)
+
+def test_pending_only_covers_the_given_input(tmp_path):
+    write_split(tmp_path / 'split1.csv', range(0, 60, 2))
+    write_split(tmp_path / 'split2.csv', range(1, 60, 2))
+    with IncidentStore(str(tmp_path / 'store.sqlite'), commit_every=3) as store:
+        store.import_stage1_csv(str(tmp_path / 'split2.csv'))
+        ids = store.import_stage1_csv(str(tmp_path / 'split1.csv'))
+
+        done = []
+        # Upserting (and committing) while iterating must neither skip nor repeat rows.
+        for row in store.pending(ids, batch_size=7):
+            done.append(row['incident_id'])
+            store.upsert_stage2(row['incident_id'], {})
+
+        assert sorted(done) == list(range(0, 60, 2))
+        assert list(store.pending(ids)) == []
+        assert len(list(store.pending())) == 30
@@ -0,0 +1,29 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from page_cache import PageCache
+
+def test_concurrent_puts_keep_the_total_right(tmp_path):
+    # Several threads put the same few pages under different URLs while eviction keeps removing blobs.
+    cache = PageCache(str(tmp_path), max_bytes=2000)
+    errors = []
+    def put_pages(n):
+        try:
+            for i in range(300):
+                cache.put('http://example.com/{}/{}'.format(n, i), 'page {} '.format(i % 20) * 50)
+        except Exception as exc:
+            errors.append(exc)
+    threads = [threading.Thread(target=put_pages, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert cache._total == cache.size()
+    assert cache.size() <= 2000
+    blobs = [fname for _, _, fnames in os.walk(tmp_path / 'blobs') for fname in fnames]
+    assert len(blobs) == cache._conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0]
@@ -0,0 +1,60 @@
+import asyncio
+import datetime
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+import refresh
+
+class FakeSession(object):
+    # Stands in for Stage2Session: every page has changed, and so have its notes.
+    def __init__(self, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def iter_fields_from_incident_urls(self, rows, driver, executor, queue_size, known_digests=None):
+        for row in rows:
+            yield row, {'notes': 'new notes'}, 'new digest'
+
+    def fetch_summary(self):
+        return ''
+
+def refresh_file(tmp_path, monkeypatch):
+    fname = str(tmp_path / 'stage2.01.2020.csv')
+    with open(fname, 'w') as file:
+        file.write('incident_id,date,notes\n1,{},old notes\n'.format(datetime.date.today().isoformat()))
+    log_fname = str(tmp_path / 'changes.jsonl')
+    monkeypatch.setattr(refresh, 'Stage2Session', FakeSession)
+    monkeypatch.setattr(sys, 'argv', ['refresh.py', fname, '--log', log_fname])
+    args = refresh.parse_args()
+    with open(log_fname, 'a') as change_log:
+        try:
+            asyncio.run(refresh.refresh_file(fname, args, None, None, None, None, change_log))
+        finally:
+            change_log.flush()
+    with open(log_fname) as change_log:
+        return fname, [json.loads(line) for line in change_log]
+
+def test_patches_are_logged(tmp_path, monkeypatch):
+    fname, changes = refresh_file(tmp_path, monkeypatch)
+    assert [change['changes'] for change in changes] == [{'notes': ['old notes', 'new notes']}]
+    with open(fname) as file:
+        assert 'new notes' in file.read()
+
+def test_patches_that_never_landed_are_not_logged(tmp_path, monkeypatch):
+    def write_rows(fname, columns, rows):
+        raise OSError("disk full")
+    monkeypatch.setattr(refresh, 'write_rows', write_rows)
+    with pytest.raises(OSError):
+        refresh_file(tmp_path, monkeypatch)
+    with open(tmp_path / 'changes.jsonl') as change_log:
+        assert change_log.read() == ''
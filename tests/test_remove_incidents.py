@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts', 'remove_incidents.py')
+PREFIX = 'http://www.gunviolencearchive.org/incident/'
+
+def write_source(fname, ids):
+    pd.DataFrame({'date': '2020-01-01', 'state': 'Texas', 'incident_url': [PREFIX + str(i) for i in ids]}).to_csv(fname, index=False)
+
+def write_result(fname, ids):
+    pd.DataFrame({'incident_id': ids, 'incident_url': [PREFIX + str(i) for i in ids], 'notes': 'x'}).to_csv(fname, index=False)
+
+def run(*args):
+    return subprocess.run([sys.executable, SCRIPT, *args], capture_output=True, text=True)
+
+def test_bulk_overlapping_globs_leave_results_alone(tmp_path):
+    write_source(tmp_path / '2020_split1.csv', [1, 2, 3])
+    write_source(tmp_path / '2020_split2.csv', [4, 5])
+    write_result(tmp_path / '2020_split1_res.csv', [1, 2])
+    write_result(tmp_path / '2020_split2_res.csv', [4])
+
+    proc = run('--bulk', str(tmp_path / '2020_split*.csv'), str(tmp_path / '*_res.csv'))
+
+    assert proc.returncode == 0, proc.stderr
+    assert '_res.csv' not in proc.stderr
+    assert pd.read_csv(tmp_path / '2020_split1_res.csv')['incident_id'].tolist() == [1, 2]
+    assert pd.read_csv(tmp_path / '2020_split2_res.csv')['incident_id'].tolist() == [4]
+    assert pd.read_csv(tmp_path / '2020_split1.csv')['incident_url'].tolist() == [PREFIX + '3']
+    assert pd.read_csv(tmp_path / '2020_split2.csv')['incident_url'].tolist() == [PREFIX + '5']
+
+def test_bulk_refuses_result_files_as_sources(tmp_path):
+    write_source(tmp_path / 'a.csv', [1, 2])
+    write_result(tmp_path / 'b.csv', [1])
+    os.mkdir(tmp_path / 'res')
+    write_result(tmp_path / 'res' / 'r.csv', [1])
+
+    proc = run('--bulk', str(tmp_path / '*.csv'), str(tmp_path / 'res' / '*.csv'))
+
+    assert proc.returncode != 0
+    assert 'incident_id' in proc.stderr
+    # Nothing was touched, not even the real source.
+    assert len(pd.read_csv(tmp_path / 'a.csv')) == 2
+    assert len(pd.read_csv(tmp_path / 'b.csv')) == 1
+
+def test_refuses_result_file_as_source(tmp_path):
+    write_result(tmp_path / 'res.csv', [1, 2])
+
+    proc = run(str(tmp_path / 'res.csv'), str(tmp_path / 'res.csv'))
+
+    assert proc.returncode != 0
+    assert len(pd.read_csv(tmp_path / 'res.csv')) == 2
+
+def test_bulk_skips_result_files_without_incident_ids(tmp_path):
+    write_source(tmp_path / '2019_split1.csv', [1, 2, 3])
+    write_source(tmp_path / '2019_split2.csv', [4, 5, 6])
+    write_result(tmp_path / '2019_split1_res.csv', [1])
+    # Like the old results in scripts/2019: a 0,1,2,... header, a blank header line, and an empty file.
+    (tmp_path / '2019_split2_res.csv').write_text('0,1,2\n4,x,y\n')
+    (tmp_path / '2019_split3_res.csv').write_text('\n5,x,y\n')
+    (tmp_path / '2019_split4_res.csv').write_text('')
+
+    proc = run('--bulk', str(tmp_path / '2019_split*.csv'), str(tmp_path / '*_res.csv'))
+
+    assert proc.returncode == 0, proc.stderr
+    for n in [2, 3, 4]:
+        assert '2019_split{}_res.csv'.format(n) in proc.stderr
+    assert 'Traceback' not in proc.stderr
+    assert pd.read_csv(tmp_path / '2019_split1.csv')['incident_url'].tolist() == [PREFIX + '2', PREFIX + '3']
+    assert len(pd.read_csv(tmp_path / '2019_split2.csv')) == 3
+
+def test_refuses_result_file_without_incident_ids(tmp_path):
+    write_source(tmp_path / 'source.csv', [1, 2])
+    (tmp_path / 'res.csv').write_text('0,1,2\n1,x,y\n')
+
+    proc = run(str(tmp_path / 'source.csv'), str(tmp_path / 'res.csv'))
+
+    assert proc.returncode != 0
+    assert 'no incident_id column' in proc.stderr
+    assert len(pd.read_csv(tmp_path / 'source.csv')) == 2
@@ -0,0 +1,72 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+import shard
+from shard import ShardQueue
+
+def make_queue(tmp_path):
+    input_fname = tmp_path / 'stage1.csv'
+    input_fname.write_text('incident_id,incident_url\n1,a\n2,b\n')
+    shard_dir = str(tmp_path / 'shards')
+    shard.plan(shard_dir, [str(input_fname)], rows_per_unit=10)
+    return shard_dir
+
+def run_together(*functions):
+    # Runs the functions in threads that start at the same moment and returns their results.
+    barrier = threading.Barrier(len(functions))
+    results = [None] * len(functions)
+    def run(i):
+        barrier.wait()
+        results[i] = functions[i]()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(functions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_a_live_lease_is_never_handed_out(tmp_path):
+    shard_dir = make_queue(tmp_path)
+    a = ShardQueue(shard_dir, worker_id='a', ttl=3600.0)
+    c = ShardQueue(shard_dir, worker_id='c', ttl=3600.0)
+    name, lease = a.acquire_next()
+    heartbeats, acquired = run_together(lambda: [a.heartbeat(name, lease) for _ in range(200)],
+                                        lambda: [c.try_acquire(name) for _ in range(200)])
+    assert all(heartbeats)
+    assert acquired == [None] * 200
+    assert a.lease(name) == lease
+    assert lease['attempts'] == 1
+
+def test_only_one_of_a_heartbeat_and_a_takeover_wins(tmp_path):
+    for i in range(30):
+        (tmp_path / str(i)).mkdir()
+        shard_dir = make_queue(tmp_path / str(i))
+        a = ShardQueue(shard_dir, worker_id='a', ttl=0.0)
+        b = ShardQueue(shard_dir, worker_id='b', ttl=0.0)
+        name, lease = a.acquire_next()
+        # Both may succeed, one after the other, since b sees every lease as expired; then b owns the unit.
+        renewed, taken = run_together(lambda: a.heartbeat(name, lease), lambda: b.try_acquire(name))
+        assert renewed or taken is not None
+        if taken is None:
+            assert a.lease(name) == lease
+        else:
+            assert taken['attempts'] == 2
+            assert a.lease(name) == taken
+            assert not a.heartbeat(name, lease)
+            assert not a.release(name, lease)
+            assert a.lease(name) == taken
+        assert len(os.listdir(os.path.join(shard_dir, shard.LEASE_DIRNAME, name))) == 1
+
+def test_release_marks_a_complete_unit_done(tmp_path):
+    shard_dir = make_queue(tmp_path)
+    queue = ShardQueue(shard_dir, worker_id='a')
+    name, lease = queue.acquire_next()
+    with open(queue.path(name, 'output'), 'w') as file:
+        file.write('incident_id,incident_url\n1,a\n2,b\n')
+    assert queue.release(name, lease)
+    assert queue.done(name)['rows'] == 2
+    assert queue.acquire_next() == (None, None)
+    assert queue.is_settled()
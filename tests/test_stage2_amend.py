@@ -0,0 +1,90 @@
+import asyncio
+import os
+import sys
+import types
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+# selenium_utils starts Chrome when it's imported; these tests don't use a browser.
+sys.modules.setdefault('selenium_utils', types.ModuleType('selenium_utils'))
+
+import stage2
+from stage2_extractor import ALL_FIELD_NAMES
+from stage2_session import IpBlocked
+
+SAMPLE_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'intermediate', 'stage2.01.2014.csv')
+INPUT_FNAME = 'stage2.01.2014.csv'
+
+class FakeSession(object):
+    # Stands in for Stage2Session, returning the fields of the sample rows instead of fetching pages.
+    fields = {}
+    error = None
+
+    def __init__(self, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def iter_fields_from_incident_urls(self, rows, driver, executor, queue_size):
+        for row in rows:
+            if self.error is not None:
+                raise self.error
+            yield row, self.fields.get(row['incident_id']), 'digest'
+
+    def fetch_summary(self):
+        return ''
+
+@pytest.fixture
+def amend_input(tmp_path, monkeypatch):
+    # A month in which two incidents are missing their fields.
+    sample = pd.read_csv(SAMPLE_FNAME, nrows=6)
+    missing = sample.index.isin([1, 3])
+    amend_input = sample.copy()
+    amend_input['incident_url_fields_missing'] = missing
+    for name in ALL_FIELD_NAMES:
+        amend_input[name] = amend_input[name].astype(object)
+    amend_input.loc[missing, ALL_FIELD_NAMES] = None
+    monkeypatch.chdir(tmp_path)
+    amend_input.to_csv(INPUT_FNAME, index=False, encoding='utf-8')
+    monkeypatch.setattr(stage2, 'Stage2Session', FakeSession)
+    monkeypatch.setattr(sys, 'argv', ['stage2.py', INPUT_FNAME, '.am', '--amend', '-f', 'proxy', '-w', '0'])
+    FakeSession.fields = {row['incident_id']: {name: row[name] for name in ALL_FIELD_NAMES}
+                          for row in sample[missing].to_dict('records')}
+    FakeSession.error = None
+    return sample
+
+def run_amend():
+    args = stage2.parse_args()
+    with stage2.open_journal(INPUT_FNAME + '.am', args) as journal:
+        asyncio.run(stage2.add_fields_from_incident_url(None, stage2.iter_input_rows(args, journal.completed_ids),
+                                                       args, journal))
+        stage2.copy_remaining_rows(args, journal)
+    with open(INPUT_FNAME + '.am', encoding='utf-8') as file:
+        return file.read()
+
+def test_amended_rows_are_no_longer_missing_fields(amend_input):
+    text = run_amend()
+    # stage2_amend replaces the input with files that `grep -L ',True,'` lists.
+    assert ',True,' not in text
+    output = pd.read_csv(INPUT_FNAME + '.am')
+    assert sorted(output['incident_id']) == sorted(amend_input['incident_id'])
+    assert not output['incident_url_fields_missing'].any()
+
+def test_rows_that_could_not_be_amended_keep_the_input_back(amend_input):
+    del FakeSession.fields[amend_input['incident_id'][3]]
+    assert ',True,' in run_amend()
+
+def test_only_ip_blocks_are_caught(amend_input):
+    FakeSession.error = IpBlocked()
+    run_amend()
+    os.remove(INPUT_FNAME + '.am')
+    FakeSession.error = RuntimeError("extraction bug")
+    with pytest.raises(RuntimeError):
+        run_amend()
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from stage2_decoder import PARTICIPANT_FIELDS, decode_list, legacy_rows, participants
+
+URL = 'http://example.com/story?a=1|b=2'
+
+def stage2_rows(dates, participant_types, sources):
+    df = pd.DataFrame({'incident_id': range(len(dates)), 'date': pd.to_datetime(dates), 'sources': sources})
+    for field in PARTICIPANT_FIELDS:
+        df['participant_' + field] = participant_types if field == 'type' else None
+    return df
+
+def test_a_single_new_format_item_may_contain_a_bar():
+    df = stage2_rows(['2017-01-01', '2017-01-02'], ['0::Victim', None], [URL, URL])
+    assert not legacy_rows(df).any()
+    assert decode_list(df['sources'], legacy_rows(df)).tolist() == [URL, URL]
+
+def test_legacy_rows_are_told_apart_by_their_dict_columns():
+    # Like stage2.03.2014.csv: mostly old-format rows, some new ones, and rows without participants that go
+    # with the rest of their month. The April row is from another file.
+    df = stage2_rows(['2014-03-01', '2014-03-02', '2014-03-03', '2014-04-01'],
+                     ['0:Victim|1:Subject-Suspect', '0::Victim||1::Victim', None, None],
+                     ['a|b', URL, 'c|d', URL])
+    assert legacy_rows(df).tolist() == [True, False, True, False]
+    assert decode_list(df['sources'], legacy_rows(df)).tolist() == ['a', 'b', URL, 'c', 'd', URL]
+    assert participants(df)['type'].tolist() == ['Victim', 'Subject-Suspect', 'Victim', 'Victim']
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from stage2_journal import Stage2Journal
+
+COLUMNS = ['incident_id', 'notes']
+
+def write_journal(fname, records):
+    with Stage2Journal(fname, COLUMNS) as journal:
+        for record in records:
+            journal.append(record)
+
+def resume(fname):
+    with Stage2Journal(fname, COLUMNS) as journal:
+        return journal.completed_ids
+
+def test_torn_row_with_quoted_newline(tmp_path):
+    fname = str(tmp_path / 'out.csv')
+    write_journal(fname, [{'incident_id': 1, 'notes': 'one line'},
+                          {'incident_id': 2, 'notes': 'first line\nsecond line'}])
+    with open(fname, 'rb') as file:
+        data = file.read()
+    # Cut right after the newline inside the quoted notes, so the file still ends in a newline.
+    with open(fname, 'wb') as file:
+        file.write(data[:data.index(b'first line\n') + len(b'first line\n')])
+
+    assert resume(fname) == {1}
+    write_journal(fname, [{'incident_id': 2, 'notes': 'first line\nsecond line'}])
+    assert pd.read_csv(fname)['notes'].tolist() == ['one line', 'first line\nsecond line']
+
+def test_torn_row_longer_than_64k(tmp_path):
+    fname = str(tmp_path / 'out.csv')
+    write_journal(fname, [{'incident_id': 1, 'notes': 'short'},
+                          {'incident_id': 2, 'notes': 'x' * 100000}])
+    with open(fname, 'rb+') as file:
+        file.truncate(os.path.getsize(fname) - 10)
+
+    assert resume(fname) == {1}
+    assert pd.read_csv(fname)['incident_id'].tolist() == [1]
+
+def test_complete_journal_is_left_alone(tmp_path):
+    fname = str(tmp_path / 'out.csv')
+    write_journal(fname, [{'incident_id': 1, 'notes': 'a\n"quoted"\nb'}, {'incident_id': 2, 'notes': ''}])
+    size = os.path.getsize(fname)
+
+    assert resume(fname) == {1, 2}
+    assert os.path.getsize(fname) == size
+
+def test_rows_end_like_pandas_wrote_them(tmp_path):
+    fname = str(tmp_path / 'out.csv')
+    write_journal(fname, [{'incident_id': 1, 'notes': 'x'}])
+    write_journal(fname, [{'incident_id': 2, 'notes': 'y'}])
+    with open(fname, 'rb') as file:
+        assert file.read() == pd.DataFrame({'incident_id': [1, 2], 'notes': ['x', 'y']}).to_csv(index=False).encode()
+
+def test_appends_keep_an_older_journals_line_endings(tmp_path):
+    fname = str(tmp_path / 'out.csv')
+    with open(fname, 'wb') as file:
+        file.write(b'incident_id,notes\r\n1,x\r\n')
+    write_journal(fname, [{'incident_id': 2, 'notes': 'y'}])
+    with open(fname, 'rb') as file:
+        assert file.read() == b'incident_id,notes\r\n1,x\r\n2,y\r\n'
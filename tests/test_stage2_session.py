@@ -0,0 +1,41 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from page_cache import PageCache
+from stage2_session import Stage2Session, _retry_reason
+
+URL = 'http://www.gunviolencearchive.org/incident/1'
+PAGE = '<html><body><div class="region-content"><h2>Location</h2></div></body></html>'
+CHALLENGE = '<html><head><title>Just a moment...</title></head><body></body></html>'
+
+def fetch_via_proxy(tmp_path, status, text):
+    cache = PageCache(str(tmp_path / 'cache'))
+    session = Stage2Session(cache=cache)
+    async def get(url):
+        return {'status': 'ok', 'solution': {'url': url, 'status': status, 'response': text}}
+    session._get = get
+    try:
+        return asyncio.run(session._fetch_incident_html_via_proxy({'incident_url': URL})), cache
+    except Exception as exc:
+        return exc, cache
+
+@pytest.mark.parametrize('status, text, retried', [
+    (503, PAGE, True),
+    (403, CHALLENGE, True),
+    (404, PAGE, False),
+])
+def test_error_pages_from_the_proxy_are_not_cached(tmp_path, status, text, retried):
+    exc, cache = fetch_via_proxy(tmp_path, status, text)
+    assert isinstance(exc, Exception)
+    assert (_retry_reason(exc) is not None) == retried
+    assert cache.get_digest(URL) is None
+
+def test_pages_from_the_proxy_are_cached(tmp_path):
+    text, cache = fetch_via_proxy(tmp_path, 200, PAGE)
+    assert text == '<h2>Location</h2>'
+    assert cache.get_digest(URL) is not None